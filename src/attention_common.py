@@ -19,19 +19,20 @@ from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
 from tensorflow.python.ops import variable_scope
 
-def intra_temporal_context(decoder_states, encoder_states, eti, enc_padding_mask):
+def intra_temporal_context(decoder_states, encoder_states, eti_logsumexp, enc_padding_mask, encoder_features=None):
     '''
     Caculate the intra_temporal context
     :param decoder_states:
     :param encoder_states:
-    :param eti:
+    :param eti_logsumexp: the running log-sum-exp of the previous attention scores, see intra_temporal_attention
     :param enc_padding_mask:
-    :return:
+    :param encoder_features: Optional. The output of intra_temporal_encoder_features for encoder_states, if already computed
+    :return: context vector, attention distribution and the updated eti_logsumexp
     '''
     # Calculate encoder distribution
     # Mask padded sequences
-    temporal_attention = intra_temporal_attention(decoder_states,
-                                                      encoder_states, eti)
+    temporal_attention, eti_logsumexp = intra_temporal_attention(decoder_states,
+                                                      encoder_states, eti_logsumexp, encoder_features)
     attn_dist = masked_attention(temporal_attention, enc_padding_mask)
 
     # Equation (5)
@@ -44,27 +45,17 @@ def intra_temporal_context(decoder_states, encoder_states, eti, enc_padding_mask
     # print(temporal_context.get_shape())--> (16, 512)
     context_vector = temporal_context
 
-    return context_vector, attn_dist
+    return context_vector, attn_dist, eti_logsumexp
 
 
-def intra_temporal_attention(decoder_states, encoder_states, eti_list):
+def intra_temporal_encoder_features(encoder_states, decoder_hidden_vec_size):
     '''
-    Get Intra-Temporal Attention Score. Refs to original paper section 2.1 https://arxiv.org/abs/1705.04304
-    :param decoder_states: list of Tuple (c, h) from output of a LSTM cell,
-                          each h has shape [batch_size, hidden_vector_size]
+    Get the encoder side of the Intra-Temporal Attention score, h_e W_e_attn in equation (2). It only depends on the encoder states,
+    so in decode mode it is computed once per batch and passed to intra_temporal_attention instead of being recomputed on every decoder step.
     :param encoder_states: expanded outputs from RNN, has shape [batch_size, T, 1, hidden_vector_size]
-    :param eti_list: attention score list, shape [decoder_t, batch_size, encoder_T]
-                          and the new attention score will also appended to the end
-    :return:temporal attention score: shape [decoder_t, attention_vector_size]
+    :param decoder_hidden_vec_size: size of the decoder hidden state
+    :return: encoder features, shape [batch_size, T, decoder_hidden_vec_size]
     '''
-    # Extract hidden state from list and tuple of decoder states
-    decoder_state = decoder_states[-1][1]
-    # decoder_state[1].get_shape() (batch_size, hidden_vec_size)
-
-    decoder_hidden_vec_size = decoder_state.get_shape()[1].value
-    encoder_hidden_vec_size = encoder_states.get_shape()[3].value
-
-    # Intra-Temporal Attention
     with variable_scope.variable_scope("IT_Attention"):
 
         # As matter of fact the Encoder is bidirectional LSTM, it has 2 * hidden_vector_size,
@@ -82,8 +73,6 @@ def intra_temporal_attention(decoder_states, encoder_states, eti_list):
                                           decoder_hidden_vec_size),
                 initializer=tf.contrib.layers.xavier_initializer())
 
-        decoder_T = len(decoder_states)
-
         #encoder_states_dot_W = nn_ops.conv2d(trans_encoder_states, W_e_attn,
         #                                    [1, 1, 1, 1],
         #                                    "SAME")
@@ -93,6 +82,42 @@ def intra_temporal_attention(decoder_states, encoder_states, eti_list):
         # tf.logging.info("encoder_states_dot_W.shape {}".format(encoder_states_dot_W.get_shape()))
         # encoder_states_dot_W.shape (16, len_attn, 1, 256)
 
+    return encoder_states_dot_W
+
+def initial_eti_logsumexp(enc_padding_mask):
+    '''
+    The eti_logsumexp for the first decoder step, when there are no previous attention scores: log(0) = -inf everywhere
+    :param enc_padding_mask: shape [batch_size, encoder_T]
+    :return: shape [batch_size, encoder_T]
+    '''
+    return tf.fill(tf.shape(enc_padding_mask), float('-inf'))
+
+def intra_temporal_attention(decoder_states, encoder_states, eti_logsumexp, encoder_features=None):
+    '''
+    Get Intra-Temporal Attention Score. Refs to original paper section 2.1 https://arxiv.org/abs/1705.04304
+    Rather than the list of all the previous attention scores eti, only log(sum_j exp(etj)) over the previous steps is carried
+    from step to step, so each step costs the same and nothing is exponentiated outside a log-sum-exp or softmax.
+    :param decoder_states: list of Tuple (c, h) from output of a LSTM cell,
+                          each h has shape [batch_size, hidden_vector_size]
+    :param encoder_states: expanded outputs from RNN, has shape [batch_size, T, 1, hidden_vector_size]
+    :param eti_logsumexp: log of the sum of exp of the attention scores of the previous decoder steps, shape [batch_size, encoder_T].
+                          -inf on the first step (see initial_eti_logsumexp)
+    :param encoder_features: Optional. The output of intra_temporal_encoder_features for encoder_states; computed here if None
+    :return:temporal attention score: shape [batch_size, encoder_T], and eti_logsumexp updated with this step's scores
+    '''
+    # Extract hidden state from list and tuple of decoder states
+    decoder_state = decoder_states[-1][1]
+    # decoder_state[1].get_shape() (batch_size, hidden_vec_size)
+
+    decoder_hidden_vec_size = decoder_state.get_shape()[1].value
+
+    if encoder_features is None:
+        encoder_features = intra_temporal_encoder_features(encoder_states, decoder_hidden_vec_size)
+    encoder_states_dot_W = encoder_features
+
+    # Intra-Temporal Attention
+    with variable_scope.variable_scope("IT_Attention"):
+
         #decoder_state = tf.expand_dims(tf.expand_dims(decoder_state, 1), 1)
         # reshape to (batch_size, 1, 1, decoder_hidden_vec_size)
 
@@ -100,42 +125,52 @@ def intra_temporal_attention(decoder_states, encoder_states, eti_list):
         e = tf.einsum("bi,bti->bt", decoder_state, encoder_states_dot_W)
         # shape: (batch_size x attn_length)
 
-        # Equation (3)
-        if decoder_T == 1:
-            e_prime = tf.exp(e)
-        else:
-            denominator = tf.reduce_sum(tf.exp(eti_list), axis=0)
-            e_prime = tf.divide(tf.exp(e), denominator)
+        # Equation (3), in log space: log(e_prime) = e - eti_logsumexp, except on the first step where e_prime = exp(e)
+        log_denominator = tf.where(tf.is_finite(eti_logsumexp), eti_logsumexp, tf.zeros_like(eti_logsumexp))
+        log_e_prime = e - log_denominator
         # tf.logging.info("e_prime.shape:{}".format(e_prime.get_shape())) # (batch_size, attn_length)
 
-        # append to eti list after e_prime been calculated
-        eti_list.append(e)
+        # add this step's scores to the running sum after e_prime been calculated
+        eti_logsumexp = tf.reduce_logsumexp(tf.stack([eti_logsumexp, e]), axis=0)
         # tf.logging.info("e.shape:{}".format(e.get_shape()))
         # e.shape:(batch_size, ?)
 
-        # Equation (4)
-        attn_score = tf.divide(e_prime, tf.reduce_sum(e_prime, axis=1, keep_dims=True)) #tf.nn.softmax(e_prime)
+        # Equation (4): e_prime / sum(e_prime) is the softmax of log(e_prime)
+        attn_score = tf.nn.softmax(log_e_prime)
         # tf.logging.info("attn_score.shape:{}".format(attn_score.get_shape())) # attn_score.shape:(16, attn_length)
 
-        return attn_score
+        return attn_score, eti_logsumexp
+
+def intra_decoder_history(size, batch_size, decoder_hidden_size):
+    '''
+    The history that the Intra-Decoder Attention reads from: the decoder hidden states h_t' of the previous steps, and the same
+    states multiplied by W_d_attn (the decoder side of equation (6)). Each step's entries are written once, on that step, by
+    intra_decoder_attention, so a step only has to compute its own row of scores.
+    :param size: the number of decoder steps
+    :param batch_size:
+    :param decoder_hidden_size:
+    :return: tuple of two TensorArrays (states, states_dot_W), elements of shape [batch_size, decoder_hidden_size]
+    '''
+    return tuple(tf.TensorArray(tf.float32, size=size, clear_after_read=False,
+                                element_shape=[batch_size, decoder_hidden_size]) for _ in range(2))
 
-def intra_decoder_attention(decoder_states_stack):
+def intra_decoder_attention(decoder_state, t, history):
     '''
     Get Intra-Decoder Attention Score. Refs to original paper section 2.2
     https://arxiv.org/abs/1705.04304.
     Args:
-        decoder_states_stack: tensor of decoder hidden states
-            size = [T, batch_size, decoder_hidden_size]
+        decoder_state: the decoder hidden state of step t,
+            size = [batch_size, decoder_hidden_size]
+        t: the decoder step, a python int or a scalar int32 tensor (inside a tf.while_loop)
+        history: the states of steps 0..t-1, see intra_decoder_history
     Returns:
         attn_score: tensor of attnetion scores alpha_d_tt (Equation 7),
-            size = [batch_size, T - 1]
+            size = [batch_size, t], or zeros of size [batch_size, 1] on the first step
+        history: with the states of step t written
     '''
-    batch_size = decoder_states_stack[-1].get_shape()[0].value
-    decoder_T = decoder_states_stack.get_shape()[0]
-    decoder_state = decoder_states_stack[-1]
-    # decoder_state[1].get_shape() (batch_size, hidden_vec_size)
-
+    batch_size = decoder_state.get_shape()[0].value
     decoder_hidden_vec_size = decoder_state.get_shape().as_list()[-1]
+    states_ta, states_dot_W_ta = history
 
     # Intra-Decoder Attention
     with variable_scope.variable_scope("ID_Attention"):
@@ -145,43 +180,57 @@ def intra_decoder_attention(decoder_states_stack):
             shape=(decoder_hidden_vec_size, decoder_hidden_vec_size),
             initializer=tf.contrib.layers.xavier_initializer())
 
-        if decoder_T > 1:
-            # Equation (6)
-            # return shape [T-1, batch_size, hidden_state_size]
-            decoder_states_dot_W = tf.einsum(
-                "ij,tbi->tbj", W_d_attn, decoder_states_stack[:-1])
+        def scores():
+            # Equation (6), against the previous steps only
+            # shape [t, batch_size, hidden_state_size]
+            decoder_states_dot_W = states_dot_W_ta.gather(tf.range(t))
 
             e = tf.einsum("tbi,bi->bt", decoder_states_dot_W, decoder_state)
-            # return shape [batch_size, T-1]
+            # return shape [batch_size, t]
 
             # Equation (7)
-            attn_score = tf.nn.softmax(e)
-            # shape (batch_size, decoder_T-1)
+            return tf.nn.softmax(e)
+
+        def no_scores():
+            return tf.zeros([batch_size, 1])
+
+        if isinstance(t, int):
+            attn_score = scores() if t > 0 else no_scores()
         else:
-            attn_score = tf.zeros([batch_size, 1])
+            attn_score = tf.cond(t > 0, scores, no_scores)
 
-        return attn_score
+        # W_d_attn h_t for the later steps; this is the only multiplication by W_d_attn on this step
+        history = (states_ta.write(t, decoder_state),
+                   states_dot_W_ta.write(t, tf.matmul(decoder_state, W_d_attn)))
 
-def intra_decoder_context(decoder_states_stack):
+        return attn_score, history
+
+def intra_decoder_context(decoder_state, t, history):
     '''
-    :param decoder_states_stack: shape T x batch_size x decoder_hidden_size
-    :return: intra_decoder_context shape batch_size x decoder_hidden_size
+    :param decoder_state: the decoder hidden state of step t, shape batch_size x decoder_hidden_size
+    :param t: the decoder step, a python int or a scalar int32 tensor
+    :param history: the states of steps 0..t-1, see intra_decoder_history
+    :return: intra_decoder_context shape batch_size x decoder_hidden_size, and history with the states of step t written
     '''
-    T, batch_size, decoder_hidden_size = decoder_states_stack.get_shape().as_list()
-    decoder_attention = intra_decoder_attention(decoder_states_stack)
+    batch_size, decoder_hidden_size = decoder_state.get_shape().as_list()
+    states_ta = history[0]
+    decoder_attention, history = intra_decoder_attention(decoder_state, t, history)
     # Equation (8)
-    # decoder_states_stack: T x batch_size x decoder_hidden_size
-    # decoder_attention: batch_size x T - 1
+    # previous decoder states: t x batch_size x decoder_hidden_size
+    # decoder_attention: batch_size x t
     # Result has shape (batch_size, decoder_hidden_size)
-    if T > 1:
-        decoder_context = tf.einsum('tbh,bt->bh',
-                                    decoder_states_stack[:-1, :, :],
-                                    decoder_attention)
-                                    # ignore the last e
+    def context():
+        return tf.einsum('tbh,bt->bh', states_ta.gather(tf.range(t)), decoder_attention)
+
+    def no_context():
+        return tf.zeros(shape=[batch_size, decoder_hidden_size])
+
+    if isinstance(t, int):
+        decoder_context = context() if t > 0 else no_context()
     else:
-        decoder_context = tf.zeros(shape=[batch_size, decoder_hidden_size])
+        decoder_context = tf.cond(t > 0, context, no_context)
 
-    return decoder_context
+    return decoder_context, history
 
 def masked_attention_with_softmax(e, masks):
     """Take softmax of e then apply enc_padding_mask and re-normalize"""
@@ -208,6 +257,22 @@ def masked_attention(e, enc_padding_mask):
     return attn_dist / tf.reshape(masked_sums, [-1, 1])  # re-normalize
 
 
+def calculate_p_gens(p_gen_inputs):
+    '''
+    Calculate the generation probability p_gen of all decoder steps at once
+    Args:
+        p_gen_inputs: tensor of the concatenated [context_vector, state.c,
+            state.h, inp] of every decoder step, stacked along the batch axis
+            size = (dec_len * batch_size) x input_size
+    Returns:
+        p_gens: tensor of generation probabilities, in the same row order
+            size = (dec_len * batch_size) x 1
+    '''
+    # Called after the decoder loop, where the enclosing scope may already be in reuse mode
+    with tf.variable_scope('calculate_pgen', reuse=tf.AUTO_REUSE):
+        return tf.sigmoid(linear(p_gen_inputs, 1, True))
+
+
 def linear(args, output_size, bias, bias_start=0.0, scope=None):
     """Linear map: sum_i(args[i] * W[i]), where W[i] is a variable.
     Args:
@@ -278,7 +343,8 @@ def test_intra_temporal_attention(args):
     lstm_decode_cell = tf.nn.rnn_cell.LSTMCell(decoder_vector_size)
     initial_state = lstm_decode_cell.zero_state(batch_size, tf.float32)
 
-    eti_list = []
+    eti_logsumexp = tf.fill([batch_size, max_total_time], float('-inf'))
+    eti_logsumexps = [eti_logsumexp]
 
     #construct encoder_states
     inputs = tf.random_normal(shape=(batch_size, max_total_time, input_vector_size))
@@ -292,33 +358,19 @@ def test_intra_temporal_attention(args):
         inputs = tf.random_normal(shape=(batch_size, input_vector_size))
         output, state = lstm_decode_cell(inputs, initial_state)
         decoder_states.append(state)
-        attn_score = intra_temporal_attention(decoder_states, encoder_states, eti_list)
+        attn_score, eti_logsumexp = intra_temporal_attention(decoder_states, encoder_states, eti_logsumexp)
+        eti_logsumexps.append(eti_logsumexp)
 
     with variable_scope.variable_scope("IT_Attention"):
         variable_scope.get_variable_scope().reuse_variables()
         W_d_attn = tf.get_variable('W_e_attn')
     with tf.Session() as sess:
         sess.run(tf.global_variables_initializer())
-        _attn_score, _eti_list, _W, _states, _decoder_states = sess.run([attn_score, eti_list, W_d_attn, encoder_states, decoder_states])
-        print("[attn_score]")#, eti_list[-1]") #, W_d_attn, encoder_states]")
-        print(_attn_score)
-        print("the last eti from eti_list[-1]")
-        print(_eti_list[-1])
-
-        # To verify the equation (3) and (4) calculation
-        _eti = np.exp(_eti_list[-1]) #shape [batch_size, encoder_sequence_length]
-        _eti_list = _eti_list[:-1] # remove last one
-        # t > 1 in our test case
-        exp_eti = np.exp(_eti_list) # shape [T-1, batch_size, encoder_sequence_length]
-        denominator = np.sum(exp_eti, axis=0) # shape [batch_size, encoder_sequence_length]
-        temporal_score = _eti / denominator # eti_prime at current time T shape [batch_size, encoder_sequence_length]
-        attn = temporal_score / np.sum(temporal_score, axis=1, keepdims=True)
-        print("Equation (4) output:")
-        print(attn)
-        print("with softmax:")
-        print(np.exp(temporal_score) / np.sum(np.exp(temporal_score), axis=1, keepdims=True))
-        print("Function output:")
+        _attn_score, _eti_logsumexps, _W, _states, _decoder_states = sess.run([attn_score, eti_logsumexps, W_d_attn, encoder_states, decoder_states])
+        print("[attn_score]") #, W_d_attn, encoder_states]")
         print(_attn_score)
+        print("the running log-sum-exp of the eti before the last step")
+        print(_eti_logsumexps[-2])
 
         # print("decoder_states")
         # print(_decoder_states)
@@ -350,9 +402,8 @@ def test_intra_temporal_attention(args):
         print(e_ti_right)
         # To-do: need t==1 test case
         e_ti_prime = np.exp(e_ti)
-        print("eti list shape:{} x {}".format(len(_eti_list), _eti_list[0].shape))
-        denominator = np.sum(np.exp(_eti_list), axis=0) # shape [batch_size, max_total_time]
-        print(np.exp(_eti_list))
+        # t > 1 in our test case
+        denominator = np.exp(_eti_logsumexps[-2]) # shape [batch_size, max_total_time]
         print(denominator.shape)
         temporal_score = e_ti_prime / denominator
         print("temporal_score (equation 3)")
@@ -373,7 +424,7 @@ def test_intra_temporal_attention(args):
     _states:        [batch_size, max_total_time, 1, hidden_vector_size]
     _decoder_states: list length decoder_t, the second value in the Tuple has shape [batch_size, hidden_vector_size]
     _W:             [hidden_vector_size, hidden_vector_size]
-    _eti_list:       list length decoder_t, element [batch_size, max_total_time]
+    _eti_logsumexps: list length decoder_t + 1, element [batch_size, max_total_time]
 '''
 
 
@@ -429,6 +480,19 @@ def get_decoder_states_stack():
 
     return decoder_states_stack
 
+def run_intra_decoder_steps(decoder_states_stack, step_fn):
+    '''
+    Run step_fn (intra_decoder_attention or intra_decoder_context) over every step of decoder_states_stack
+    :return: the output of step_fn on the last step
+    '''
+    T, batch_size, hidden_vector_size = decoder_states_stack.get_shape().as_list()
+    history = intra_decoder_history(T, batch_size, hidden_vector_size)
+    for t in range(T):
+        if t > 0:
+            variable_scope.get_variable_scope().reuse_variables()
+        output, history = step_fn(decoder_states_stack[t], t, history)
+    return output
+
 def test_intra_decoder_attention(args):
     #(decoder_states, decoder_states_stack):
     '''
@@ -438,7 +502,7 @@ def test_intra_decoder_attention(args):
     '''
 
     dec_stack = get_decoder_states_stack()
-    attn = intra_decoder_attention(dec_stack)
+    attn = run_intra_decoder_steps(dec_stack, intra_decoder_attention)
 
     with variable_scope.variable_scope("ID_Attention"):
         variable_scope.get_variable_scope().reuse_variables()
@@ -490,7 +554,7 @@ def test_intra_decoder_attention(args):
 '''
 
 def test_intra_decoder_context(args):
-    context = intra_decoder_context(get_decoder_states_stack())
+    context = run_intra_decoder_steps(get_decoder_states_stack(), intra_decoder_context)
 
     with tf.Session() as sess:
         sess.run(tf.global_variables_initializer())
@@ -22,13 +22,15 @@ from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
 from tensorflow.python.ops import variable_scope
-from attention_common import intra_decoder_context, intra_temporal_context, masked_attention_with_softmax
+from attention_common import calculate_p_gens, initial_eti_logsumexp, intra_decoder_context, intra_decoder_history, \
+    intra_temporal_context, intra_temporal_encoder_features, masked_attention_with_softmax
 
 
 # Note: this function is based on tf.contrib.legacy_seq2seq_attention_decoder, which is now outdated.
 # In the future, it would make more sense to write variants on the attention mechanism using the new seq2seq library for tensorflow 1.0: https://www.tensorflow.org/api_guides/python/contrib.seq2seq#Attention
 def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding_mask, cell,
-                      initial_state_attention=False, pointer_gen=True, use_coverage=False, prev_coverage=None, input_attention=1, use_intra_decoder_attention=0):
+                      initial_state_attention=False, pointer_gen=True, use_coverage=False, prev_coverage=None, input_attention=1, use_intra_decoder_attention=0,
+                      encoder_features=None, temporal_encoder_features=None, prev_eti_logsumexp=None):
     """
     Args:
       decoder_inputs: A list of 2D Tensors [batch_size x input_size].
@@ -37,11 +39,17 @@ def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding
       enc_padding_mask: 2D Tensor [batch_size x attn_length] containing 1s and 0s; indicates which of the encoder locations are padding (0) or a real token (1).
       cell: rnn_cell.RNNCell defining the cell function and size.
       initial_state_attention:
-        Note that this attention decoder passes each decoder input through a linear layer with the previous step's context vector to get a modified version of the input. If initial_state_attention is False, on the first decoder step the "previous context vector" is just a zero vector. If initial_state_attention is True, we use initial_state to (re)calculate the previous step's context vector. We set this to False for train/eval mode (because we call attention_decoder once for all decoder steps) and True for decode mode (because we call attention_decoder once for each decoder step).
+        Unused; for the same signature as intra_attention_decoder. That decoder passes each decoder input through a linear layer with the previous step's context vector, so in decode mode it needs initial_state to (re)calculate the previous step's context vector. This decoder runs the cell on the decoder inputs alone.
       pointer_gen: boolean. If True, calculate the generation probability p_gen for each decoder step.
       use_coverage: boolean. If True, use coverage mechanism.
       prev_coverage:
         If not None, a tensor with shape (batch_size, attn_length). The previous step's coverage vector. This is only not None in decode mode when using coverage.
+      encoder_features:
+        If not None, the output of encoder_attention_features for encoder_states, computed outside the decoder (in decode mode, once per batch instead of on every step). The W_h variable must then already exist.
+      temporal_encoder_features:
+        If not None, the output of attention_common.intra_temporal_encoder_features for encoder_states, likewise computed outside the decoder.
+      prev_eti_logsumexp:
+        If not None, a tensor with shape (batch_size, attn_length). The running log-sum-exp of the intra temporal attention scores of the previous steps. This is only not None in decode mode when using intra temporal attention.
 
     Returns:
       outputs: A list of the same length as decoder_inputs of 2D Tensors of
@@ -51,6 +59,7 @@ def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding
         The attention distributions for each decoder step.
       p_gens: List of scalars. The values of p_gen for each decoder step. Empty list if pointer_gen=False.
       coverage: Coverage vector on the last step computed. None if use_coverage=False.
+      eti_logsumexp: The running log-sum-exp of the intra temporal attention scores, including the last step. None unless using intra temporal attention.
     """
     with variable_scope.variable_scope("attention_decoder") as scope:
         batch_size = encoder_states.get_shape()[
@@ -68,16 +77,16 @@ def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding
         # We set it to be equal to the size of the encoder states.
         attention_vec_size = attn_size
 
-        # Get the weight matrix W_h and apply it to each encoder state to get (W_h h_i), the encoder features
-        W_h = variable_scope.get_variable("W_h", [1, 1, attn_size, attention_vec_size])
-        encoder_features = nn_ops.conv2d(encoder_states, W_h, [1, 1, 1, 1],
-                                         "SAME")  # shape (batch_size,attn_length,1,attention_vec_size)
+        # The pointer-generator attention is only built if used (use_intra_decoder_attention 0 or 1)
+        if use_intra_decoder_attention in [0, 1]:
+            if encoder_features is None:
+                encoder_features = encoder_attention_features(encoder_states)  # shape (batch_size,attn_length,1,attention_vec_size)
 
-        # Get the weight vectors v and w_c (w_c is for coverage)
-        v = variable_scope.get_variable("v", [attention_vec_size])
-        if use_coverage:
-            with variable_scope.variable_scope("coverage"):
-                w_c = variable_scope.get_variable("w_c", [1, 1, 1, attention_vec_size])
+            # Get the weight vectors v and w_c (w_c is for coverage)
+            v = variable_scope.get_variable("v", [attention_vec_size])
+            if use_coverage:
+                with variable_scope.variable_scope("coverage"):
+                    w_c = variable_scope.get_variable("w_c", [1, 1, 1, attention_vec_size])
 
         if prev_coverage is not None:  # for beam search mode with coverage
             # reshape from (batch_size, attn_length) to (batch_size, attn_len, 1, 1)
@@ -138,71 +147,41 @@ def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding
         outputs = []
         attn_dists = []
         p_gens = []
+        p_gen_inputs = []
         state = initial_state
 
         decoder_states = []  # hidden states from each decoder step
-        eti = []
+        # initialize the intra temporal attention history to none or whatever was passed in
+        eti_logsumexp = prev_eti_logsumexp if prev_eti_logsumexp is not None else initial_eti_logsumexp(enc_padding_mask)
+        # the intra decoder attention history; each step's hidden state is added to it once
+        decoder_hidden_size = initial_state[1].get_shape().as_list()[1]
+        use_decoder_history = use_intra_decoder_attention in [1, 2]
+        decoder_history = intra_decoder_history(len(decoder_inputs), batch_size, decoder_hidden_size) if use_decoder_history else None
 
         coverage = prev_coverage  # initialize coverage to None or whatever was passed in
-        context_vector = array_ops.zeros([batch_size, attn_size])
-        context_vector.set_shape([None, attn_size])  # Ensure the second shape of attention vectors is set.
-        if initial_state_attention:  # true in decode mode
-            # Re-calculate the context vector from the previous step so that we can pass it through a linear layer with this step's input to get a modified version of the input
-            attn_dist, context_vector, intra_context_vector = get_context(use_intra_decoder_attention,
-                                                                              attention, coverage,
-                                                                              [initial_state], tf.zeros(shape=[1, batch_size, initial_state[1].get_shape().as_list()[1]]),
-                                                                              enc_padding_mask, encoder_states, [],
-                                                                              initial_state)
+        # The decoder cell is run on the inputs alone, so unlike in intra_attention_decoder there is no previous context vector to re-calculate
         for i, inp in enumerate(decoder_inputs):
             tf.logging.info("Adding attention_decoder timestep %i of %i", i, len(decoder_inputs))
             if i > 0:
                 variable_scope.get_variable_scope().reuse_variables()
 
-            # Merge input and previous attentions into one vector x of the same size as inp
-            input_size = inp.get_shape().with_rank(2)[1]
-            if input_size.value is None:
-                raise ValueError("Could not infer input size from input: %s" % inp.name)
-
-            if use_intra_decoder_attention==1 or use_intra_decoder_attention==2:
-                if i==0:
-                    print("initial_state[1].shape {}".format(initial_state[1].get_shape()))
-                    intra_context_vector = tf.zeros(shape=[batch_size, initial_state[1].get_shape().as_list()[1]])
-                print("inp.shape {}, context_vector.shape {}, intra_context_vector.shape {}".format(inp.get_shape().as_list(), context_vector.get_shape().as_list(), intra_context_vector.get_shape()))
-                x = linear([inp] + [context_vector] + [intra_context_vector], input_size, True)
-            else: # 0 or 3
-                x = linear([inp] + [context_vector], input_size, True)
-
             # Run the decoder RNN cell. cell_output = decoder state
             cell_output, state = cell(inp, state)
 
             # Keep the decoder states
             decoder_states.append(state)
-            _, decoder_states_list = map(list, zip(*decoder_states))
-            decoder_states_stack = tf.stack(decoder_states_list)
 
             # Run the attention mechanism.
-            if i == 0 and initial_state_attention:  # always true in decode mode
-                with variable_scope.variable_scope(variable_scope.get_variable_scope(),
-                                                   reuse=True):  # you need this because you've already run the initial attention(...) call
-                    attn_dist, context_vector, intra_context_vector = get_context(use_intra_decoder_attention,
-                                                                                  attention, coverage,
-                                                                                  decoder_states, decoder_states_stack,
-                                                                                  enc_padding_mask, encoder_states, eti,
-                                                                                  state)
-            else:
-                attn_dist, context_vector, intra_context_vector = get_context(use_intra_decoder_attention,
+            attn_dist, context_vector, intra_context_vector, eti_logsumexp, decoder_history = get_context(use_intra_decoder_attention,
                                                                               attention, coverage,
-                                                                              decoder_states, decoder_states_stack,
-                                                                              enc_padding_mask, encoder_states, eti,
-                                                                              state)
+                                                                              decoder_states, decoder_history, i,
+                                                                              enc_padding_mask, encoder_states, eti_logsumexp,
+                                                                              state, temporal_encoder_features)
             attn_dists.append(attn_dist)
 
-            # Calculate p_gen
+            # Keep the inputs of p_gen, which is calculated for all steps at once after the loop
             if pointer_gen:
-                with tf.variable_scope('calculate_pgen'):
-                    p_gen = linear([context_vector, state.c, state.h, inp], 1, True)  # a scalar
-                    p_gen = tf.sigmoid(p_gen)
-                    p_gens.append(p_gen)
+                p_gen_inputs.append(tf.concat([context_vector, state.c, state.h, inp], axis=1))
 
             # Concatenate the cell_output (= decoder state) and the context vector, and pass them through a linear layer
             # This is V[s_t, h*_t] + b in the paper
@@ -213,15 +192,181 @@ def attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding
                     output = linear([cell_output] + [context_vector], cell.output_size, True)
             outputs.append(output)
 
+        # Calculate p_gen for all steps with a single matmul, rather than one small one per step
+        if pointer_gen:
+            p_gens = tf.split(calculate_p_gens(tf.concat(p_gen_inputs, axis=0)), len(decoder_inputs), axis=0)
+
         # If using coverage, reshape it
         if coverage is not None:
             coverage = array_ops.reshape(coverage, [batch_size, -1])
 
-        return {"outputs":outputs, "state":state, "attn_dists":attn_dists, "p_gens":p_gens, "coverage":coverage}
+        if use_intra_decoder_attention not in [2, 3]:  # no intra temporal attention
+            eti_logsumexp = None
+
+        return {"outputs":outputs, "state":state, "attn_dists":attn_dists, "p_gens":p_gens, "coverage":coverage,
+                "eti_logsumexp":eti_logsumexp}
+
+
+def dynamic_attention_decoder(decoder_inputs, initial_state, encoder_states, enc_padding_mask, cell, pointer_gen=True,
+                              use_coverage=False, use_intra_decoder_attention=0):
+    """The train/eval mode version of attention_decoder, run as a tf.while_loop over the decoder steps instead of unrolled in the graph.
+
+    This creates the same variables and computes the same values as attention_decoder with initial_state_attention=False and prev_coverage=None, but the graph has a single decoder step whatever the number of steps, and the number of steps is the (dynamic) length of decoder_inputs, so a batch only pays for as many steps as its longest target sequence.
+
+    Args:
+      decoder_inputs: 3D Tensor [batch_size x dec_len x input_size]. dec_len may be unknown.
+      initial_state: 2D Tensor [batch_size x cell.state_size].
+      encoder_states: 3D Tensor [batch_size x attn_length x attn_size].
+      enc_padding_mask: 2D Tensor [batch_size x attn_length] containing 1s and 0s; indicates which of the encoder locations are padding (0) or a real token (1).
+      cell: rnn_cell.RNNCell defining the cell function and size.
+      pointer_gen: boolean. If True, calculate the generation probability p_gen for each decoder step.
+      use_coverage: boolean. If True, create the coverage variable. As in attention_decoder in train/eval mode, the coverage vector itself is never fed back into the attention.
+      use_intra_decoder_attention: which attention to use, as for attention_decoder.
+
+    Returns:
+      outputs: 3D Tensor [batch_size x dec_len x cell.output_size]. The output vectors.
+      state: The final state of the decoder. A tensor shape [batch_size x cell.state_size].
+      attn_dists: 3D Tensor [batch_size x dec_len x attn_length]. The attention distributions for each decoder step.
+      p_gens: 3D Tensor [batch_size x dec_len x 1]. The values of p_gen for each decoder step. None if pointer_gen=False.
+      coverage: None, as for attention_decoder in train/eval mode.
+      eti_logsumexp: None; the intra temporal attention history is only needed to decode.
+    """
+    with variable_scope.variable_scope("attention_decoder"):
+        batch_size = encoder_states.get_shape()[
+            0].value  # if this line fails, it's because the batch size isn't defined
+        attn_size = encoder_states.get_shape()[
+            2].value  # if this line fails, it's because the attention length isn't defined
+        input_size = decoder_inputs.get_shape().with_rank(3)[2].value
+        if input_size is None:
+            raise ValueError("Could not infer input size from input: %s" % decoder_inputs.name)
+
+        # Reshape encoder_states (need to insert a dim)
+        encoder_states = tf.expand_dims(encoder_states, axis=2)  # now is shape (batch_size, attn_len, 1, attn_size)
+        attention_vec_size = attn_size
+
+        # The pointer-generator attention is only built if used (use_intra_decoder_attention 0 or 1)
+        if use_intra_decoder_attention in [0, 1]:
+            encoder_features = encoder_attention_features(encoder_states)  # shape (batch_size,attn_length,1,attention_vec_size)
+
+            # Get the weight vectors v and w_c (w_c is for coverage)
+            v = variable_scope.get_variable("v", [attention_vec_size])
+            if use_coverage:
+                with variable_scope.variable_scope("coverage"):
+                    variable_scope.get_variable("w_c", [1, 1, 1, attention_vec_size])
+
+        decoder_hidden_size = initial_state.h.get_shape()[1].value
+        temporal_encoder_features = None
+        if use_intra_decoder_attention in [2, 3]:
+            # The encoder side of the intra temporal attention does not change from step to step
+            temporal_encoder_features = intra_temporal_encoder_features(encoder_states, decoder_hidden_size)
+        use_decoder_history = use_intra_decoder_attention in [1, 2]
+
+        def attention(decoder_state, coverage=None):
+            """Calculate the context vector and attention distribution from the decoder state, like attention_decoder's attention without coverage (coverage is ignored)."""
+            with variable_scope.variable_scope("Attention"):
+                # Pass the decoder state through a linear layer (this is W_s s_t + b_attn in the paper)
+                decoder_features = linear(decoder_state, attention_vec_size,
+                                          True)  # shape (batch_size, attention_vec_size)
+                decoder_features = tf.expand_dims(tf.expand_dims(decoder_features, 1),
+                                                  1)  # reshape to (batch_size, 1, 1, attention_vec_size)
+
+                # Calculate v^T tanh(W_h h_i + W_s s_t + b_attn)
+                e = math_ops.reduce_sum(v * math_ops.tanh(encoder_features + decoder_features),
+                                        [2, 3])  # calculate e
+
+                # Calculate attention distribution
+                attn_dist = masked_attention_with_softmax(e, enc_padding_mask)
+
+                # Calculate the context vector from attn_dist and encoder_states
+                context_vector = math_ops.reduce_sum(
+                    array_ops.reshape(attn_dist, [batch_size, -1, 1, 1]) * encoder_states,
+                    [1, 2])  # shape (batch_size, attn_size).
+                context_vector = array_ops.reshape(context_vector, [-1, attn_size])
+
+            return context_vector, attn_dist, None
+
+        dec_len = tf.shape(decoder_inputs)[1]
+        inputs_ta = tf.TensorArray(tf.float32, size=dec_len).unstack(
+            tf.transpose(decoder_inputs, [1, 0, 2]))  # time-major
+        outputs_ta = tf.TensorArray(tf.float32, size=dec_len)
+        attn_dists_ta = tf.TensorArray(tf.float32, size=dec_len)
+        p_gen_inputs_ta = tf.TensorArray(tf.float32, size=dec_len)
+
+        eti_logsumexp = initial_eti_logsumexp(enc_padding_mask)
+        eti_logsumexp.set_shape([batch_size, None])
+        # the intra decoder attention history (an empty structure if not used)
+        decoder_history = intra_decoder_history(dec_len, batch_size, decoder_hidden_size) if use_decoder_history else ()
+
+        def step(i, state, eti_logsumexp, decoder_history, outputs_ta, attn_dists_ta, p_gen_inputs_ta):
+            """One decoder step; the body of the loop in attention_decoder."""
+            inp = inputs_ta.read(i)
+            inp.set_shape([batch_size, input_size])
+
+            # Run the decoder RNN cell. cell_output = decoder state
+            cell_output, state = cell(inp, state)
+
+            # Run the attention mechanism.
+            attn_dist, context_vector, intra_context_vector, eti_logsumexp, decoder_history = get_context(
+                use_intra_decoder_attention, attention, None, [state], decoder_history, i, enc_padding_mask,
+                encoder_states, eti_logsumexp, state, temporal_encoder_features)
+            attn_dists_ta = attn_dists_ta.write(i, attn_dist)
+
+            # Keep the inputs of p_gen, which is calculated for all steps at once after the loop
+            if pointer_gen:
+                p_gen_inputs_ta = p_gen_inputs_ta.write(i, tf.concat([context_vector, state.c, state.h, inp], axis=1))
+
+            # Concatenate the cell_output (= decoder state) and the context vector, and pass them through a linear layer
+            # This is V[s_t, h*_t] + b in the paper
+            with variable_scope.variable_scope("AttnOutputProjection"):
+                if use_decoder_history:
+                    output = linear([cell_output] + [context_vector] + [intra_context_vector], cell.output_size, True)
+                else:
+                    output = linear([cell_output] + [context_vector], cell.output_size, True)
+            outputs_ta = outputs_ta.write(i, output)
+
+            return i + 1, state, eti_logsumexp, decoder_history, outputs_ta, attn_dists_ta, p_gen_inputs_ta
+
+        _, state, _, _, outputs_ta, attn_dists_ta, p_gen_inputs_ta = tf.while_loop(
+            lambda i, *_: i < dec_len, step,
+            (tf.constant(0), initial_state, eti_logsumexp, decoder_history, outputs_ta, attn_dists_ta, p_gen_inputs_ta),
+            swap_memory=True)
+
+        # Back to batch-major
+        outputs = tf.transpose(outputs_ta.stack(), [1, 0, 2])
+        attn_dists = tf.transpose(attn_dists_ta.stack(), [1, 0, 2])
+        p_gens = None
+        if pointer_gen:
+            # Calculate p_gen for all steps with a single matmul, rather than one small one per step
+            p_gen_size = attn_size + 2 * decoder_hidden_size + input_size
+            p_gens = calculate_p_gens(tf.reshape(p_gen_inputs_ta.stack(), [-1, p_gen_size]))
+            p_gens = tf.transpose(tf.reshape(p_gens, [dec_len, batch_size, 1]), [1, 0, 2])
+
+        return {"outputs": outputs, "state": state, "attn_dists": attn_dists, "p_gens": p_gens, "coverage": None,
+                "eti_logsumexp": None}
+
+
+def encoder_attention_features(encoder_states):
+    """Calculate the encoder features (W_h h_i) of the pointer-generator attention. They only depend on the encoder states, so in decode mode they are computed once per batch rather than on every decoder step.
+
+    Must be called in the attention_decoder variable scope, where it creates the W_h variable.
+
+    Args:
+      encoder_states: 4D Tensor [batch_size x attn_length x 1 x attn_size].
+
+    Returns:
+      encoder_features: 4D Tensor [batch_size x attn_length x 1 x attn_size].
+    """
+    attn_size = encoder_states.get_shape()[3].value
+    attention_vec_size = attn_size  # see attention_decoder
+
+    # Get the weight matrix W_h and apply it to each encoder state to get (W_h h_i), the encoder features
+    W_h = variable_scope.get_variable("W_h", [1, 1, attn_size, attention_vec_size])
+    return nn_ops.conv2d(encoder_states, W_h, [1, 1, 1, 1],
+                         "SAME")  # shape (batch_size,attn_length,1,attention_vec_size)
 
 
-def get_context(use_intra_decoder_attention, attention, coverage, decoder_states, decoder_states_stack,
-                enc_padding_mask, encoder_states, eti, state):
+def get_context(use_intra_decoder_attention, attention, coverage, decoder_states, decoder_history, step,
+                enc_padding_mask, encoder_states, eti_logsumexp, state, temporal_encoder_features=None):
     '''
     Get context, attention and other information based on the use_intra_decoder_attention flag
     :param use_intra_decoder_attention:
@@ -232,26 +377,30 @@ def get_context(use_intra_decoder_attention, attention, coverage, decoder_states
     :param attention:
     :param coverage:
     :param decoder_states:
-    :param decoder_states_stack:
+    :param decoder_history: the intra decoder attention history (see attention_common.intra_decoder_history), or None if not used
+    :param step: the decoder step, a python int or a scalar int32 tensor
     :param enc_padding_mask:
     :param encoder_states:
-    :param eti:
+    :param eti_logsumexp: the running log-sum-exp of the intra temporal attention scores
     :param state:
-    :return:
+    :param temporal_encoder_features: Optional. The precomputed encoder side of the intra temporal attention
+    :return: attention distribution, context vector, intra decoder context vector (or None), the updated eti_logsumexp and the updated decoder_history
     '''
     if use_intra_decoder_attention == 0:
         context_vector, attn_dist, _ = attention(state, coverage)  # don't allow coverage to update
         intra_context_vector = None
     elif use_intra_decoder_attention == 1:
         context_vector, attn_dist, _ = attention(state, coverage)  # don't allow coverage to update
-        intra_context_vector = intra_decoder_context(decoder_states_stack)
+        intra_context_vector, decoder_history = intra_decoder_context(state.h, step, decoder_history)
     elif use_intra_decoder_attention == 2:
-        context_vector, attn_dist, = intra_temporal_context(decoder_states, encoder_states, eti, enc_padding_mask)
-        intra_context_vector = intra_decoder_context(decoder_states_stack)
+        context_vector, attn_dist, eti_logsumexp = intra_temporal_context(decoder_states, encoder_states, eti_logsumexp, enc_padding_mask,
+                                                                          temporal_encoder_features)
+        intra_context_vector, decoder_history = intra_decoder_context(state.h, step, decoder_history)
     elif use_intra_decoder_attention == 3:
-        context_vector, attn_dist, = intra_temporal_context(decoder_states, encoder_states, eti, enc_padding_mask)
+        context_vector, attn_dist, eti_logsumexp = intra_temporal_context(decoder_states, encoder_states, eti_logsumexp, enc_padding_mask,
+                                                                          temporal_encoder_features)
         intra_context_vector = None
-    return attn_dist, context_vector, intra_context_vector
+    return attn_dist, context_vector, intra_context_vector, eti_logsumexp, decoder_history
 
 
 def linear(args, output_size, bias, bias_start=0.0, scope=None):
@@ -30,7 +30,7 @@ import data
 class Example(object):
     """Class representing a train/val/test example for text summarization."""
 
-    def __init__(self, article, abstract_sentences, vocab, hps):
+    def __init__(self, article, abstract_sentences, vocab, hps, length_limits=None):
         """Initializes the Example, performing tokenization and truncation to produce the encoder, decoder and target sequences, which are stored in self.
 
         Args:
@@ -38,8 +38,11 @@ class Example(object):
           abstract_sentences: list of strings, one per abstract sentence. In each sentence, each token is separated by a single space.
           vocab: Vocabulary object
           hps: hyperparameters
+          length_limits: (max_enc_steps, max_dec_steps) to truncate the article and abstract to, if shorter than hps.max_enc_steps and hps.max_dec_steps (see Batcher.set_length_limits)
         """
         self.hps = hps
+        self.length_limits = length_limits or (hps.max_enc_steps, hps.max_dec_steps)
+        max_enc_steps, max_dec_steps = self.length_limits
 
         # Get ids of special tokens
         start_decoding = vocab.word2id(data.START_DECODING)
@@ -47,8 +50,8 @@ class Example(object):
 
         # Process the article
         article_words = article.split()
-        if len(article_words) > hps.max_enc_steps:
-            article_words = article_words[:hps.max_enc_steps]
+        if len(article_words) > max_enc_steps:
+            article_words = article_words[:max_enc_steps]
         self.enc_len = len(article_words)  # store the length after truncation but before padding
         self.enc_input = [vocab.word2id(w) for w in
                           article_words]  # list of word ids; OOVs are represented by the id for UNK token
@@ -60,7 +63,7 @@ class Example(object):
                    abstract_words]  # list of word ids; OOVs are represented by the id for UNK token
 
         # Get the decoder input sequence and target sequence
-        self.dec_input, self.target = self.get_dec_inp_targ_seqs(abs_ids, hps.max_dec_steps, start_decoding,
+        self.dec_input, self.target = self.get_dec_inp_targ_seqs(abs_ids, max_dec_steps, start_decoding,
                                                                  stop_decoding)
         self.dec_len = len(self.dec_input)
 
@@ -73,7 +76,7 @@ class Example(object):
             abs_ids_extend_vocab = data.abstract2ids(abstract_words, vocab, self.article_oovs)
 
             # Overwrite decoder target sequence so it uses the temp article OOV ids
-            _, self.target = self.get_dec_inp_targ_seqs(abs_ids_extend_vocab, hps.max_dec_steps, start_decoding,
+            _, self.target = self.get_dec_inp_targ_seqs(abs_ids_extend_vocab, max_dec_steps, start_decoding,
                                                         stop_decoding)
 
         # Store the original strings
@@ -132,8 +135,15 @@ class Batch(object):
            vocab: Vocabulary object
         """
         self.pad_id = vocab.word2id(data.PAD_TOKEN)  # id of the PAD token used to pad sequences
+        self.length_limits = example_list[0].length_limits  # the Batcher makes every example of a batch under the same limits
+        # The last batch of a single_pass run can be short. Pad it by repeating its last example, but remember how many examples are real.
+        self.num_examples = len(example_list)
+        if len(example_list) < hps.batch_size:
+            example_list = example_list + [example_list[-1]] * (hps.batch_size - len(example_list))
         self.init_encoder_seq(example_list, hps)  # initialize the input to the encoder
         self.init_decoder_seq(example_list, hps)  # initialize the input and targets for the decoder
+        if hps.mode == 'decode' and hps.decode_shortlist_size > 0:
+            self.init_shortlist(example_list, hps, vocab)  # initialize the output vocabulary shortlist for decoding
         self.store_orig_strings(example_list)  # store the original strings
 
     def init_encoder_seq(self, example_list, hps):
@@ -192,6 +202,8 @@ class Batch(object):
               numpy array of shape (batch_size, max_dec_steps), containing integer ids for the target sequence, padded to max_dec_steps length.
             self.dec_padding_mask:
               numpy array of shape (batch_size, max_dec_steps), containing 1s and 0s. 1s correspond to real tokens in dec_batch and target_batch; 0s correspond to padding.
+
+          If hps.dynamic_decoder, the three arrays are only padded to the length of the longest decoder sequence in the batch instead of max_dec_steps.
             """
         # Pad the inputs and targets
         for ex in example_list:
@@ -210,6 +222,37 @@ class Batch(object):
             for j in range(ex.dec_len):
                 self.dec_padding_mask[i][j] = 1
 
+        if hps.dynamic_decoder:
+            # The dynamic decoder runs as many steps as it is fed, so don't make it run any steps that are padding for the whole batch
+            max_dec_len = max([ex.dec_len for ex in example_list])
+            self.dec_batch = self.dec_batch[:, :max_dec_len]
+            self.target_batch = self.target_batch[:, :max_dec_len]
+            self.dec_padding_mask = self.dec_padding_mask[:, :max_dec_len]
+
+    def init_shortlist(self, example_list, hps, vocab):
+        """Initializes the following, for decoding with the output projection restricted to a shortlist of the vocabulary:
+            self.shortlist_ids:
+              numpy array of shape (shortlist_size) containing the extended vocabulary ids the decoder can output: the special tokens, the decode_shortlist_size most frequent words, and every in-vocabulary word of the articles in the batch, in ascending order. If hps.pointer_gen, followed by the temporary ids of the max_art_oovs article OOVs.
+
+          If hps.pointer_gen, additionally initializes the following:
+            self.enc_shortlist_pos:
+              Same as self.enc_batch_extend_vocab, but every id is replaced by its position in self.shortlist_ids.
+        """
+        vsize = vocab.size()
+        # The vocab file is sorted by frequency, so the most frequent words have the lowest ids
+        vocab_ids = set(range(min(hps.decode_shortlist_size, vsize)))
+        vocab_ids.update(vocab.word2id(w) for w in [data.PAD_TOKEN, data.UNKNOWN_TOKEN, data.START_DECODING, data.STOP_DECODING])
+        for ex in example_list:
+            vocab_ids.update(ex.enc_input)
+        shortlist = sorted(vocab_ids)
+        if hps.pointer_gen:
+            shortlist += [vsize + i for i in range(self.max_art_oovs)]
+        self.shortlist_ids = np.array(shortlist, dtype=np.int32)
+
+        if hps.pointer_gen:
+            position = {w: pos for pos, w in enumerate(shortlist)}
+            self.enc_shortlist_pos = np.vectorize(position.get, otypes=[np.int32])(self.enc_batch_extend_vocab)
+
     def store_orig_strings(self, example_list):
         """Store the original article and abstract strings in the Batch object"""
         self.original_articles = [ex.original_article for ex in example_list]  # list of lists
@@ -222,7 +265,7 @@ class Batcher(object):
 
     BATCH_QUEUE_MAX = 100  # max number of batches the batch_queue can hold
 
-    def __init__(self, data_path, vocab, hps, single_pass):
+    def __init__(self, data_path, vocab, hps, single_pass, shard_index=0, num_shards=1):
         """Initialize the batcher. Start threads that process the data into batches.
 
         Args:
@@ -230,11 +273,15 @@ class Batcher(object):
           vocab: Vocabulary object
           hps: hyperparameters
           single_pass: If True, run through the dataset exactly once (useful for when you want to run evaluation on the dev or test set). Otherwise generate random batches indefinitely (useful for training).
+          shard_index, num_shards: Only read the shard_index-th of num_shards shards of the data files (see data.example_generator). For data-parallel training.
         """
         self._data_path = data_path
+        self._shard_index = shard_index
+        self._num_shards = num_shards
         self._vocab = vocab
         self._hps = hps
         self._single_pass = single_pass
+        self._length_limits = (hps.max_enc_steps, hps.max_dec_steps)
 
         # Initialize a queue of Batches waiting to be used, and a queue of Examples waiting to be batched
         self._batch_queue = Queue.Queue(self.BATCH_QUEUE_MAX)
@@ -272,7 +319,7 @@ class Batcher(object):
     def next_batch(self):
         """Return a Batch from the batch queue.
 
-        If mode='decode' then each batch contains a single example repeated beam_size-many times; this is necessary for beam search.
+        If mode='decode' and decode_strategy='beam' then each batch contains a single example repeated beam_size-many times; this is necessary for beam search.
 
         Returns:
           batch: a Batch object, or None if we're in single_pass mode and we've exhausted the dataset.
@@ -282,17 +329,28 @@ class Batcher(object):
             tf.logging.warning(
                 'Bucket input queue is empty when calling next_batch. Bucket queue size: %i, Input queue size: %i',
                 self._batch_queue.qsize(), self._example_queue.qsize())
-            if self._single_pass and self._finished_reading:
-                tf.logging.info("Finished reading dataset in single_pass mode.")
-                return None
 
         batch = self._batch_queue.get()  # get the next Batch
+        if batch is None:  # the batch queue thread has put the end marker, because we've exhausted the dataset in single_pass mode
+            tf.logging.info("Finished reading dataset in single_pass mode.")
+            self._batch_queue.put(None)  # leave the end marker in place for any further calls
+        elif batch.length_limits != self._length_limits:  # queued before the limits changed
+            length_limits = self._length_limits
+            examples = [Example(article, abstract_sents, self._vocab, self._hps, length_limits) for
+                        article, abstract_sents in zip(batch.original_articles[:batch.num_examples],
+                                                       batch.original_abstracts_sents[:batch.num_examples])]
+            batch = Batch(examples, self._hps, self._vocab)
         return batch
 
+    def set_length_limits(self, max_enc_steps, max_dec_steps):
+        """Truncate the articles and abstracts of the batches from now on to max_enc_steps and max_dec_steps tokens, instead of hps.max_enc_steps and hps.max_dec_steps (which they must not exceed). For a length curriculum; the examples and batches already queued are remade under the new limits as they come out."""
+        self._length_limits = (max_enc_steps, max_dec_steps)
+
     def fill_example_queue(self):
         """Reads data from file and processes into Examples which are then placed into the example queue."""
 
-        input_gen = self.text_generator(data.example_generator(self._data_path, self._single_pass))
+        input_gen = self.text_generator(data.example_generator(self._data_path, self._single_pass,
+                                                                  self._shard_index, self._num_shards))
 
         while True:
             try:
@@ -310,20 +368,30 @@ class Batcher(object):
 
             abstract_sentences = [sent.strip() for sent in data.abstract2sents(
                 abstract)]  # Use the <s> and </s> tags in abstract to get a list of sentences.
-            example = Example(article, abstract_sentences, self._vocab, self._hps)  # Process into an Example.
+            example = Example(article, abstract_sentences, self._vocab, self._hps,
+                              self._length_limits)  # Process into an Example.
             self._example_queue.put(example)  # place the Example in the example queue.
 
     def fill_batch_queue(self):
         """Takes Examples out of example queue, sorts them by encoder sequence length, processes into Batches and places them in the batch queue.
 
-        In decode mode, makes batches that each contain a single example repeated.
+        In beam search decode mode, makes batches that each contain a single example repeated.
+
+        In single_pass mode, puts None in the batch queue and stops once the dataset is exhausted.
         """
         while True:
-            if self._hps.mode != 'decode':
+            if self._hps.mode != 'decode' or self._hps.decode_strategy != 'beam':
                 # Get bucketing_cache_size-many batches of Examples into a list, then sort
                 inputs = []
                 for _ in range(self._hps.batch_size * self._bucketing_cache_size):
-                    inputs.append(self._example_queue.get())
+                    ex = self.next_example()
+                    if ex is None:  # finished reading dataset in single_pass mode; the last batch may be short
+                        break
+                    inputs.append(ex)
+                if not inputs:
+                    self._batch_queue.put(None)
+                    return
+                inputs = [self.fit_length_limits(ex) for ex in inputs]
                 inputs = sorted(inputs, key=lambda inp: inp.enc_len)  # sort by length of encoder sequence
 
                 # Group the sorted Examples into batches, optionally shuffle the batches, and place in the batch queue.
@@ -336,10 +404,40 @@ class Batcher(object):
                     self._batch_queue.put(Batch(b, self._hps, self._vocab))
 
             else:  # beam search decode mode
-                ex = self._example_queue.get()
+                ex = self.next_example()
+                if ex is None:
+                    self._batch_queue.put(None)
+                    return
+                ex = self.fit_length_limits(ex)
                 b = [ex for _ in range(self._hps.batch_size)]
                 self._batch_queue.put(Batch(b, self._hps, self._vocab))
 
+    def next_example(self):
+        """Take the next Example out of the example queue.
+
+        Returns:
+          example: an Example object, or None if we're in single_pass mode and the example queue has been emptied after reading the whole dataset.
+        """
+        if not self._single_pass:
+            return self._example_queue.get()
+        while True:
+            try:
+                return self._example_queue.get(timeout=1)
+            except Queue.Empty:
+                if self._finished_reading:
+                    # The reader may have put the last example just after the get timed out, and before setting the flag
+                    try:
+                        return self._example_queue.get_nowait()
+                    except Queue.Empty:
+                        return None
+
+    def fit_length_limits(self, ex):
+        """Return the Example ex, or if it was made under other length limits than the current ones, the Example remade under them."""
+        length_limits = self._length_limits
+        if ex.length_limits == length_limits:
+            return ex
+        return Example(ex.original_article, ex.original_abstract_sents, self._vocab, self._hps, length_limits)
+
     def watch_threads(self):
         """Watch example queue and batch queue threads and restart if dead."""
         while True:
@@ -365,7 +463,10 @@ class Batcher(object):
         Args:
           example_generator: a generator of tf.Examples from file. See data.example_generator"""
         while True:
-            e = next(example_generator)  # e is a tf.Example
+            try:
+                e = next(example_generator)  # e is a tf.Example
+            except StopIteration:  # the dataset is exhausted (in single_pass mode). Since python 3.7, letting StopIteration out of a generator is a RuntimeError (PEP 479)
+                return
             try:
                 article_text = e.features.feature['article'].bytes_list.value[
                     0].decode()  # the article text was saved under the key 'article' in the data files
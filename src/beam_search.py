@@ -29,35 +29,37 @@ MINIMUM_LOG_PROB = -1e+5
 class Hypothesis(object):
     """Class to represent a hypothesis during beam search. Holds all the information needed for the hypothesis."""
 
-    def __init__(self, tokens, log_probs, state, attn_dists, p_gens, coverage):
+    def __init__(self, tokens, log_probs, state, coverage, source_row=None, eti_logsumexp=None):
         """Hypothesis constructor.
 
         Args:
           tokens: List of integers. The ids of the tokens that form the summary so far.
           log_probs: List, same length as tokens, of floats, giving the log probabilities of the tokens so far.
           state: Current state of the decoder, a LSTMStateTuple.
-          attn_dists: List, same length as tokens, of numpy arrays with shape (attn_length). These are the attention distributions so far.
-          p_gens: List, same length as tokens, of floats, or None if not using pointer-generator model. The values of the generation probability so far.
           coverage: Numpy array of shape (attn_length), or None if not using coverage. The current coverage vector.
+          source_row: Integer, or None for the initial hypothesis. The row of the decoder batch, on the beam search step that produced the latest token, that this hypothesis was extended from. Used as a backpointer into the TraceRecorder.
+          eti_logsumexp: Numpy array of shape (attn_length), or None if not using intra temporal attention. The log-sum-exp of the intra temporal attention scores so far.
         """
         self.tokens = tokens
         self.log_probs = log_probs
         self.state = state
-        self.attn_dists = attn_dists
-        self.p_gens = p_gens
         self.coverage = coverage
+        self.source_row = source_row
+        self.eti_logsumexp = eti_logsumexp
+        self.attn_dists = None  # only filled in for the returned hypothesis, and only if traces are recorded
+        self.p_gens = None
         self.tri_grams = set()
 
-    def extend(self, token, log_prob, state, attn_dist, p_gen, coverage):
+    def extend(self, token, log_prob, state, coverage, source_row, eti_logsumexp=None):
         """Return a NEW hypothesis, extended with the information from the latest step of beam search.
 
         Args:
           token: Integer. Latest token produced by beam search.
           log_prob: Float. Log prob of the latest token.
           state: Current decoder state, a LSTMStateTuple.
-          attn_dist: Attention distribution from latest step. Numpy array shape (attn_length).
-          p_gen: Generation probability on latest step. Float.
           coverage: Latest coverage vector. Numpy array shape (attn_length), or None if not using coverage.
+          source_row: Integer. The row of the decoder batch that this hypothesis occupied on the latest step.
+          eti_logsumexp: Latest intra temporal attention history. Numpy array shape (attn_length), or None if not using intra temporal attention.
         Returns:
           New Hypothesis for next step.
         """
@@ -71,9 +73,9 @@ class Hypothesis(object):
         return Hypothesis(tokens=self.tokens + [token],
                           log_probs=self.log_probs + [log_prob],
                           state=state,
-                          attn_dists=self.attn_dists + [attn_dist],
-                          p_gens=self.p_gens + [p_gen],
-                          coverage=coverage)
+                          coverage=coverage,
+                          source_row=source_row,
+                          eti_logsumexp=eti_logsumexp)
 
     @property
     def latest_token(self):
@@ -90,6 +92,47 @@ class Hypothesis(object):
         return self.log_prob / len(self.tokens)
 
 
+class TraceRecorder(object):
+    """Records the attention distributions and generation probabilities of every beam search step, for the attention visualizer.
+
+    Rather than every hypothesis carrying (and copying on every extend) its own history, each step is stored once as a float16 array with one row per hypothesis in the decoder batch, together with a backpointer per row to the row of the previous step it was extended from. The history of a single hypothesis is only materialized at the end of the search, by following the backpointers."""
+
+    def __init__(self):
+        self._attn_dists = []  # list length num_steps of float16 arrays shape (beam_size, attn_length)
+        self._p_gens = []  # list length num_steps of float16 arrays shape (beam_size), or None if not using pointer-generator model
+        self._backpointers = []  # list length num_steps of int arrays shape (beam_size)
+
+    def record(self, hyps, attn_dists, p_gens):
+        """Record one step of beam search.
+
+        Args:
+          hyps: List of the Hypothesis objects that were fed to the decoder on this step, in batch order.
+          attn_dists: Numpy array shape (beam_size, attn_length). The attention distributions for this step.
+          p_gens: Numpy array shape (beam_size, 1), or None if not using pointer-generator model.
+        """
+        self._backpointers.append(np.array([-1 if h.source_row is None else h.source_row for h in hyps]))
+        self._attn_dists.append(np.asarray(attn_dists, dtype=np.float16))
+        self._p_gens.append(None if p_gens is None else np.asarray(p_gens, dtype=np.float16).reshape(-1))
+
+    def materialize(self, hyp):
+        """Follow the backpointers of hyp and return its attention distributions and generation probabilities.
+
+        Returns:
+          attn_dists: List, one per generated token, of lists length attn_length.
+          p_gens: List, one per generated token, of floats (or None if not using pointer-generator model).
+        """
+        attn_dists = []
+        p_gens = []
+        row = hyp.source_row
+        for step in reversed(range(len(hyp.tokens) - 1)):  # the step on which each generated token was produced
+            attn_dists.append(self._attn_dists[step][row].tolist())
+            p_gens.append(None if self._p_gens[step] is None else float(self._p_gens[step][row]))
+            row = self._backpointers[step][row]
+        attn_dists.reverse()
+        p_gens.reverse()
+        return attn_dists, p_gens
+
+
 def run_beam_search(sess, model, vocab, batch):
     """Performs beam search decoding on the given example.
 
@@ -100,23 +143,25 @@ def run_beam_search(sess, model, vocab, batch):
       batch: Batch object that is the same example repeated across the batch
 
     Returns:
-      best_hyp: Hypothesis object; the best hypothesis found by beam search.
+      best_hyp: Hypothesis object; the best hypothesis found by beam search. If FLAGS.record_traces, its attn_dists and p_gens are filled in.
     """
     # Run the encoder to get the encoder hidden states and decoder initial state
     enc_states, dec_in_state = model.run_encoder(sess, batch)
     # dec_in_state is a LSTMStateTuple
-    # enc_states has shape [batch_size, <=max_enc_steps, 2*hidden_dim].
+    # enc_states holds the encoder states, shape [batch_size, <=max_enc_steps, 2*hidden_dim], and the encoder attention features.
 
     # Initialize beam_size-many hyptheses
     hyps = [Hypothesis(tokens=[vocab.word2id(data.START_DECODING)],
                        log_probs=[0.0],
                        state=dec_in_state,
-                       attn_dists=[],
-                       p_gens=[],
-                       coverage=np.zeros([batch.enc_batch.shape[1]])  # zero vector of length attention_length
+                       coverage=np.zeros([batch.enc_batch.shape[1]]),  # zero vector of length attention_length
+                       eti_logsumexp=np.full([batch.enc_batch.shape[1]], -np.inf)  # no attention scores yet
                        ) for _ in range(FLAGS.beam_size)]
     results = []  # this will contain finished hypotheses (those that have emitted the [STOP] token)
 
+    # Attention distributions and p_gens are only kept if we need them for the attention visualizer
+    trace_recorder = TraceRecorder() if FLAGS.record_traces else None
+
     steps = 0
     while steps < FLAGS.max_dec_steps and len(results) < FLAGS.beam_size:
         latest_tokens = [h.latest_token for h in hyps]  # latest token produced by each hypothesis
@@ -124,14 +169,22 @@ def run_beam_search(sess, model, vocab, batch):
                          latest_tokens]  # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
         states = [h.state for h in hyps]  # list of current decoder states of the hypotheses
         prev_coverage = [h.coverage for h in hyps]  # list of coverage vectors (or None)
+        prev_eti_logsumexp = [h.eti_logsumexp for h in hyps]  # list of intra temporal attention histories (or None)
+        parents = [0 if h.source_row is None else h.source_row for h in
+                   hyps]  # rows of the previous step's decoder batch the hypotheses continue, for stateful decoding
 
         # Run one step of the decoder to get the new info
-        (topk_ids, topk_log_probs, new_states, attn_dists, p_gens, new_coverage) = model.decode_onestep(sess=sess,
-                                                                                                        batch=batch,
-                                                                                                        latest_tokens=latest_tokens,
-                                                                                                        enc_states=enc_states,
-                                                                                                        dec_init_states=states,
-                                                                                                        prev_coverage=prev_coverage)
+        (topk_ids, topk_log_probs, new_states, attn_dists, p_gens, new_coverage,
+         new_eti_logsumexp) = model.decode_onestep(sess=sess,
+                                                   batch=batch,
+                                                   latest_tokens=latest_tokens,
+                                                   enc_states=enc_states,
+                                                   dec_init_states=states,
+                                                   prev_coverage=prev_coverage,
+                                                   parents=parents,
+                                                   prev_eti_logsumexp=prev_eti_logsumexp)
+        if trace_recorder is not None:
+            trace_recorder.record(hyps, attn_dists, p_gens)
 
         # Extend each hypothesis and collect them all in all_hyps
         all_hyps = []
@@ -139,18 +192,17 @@ def run_beam_search(sess, model, vocab, batch):
             hyps)  # On the first step, we only had one original hypothesis (the initial hypothesis). On subsequent steps, all original hypotheses are distinct.
 
         for i in range(num_orig_hyps):
-            h, new_state, attn_dist, p_gen, new_coverage_i = hyps[i], new_states[i], attn_dists[i], p_gens[i], \
-                                                             new_coverage[
-                                                                 i]  # take the ith hypothesis and new decoder state info
+            h, new_state, new_coverage_i, new_eti_logsumexp_i = hyps[i], new_states[i], new_coverage[i], \
+                new_eti_logsumexp[i]  # take the ith hypothesis and new decoder state info
 
             for j in range(FLAGS.beam_size * 2):  # for each of the top 2*beam_size hyps:
                 # Extend the ith hypothesis with the jth option
                 new_hyp = h.extend(token=topk_ids[i, j],
                                    log_prob=topk_log_probs[i, j],
                                    state=new_state,
-                                   attn_dist=attn_dist,
-                                   p_gen=p_gen,
-                                   coverage=new_coverage_i)
+                                   coverage=new_coverage_i,
+                                   source_row=i,
+                                   eti_logsumexp=new_eti_logsumexp_i)
 
                 all_hyps.append(new_hyp)
 
@@ -169,7 +221,14 @@ def run_beam_search(sess, model, vocab, batch):
 
         steps += 1
 
-    # At this point, either we've got beam_size results, or we've reached maximum decoder steps
+        # Stop once no live hypothesis can overtake the best finished one
+        if FLAGS.beam_early_stop and steps < FLAGS.max_dec_steps and len(results) < FLAGS.beam_size and \
+                can_stop_early(results, hyps, FLAGS.max_dec_steps - steps):
+            tf.logging.info('Beam search stopped early after %i steps, saving %i of max_dec_steps=%i', steps,
+                            FLAGS.max_dec_steps - steps, FLAGS.max_dec_steps)
+            break
+
+    # At this point, either we've got beam_size results, we've reached maximum decoder steps, or we've stopped early
 
     if len(
             results) == 0:  # if we don't have any complete results, add all current hypotheses (incomplete summaries) to results
@@ -177,9 +236,37 @@ def run_beam_search(sess, model, vocab, batch):
 
     # Sort hypotheses by average log probability
     hyps_sorted = sort_hyps(results)
+    best_hyp = hyps_sorted[0]
+
+    # Only the hypothesis we return gets its attention and p_gen history built
+    if trace_recorder is not None:
+        best_hyp.attn_dists, best_hyp.p_gens = trace_recorder.materialize(best_hyp)
 
     # Return the hypothesis with highest average log prob
-    return hyps_sorted[0]
+    return best_hyp
+
+
+def can_stop_early(results, hyps, steps_left):
+    """Return True if no live hypothesis can end up with a higher average log probability than the best finished one.
+
+    Every future token has log probability <= 0, so a live hypothesis can only lower its total log probability; the best it can do is to add steps_left tokens of log probability 0, which gives an upper bound of log_prob / (len(tokens) + steps_left) on its final average log probability. All future finished hypotheses descend from the current live ones, so once the best finished hypothesis beats every bound, continuing the search cannot change the returned hypothesis.
+
+    Args:
+      results: List of finished Hypothesis objects.
+      hyps: List of live Hypothesis objects.
+      steps_left: Integer. The number of beam search steps that could still be run.
+    """
+    if not results:
+        return False
+    best_finished = max(h.avg_log_prob for h in results)
+    for h in hyps:
+        if h.log_prob <= 0:
+            upper_bound = h.log_prob / (len(h.tokens) + steps_left)
+        else:  # can't happen for proper log probabilities, but keep the bound valid anyway
+            upper_bound = h.log_prob / (len(h.tokens) + 1)
+        if upper_bound >= best_finished:
+            return False
+    return True
 
 
 def sort_hyps(hyps):
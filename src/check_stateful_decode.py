@@ -0,0 +1,59 @@
+"""
+Simple script that checks that stateful decoding (--stateful_decode) produces the same tokens as the default decoding, which feeds the decoder state in and out on every step.
+It decodes the first batch of the dataset with the latest checkpoint, once each way, with the decode_strategy given. Run like this, with the model flags as for run_summarization.py:
+  python check_stateful_decode.py --data_path=../data/finished_files/chunked/val_000.bin --vocab_path=../data/finished_files/vocab --log_root=log --exp_name=baseline
+"""
+
+import os
+
+import numpy as np
+import tensorflow as tf
+
+import beam_search
+import greedy_search
+import util
+from batcher import Batcher
+from data import Vocab
+from model import SummarizationModel
+from run_summarization import make_hps
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def decode_batch(hps, vocab, batch):
+    """Decode batch with the latest checkpoint, with a model in a graph of its own. Returns the tokens of the hypotheses."""
+    with tf.Graph().as_default():
+        model = SummarizationModel(hps._replace(max_dec_steps=1), vocab)
+        model.build_graph()
+        with tf.Session(config=util.get_config()) as sess:
+            sess.run(tf.local_variables_initializer())  # the decode cache used by stateful decoding
+            util.load_ckpt(tf.train.Saver(), sess)
+            np.random.seed(111)  # sample the same way both times
+            if FLAGS.decode_strategy == 'beam':
+                hyps = [beam_search.run_beam_search(sess, model, vocab, batch)]
+            else:
+                hyps = greedy_search.run_greedy_search(sess, model, vocab, batch)
+    return [[int(t) for t in hyp.tokens] for hyp in hyps]
+
+
+def main(unused_argv):
+    tf.logging.set_verbosity(tf.logging.INFO)
+    FLAGS.log_root = os.path.join(FLAGS.log_root, FLAGS.exp_name)
+    FLAGS.mode = 'decode'
+    if FLAGS.decode_strategy == 'beam':  # as in run_summarization.py
+        FLAGS.batch_size = FLAGS.beam_size
+    hps = make_hps()
+    vocab = Vocab(FLAGS.vocab_path, FLAGS.vocab_size)
+    batch = Batcher(FLAGS.data_path, vocab, hps, single_pass=True).next_batch()
+
+    stateless = decode_batch(hps._replace(stateful_decode=False), vocab, batch)
+    stateful = decode_batch(hps._replace(stateful_decode=True), vocab, batch)
+    mismatches = [i for i in range(len(stateless)) if stateless[i] != stateful[i]]
+    if mismatches:
+        raise Exception("Stateful decoding differs on %i of %i hypotheses, e.g.\n%s\nvs\n%s" % (
+            len(mismatches), len(stateless), stateless[mismatches[0]], stateful[mismatches[0]]))
+    print("Stateful decoding produced the same tokens for all %i hypotheses" % len(stateless))
+
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -110,7 +110,7 @@ class Vocab(object):
                 writer.writerow({"word": self._id_to_word[i]})
 
 
-def example_generator(data_path, single_pass):
+def example_generator(data_path, single_pass, shard_index=0, num_shards=1):
     """Generates tf.Examples from data files.
 
       Binary data format: <length><blob>. <length> represents the byte size
@@ -122,13 +122,15 @@ def example_generator(data_path, single_pass):
         Path to tf.Example data files. Can include wildcards, e.g. if you have several training data chunk files train_001.bin, train_002.bin, etc, then pass data_path=train_* to access them all.
       single_pass:
         Boolean. If True, go through the dataset exactly once, generating examples in the order they appear, then return. Otherwise, generate random examples indefinitely.
+      shard_index, num_shards:
+        Only read every num_shards-th of the data files (in sorted order), starting from the shard_index-th. For data-parallel training, each worker reads its own shard.
 
     Yields:
       Deserialized tf.Example.
     """
     while True:
-        filelist = glob.glob(data_path)  # get the list of datafiles
-        assert filelist, ('Error: Empty filelist at %s' % data_path)  # check filelist isn't empty
+        filelist = sorted(glob.glob(data_path))[shard_index::num_shards]  # get the list of datafiles
+        assert filelist, ('Error: Empty filelist at %s (shard %i of %i)' % (data_path, shard_index, num_shards))  # check filelist isn't empty
         if single_pass:
             filelist = sorted(filelist)
         else:
@@ -27,6 +27,7 @@ import tensorflow as tf
 
 import beam_search
 import data
+import greedy_search
 import util
 
 FLAGS = tf.app.flags.FLAGS
@@ -51,6 +52,7 @@ class BeamSearchDecoder(object):
         self._vocab = vocab
         self._saver = tf.train.Saver()  # we use this to load checkpoints for decoding
         self._sess = tf.Session(config=util.get_config())
+        self._sess.run(tf.local_variables_initializer())  # the decode cache used by stateful decoding
 
         # Load an initial checkpoint to use for decoding
         ckpt_path = util.load_ckpt(self._saver, self._sess)
@@ -80,7 +82,7 @@ class BeamSearchDecoder(object):
         t0 = time.time()
         counter = 0
         while True:
-            batch = self._batcher.next_batch()  # 1 example repeated across batch
+            batch = self._batcher.next_batch()  # 1 example repeated across batch for beam search, otherwise batch_size examples
             if batch is None:  # finished decoding dataset in single_pass mode
                 assert FLAGS.single_pass, "Dataset exhausted, but we are not in single_pass mode"
                 tf.logging.info("Decoder has finished reading dataset for single_pass.")
@@ -90,39 +92,46 @@ class BeamSearchDecoder(object):
                 rouge_log(results_dict, self._decode_dir)
                 return
 
-            original_article = batch.original_articles[0]  # string
-            original_abstract = batch.original_abstracts[0]  # string
-            original_abstract_sents = batch.original_abstracts_sents[0]  # list of strings
-
-            article_withunks = data.show_art_oovs(original_article, self._vocab)  # string
-            abstract_withunks = data.show_abs_oovs(original_abstract, self._vocab,
-                                                   (batch.art_oovs[0] if FLAGS.pointer_gen else None))  # string
-
-            # Run beam search to get best Hypothesis
-            best_hyp = beam_search.run_beam_search(self._sess, self._model, self._vocab, batch)
-
-            # Extract the output ids from the hypothesis and convert back to words
-            output_ids = [int(t) for t in best_hyp.tokens[1:]]
-            decoded_words = data.outputids2words(output_ids, self._vocab,
-                                                 (batch.art_oovs[0] if FLAGS.pointer_gen else None))
-
-            # Remove the [STOP] token from decoded_words, if necessary
-            try:
-                fst_stop_idx = decoded_words.index(data.STOP_DECODING)  # index of the (first) [STOP] symbol
-                decoded_words = decoded_words[:fst_stop_idx]
-            except ValueError:
-                decoded_words = decoded_words
-            decoded_output = ' '.join(decoded_words)  # single string
-
-            if FLAGS.single_pass:
-                self.write_for_rouge(original_abstract_sents, decoded_words,
-                                     counter)  # write ref summary and decoded summary to file, to eval with pyrouge later
-                counter += 1  # this is how many examples we've decoded
+            if FLAGS.decode_strategy == 'beam':
+                # Run beam search to get best Hypothesis
+                hyps = [beam_search.run_beam_search(self._sess, self._model, self._vocab, batch)]
             else:
-                print_results(article_withunks, abstract_withunks, decoded_output)  # log output to screen
-                self.write_for_attnvis(article_withunks, abstract_withunks, decoded_words, best_hyp.attn_dists,
-                                       best_hyp.p_gens)  # write info to .json file for visualization tool
-
+                # Run greedy or sampling decoding to get one Hypothesis per example in the batch
+                hyps = greedy_search.run_greedy_search(self._sess, self._model, self._vocab, batch)
+
+            for i, best_hyp in enumerate(hyps):
+                original_article = batch.original_articles[i]  # string
+                original_abstract = batch.original_abstracts[i]  # string
+                original_abstract_sents = batch.original_abstracts_sents[i]  # list of strings
+
+                article_withunks = data.show_art_oovs(original_article, self._vocab)  # string
+                abstract_withunks = data.show_abs_oovs(original_abstract, self._vocab,
+                                                       (batch.art_oovs[i] if FLAGS.pointer_gen else None))  # string
+
+                # Extract the output ids from the hypothesis and convert back to words
+                output_ids = [int(t) for t in best_hyp.tokens[1:]]
+                decoded_words = data.outputids2words(output_ids, self._vocab,
+                                                     (batch.art_oovs[i] if FLAGS.pointer_gen else None))
+
+                # Remove the [STOP] token from decoded_words, if necessary
+                try:
+                    fst_stop_idx = decoded_words.index(data.STOP_DECODING)  # index of the (first) [STOP] symbol
+                    decoded_words = decoded_words[:fst_stop_idx]
+                except ValueError:
+                    decoded_words = decoded_words
+                decoded_output = ' '.join(decoded_words)  # single string
+
+                if FLAGS.single_pass:
+                    self.write_for_rouge(original_abstract_sents, decoded_words,
+                                         counter)  # write ref summary and decoded summary to file, to eval with pyrouge later
+                    counter += 1  # this is how many examples we've decoded
+                else:
+                    print_results(article_withunks, abstract_withunks, decoded_output)  # log output to screen
+                    if FLAGS.record_traces:
+                        self.write_for_attnvis(article_withunks, abstract_withunks, decoded_words, best_hyp.attn_dists,
+                                               best_hyp.p_gens)  # write info to .json file for visualization tool
+
+            if not FLAGS.single_pass:
                 # Check if SECS_UNTIL_NEW_CKPT has elapsed; if so return so we can load a new checkpoint
                 t1 = time.time()
                 if t1 - t0 > SECS_UNTIL_NEW_CKPT:
@@ -259,8 +268,14 @@ def get_decode_dir_name(ckpt_name):
         dataset = "test"
     else:
         raise ValueError("FLAGS.data_path %s should contain one of train, val or test" % (FLAGS.data_path))
-    dirname = "decode_%s_%imaxenc_%ibeam_%imindec_%imaxdec" % (
-    dataset, FLAGS.max_enc_steps, FLAGS.beam_size, FLAGS.min_dec_steps, FLAGS.max_dec_steps)
+    if FLAGS.decode_strategy == 'beam':
+        strategy = "%ibeam" % FLAGS.beam_size
+    elif FLAGS.decode_strategy == 'sample':
+        strategy = "sample%itopk%gtemp" % (FLAGS.sample_top_k, FLAGS.sample_temperature)
+    else:
+        strategy = FLAGS.decode_strategy
+    dirname = "decode_%s_%imaxenc_%s_%imindec_%imaxdec" % (
+    dataset, FLAGS.max_enc_steps, strategy, FLAGS.min_dec_steps, FLAGS.max_dec_steps)
     if ckpt_name is not None:
         dirname += "_%s" % ckpt_name
     return dirname
@@ -0,0 +1,134 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+# Modifications Copyright 2017 Abigail See
+# Modifications by CS224n team - Stelios Serghiou, Peter Li, Apurva Pancholi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""This file contains code to run greedy and sampling decoding, which decode a whole batch of different examples at once"""
+
+import numpy as np
+import tensorflow as tf
+
+import data
+from beam_search import Hypothesis
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def run_greedy_search(sess, model, vocab, batch):
+    """Performs greedy or top-k sampling decoding (depending on FLAGS.decode_strategy) on every example of the batch.
+
+    Each row of the batch is a different example, decoded by a single hypothesis. Like beam search, a token that would repeat a tri-gram of the hypothesis is never chosen, and [STOP] is not chosen before min_dec_steps.
+
+    Args:
+      sess: a tf.Session
+      model: a seq2seq model
+      vocab: Vocabulary object
+      batch: Batch object containing batch_size examples (the last batch of a single_pass run is padded, see Batch.num_examples)
+
+    Returns:
+      hyps: List length batch.num_examples of Hypothesis objects, one per example. If FLAGS.record_traces, their attn_dists and p_gens are filled in.
+    """
+    # Run the encoder to get the encoder hidden states and one decoder initial state per example
+    enc_states, dec_in_state = model.run_encoder(sess, batch, keep_batch=True)
+    batch_size = batch.enc_batch.shape[0]
+
+    start_id = vocab.word2id(data.START_DECODING)
+    stop_id = vocab.word2id(data.STOP_DECODING)
+    unk_id = vocab.word2id(data.UNKNOWN_TOKEN)
+
+    hyps = [Hypothesis(tokens=[start_id],
+                       log_probs=[0.0],
+                       state=tf.contrib.rnn.LSTMStateTuple(dec_in_state.c[i], dec_in_state.h[i]),
+                       coverage=np.zeros([batch.enc_batch.shape[1]]),  # zero vector of length attention_length
+                       eti_logsumexp=np.full([batch.enc_batch.shape[1]], -np.inf)  # no attention scores yet
+                       ) for i in range(batch_size)]
+    finished = [False] * batch_size
+    for i in range(batch.num_examples, batch_size):  # padding rows of a short last batch don't need decoding
+        finished[i] = True
+    if FLAGS.record_traces:
+        for h in hyps:
+            h.attn_dists, h.p_gens = [], []
+
+    steps = 0
+    while steps < FLAGS.max_dec_steps and not all(finished):
+        latest_tokens = [h.latest_token for h in hyps]  # latest token produced by each hypothesis
+        latest_tokens = [t if t < vocab.size() else unk_id for t in
+                         latest_tokens]  # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
+
+        # Run one step of the decoder to get the new info
+        (topk_ids, topk_log_probs, new_states, attn_dists, p_gens, new_coverage,
+         new_eti_logsumexp) = model.decode_onestep(sess=sess,
+                                                   batch=batch,
+                                                   latest_tokens=latest_tokens,
+                                                   enc_states=enc_states,
+                                                   dec_init_states=[h.state for h in hyps],
+                                                   prev_coverage=[h.coverage for h in hyps],
+                                                   parents=list(range(batch_size)),
+                                                   prev_eti_logsumexp=[h.eti_logsumexp for h in hyps])
+
+        for i in range(batch_size):
+            if finished[i]:
+                continue
+            h = hyps[i]
+            j = _choose_candidate(h, topk_ids[i], topk_log_probs[i], stop_id, steps >= FLAGS.min_dec_steps)
+            hyps[i] = h.extend(token=topk_ids[i, j],
+                               log_prob=topk_log_probs[i, j],
+                               state=new_states[i],
+                               coverage=new_coverage[i],
+                               source_row=i,
+                               eti_logsumexp=new_eti_logsumexp[i])
+            if FLAGS.record_traces:
+                hyps[i].attn_dists = h.attn_dists + [attn_dists[i].tolist()]
+                hyps[i].p_gens = h.p_gens + [None if p_gens is None else float(p_gens[i][0])]
+            if hyps[i].latest_token == stop_id:
+                finished[i] = True
+
+        steps += 1
+
+    return hyps[:batch.num_examples]
+
+
+def _choose_candidate(hyp, ids, log_probs, stop_id, allow_stop):
+    """Choose which of the top-k candidate tokens to extend hyp with.
+
+    Args:
+      hyp: Hypothesis being extended.
+      ids: Numpy array shape (k). The candidate token ids, in descending order of probability.
+      log_probs: Numpy array shape (k). The log probabilities of the candidates.
+      stop_id: Integer. The id of the [STOP] token.
+      allow_stop: Boolean. Whether [STOP] may be chosen.
+
+    Returns:
+      The index into ids of the chosen token.
+    """
+    allowed = [j for j in range(len(ids)) if (allow_stop or ids[j] != stop_id) and not _repeats_tri_gram(hyp, ids[j])]
+    if not allowed:  # every candidate is blocked; fall back to the most likely one
+        return 0
+    if FLAGS.decode_strategy == 'greedy':
+        return allowed[0]
+
+    # Sample among the sample_top_k most likely allowed candidates, with probabilities sharpened or flattened by the temperature
+    allowed = allowed[:FLAGS.sample_top_k]
+    scores = log_probs[allowed] / FLAGS.sample_temperature
+    probs = np.exp(scores - np.max(scores))
+    return allowed[np.random.choice(len(allowed), p=probs / np.sum(probs))]
+
+
+def _repeats_tri_gram(hyp, token):
+    """Return True if extending hyp with token would repeat one of its tri-grams."""
+    if len(hyp.tokens) < 2:
+        return False
+    tri_gram = tuple(hyp.tokens[-2:] + [token])
+    return any(tuple(hyp.tokens[k:k + 3]) == tri_gram for k in range(len(hyp.tokens) - 2))
@@ -22,8 +22,8 @@ from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import math_ops
 from tensorflow.python.ops import nn_ops
 from tensorflow.python.ops import variable_scope
-from attention_common import linear
-from attention_common import intra_decoder_context, intra_temporal_context
+from attention_common import calculate_p_gens, linear
+from attention_common import initial_eti_logsumexp, intra_decoder_context, intra_decoder_history, intra_temporal_context
 
 # Note: this function is based attention_decoder
 # In the future, it would make more sense to write variants on the attention mechanism using the new seq2seq library for tensorflow 1.0: https://www.tensorflow.org/api_guides/python/contrib.seq2seq#Attention
@@ -31,7 +31,8 @@ def intra_attention_decoder(decoder_inputs, initial_state, encoder_states,
                             enc_padding_mask, cell,
                             initial_state_attention=False, pointer_gen=True,
                             use_coverage=False, prev_coverage=None,
-                            input_attention=1, use_intra_decoder_attention=0):
+                            input_attention=1, use_intra_decoder_attention=0,
+                            temporal_encoder_features=None, prev_eti_logsumexp=None):
     """
     Args:
       decoder_inputs: A list of 2D Tensors [batch_size x input_size].
@@ -45,6 +46,10 @@ def intra_attention_decoder(decoder_inputs, initial_state, encoder_states,
       use_coverage: boolean. If True, use coverage mechanism.
       prev_coverage:
         If not None, a tensor with shape (batch_size, attn_length). The previous step's coverage vector. This is only not None in decode mode when using coverage.
+      temporal_encoder_features:
+        If not None, the output of attention_common.intra_temporal_encoder_features for encoder_states, computed outside the decoder (in decode mode, once per batch instead of on every step).
+      prev_eti_logsumexp:
+        If not None, a tensor with shape (batch_size, attn_length). The running log-sum-exp of the intra temporal attention scores of the previous steps. This is only not None in decode mode.
     Returns:
       outputs: A list of the same length as decoder_inputs of 2D Tensors of
         shape [batch_size x cell.output_size]. The output vectors.
@@ -53,6 +58,7 @@ def intra_attention_decoder(decoder_inputs, initial_state, encoder_states,
         The attention distributions for each decoder step.
       p_gens: List of scalars. The values of p_gen for each decoder step. Empty list if pointer_gen=False.
       coverage: Coverage vector on the last step computed. None if use_coverage=False.
+      eti_logsumexp: The running log-sum-exp of the intra temporal attention scores, including the last step.
     """
     tf.logging.info("input_attention is {}, ('0-Pointer-generator-attention, 1-Intra-Temporal Attention.')".format(input_attention))
     with variable_scope.variable_scope("attention_decoder") as scope:
@@ -66,12 +72,16 @@ def intra_attention_decoder(decoder_inputs, initial_state, encoder_states,
         # now is shape (batch_size, attn_len, 1, attn_size)
         encoder_states = tf.expand_dims(encoder_states, axis=2)
 
-        def hybrid_attention(decoder_states, coverage=None):
+        def hybrid_attention(decoder_states, decoder_history, step, eti_logsumexp, coverage=None):
             '''
             The hybrid attention model which concat Intra Temporal Attention and Intra-Decoder Attention to get context and distrubution
             Args:
                 decoder_states: list of decoder hidden states shape,
                     size = list([batch_size, hidden_dim])
+                decoder_history: the hidden states of the previous decoder steps, see attention_common.intra_decoder_history
+                step: the decoder step of decoder_states[-1]
+                eti_logsumexp: the running log-sum-exp of the previous intra temporal attention scores,
+                    size = [batch_size x attn_length]
                 coverage: initialized to None or a previous coverage tensor
             Returns:
                 context vector: tensor of weighed encoder hidden states,
@@ -81,32 +91,38 @@ def intra_attention_decoder(decoder_inputs, initial_state, encoder_states,
                 decoder context: tensor of weighted decoder hidden states,
                     size = [batch_size x hidden_dims]
                 coverage: as per Abi's code to prevent repetition
+                eti_logsumexp: updated with this step's intra temporal attention scores
+                decoder_history: updated with this step's hidden state
             '''
-            context_vector, attn_dist = intra_temporal_context(decoder_states, encoder_states, eti, enc_padding_mask)
+            context_vector, attn_dist, eti_logsumexp = intra_temporal_context(decoder_states, encoder_states,
+                                                                              eti_logsumexp, enc_padding_mask,
+                                                                              temporal_encoder_features)
 
             # Equation (8)
-            # decoder_states_stack: T x batch_size x decoder_hidden_size
-            # decoder_attention: batch_size x T - 1
             # Result has shape (batch_size, decoder_hidden_size)
-            decoder_context = intra_decoder_context(decoder_states_stack)
+            decoder_context, decoder_history = intra_decoder_context(decoder_states[-1][1], step, decoder_history)
 
-            return context_vector, attn_dist, decoder_context, coverage
+            return context_vector, attn_dist, decoder_context, coverage, eti_logsumexp, decoder_history
 
         # USING ATTENTION
         tf.logging.info("Using Intra Temporal + Decoder Attention Model")
 
-        # The eti in equation (1), eti is a list length of decoder_steps_length, and each eti[t] is a list of length encoder_steps_length
-        eti = []  # eti and ett does NOT share same weight
+        # log(sum(exp(eti))) over the previous decoder steps, for the eti in equation (3)
+        eti_logsumexp = prev_eti_logsumexp if prev_eti_logsumexp is not None else initial_eti_logsumexp(enc_padding_mask)
+        # the hidden states of the previous decoder steps, for the intra decoder attention; each step's is added to it once
+        decoder_hidden_size = initial_state[1].get_shape().as_list()[1]
+        decoder_history = intra_decoder_history(len(decoder_inputs), batch_size, decoder_hidden_size)
         outputs = []  # stores decoder hidden state outputs
         attn_dists = []
         p_gens = []  # probabilities for pointer generator model of Abi
+        p_gen_inputs = []
         decoder_states = []  # hidden states from each decoder step
         temporal_attention_scores = []
         input_contexts = []  # encoder weighted hidden states by attention
         decoder_contexts = []  # decoder weighted hidden states by attention
         state = initial_state  # state to be fed into the first decoder step
 
-        old_dists = []
+        # With input_attention=0, the output projection reads the context vectors of the pointer-generator attention instead
         old_contexts = []
 
         # don't need initial_state for caculation
@@ -117,11 +133,10 @@ def intra_attention_decoder(decoder_inputs, initial_state, encoder_states,
         context_vector.set_shape([None, attn_size])
 
         if initial_state_attention:  # true in decode mode
-            decoder_states_stack = tf.zeros(shape=[1, batch_size, initial_state[1].get_shape().as_list()[1]])
             # Re-calculate the context vector from the previous step so that we can pass it through a linear layer with this step's input to get a modified version of the input
-            context_vector, _, decoder_context, coverage = hybrid_attention(
-                [initial_state], coverage)
-            old_context_vector, _ = attention(encoder_states, initial_state, enc_padding_mask)
+            # (without any intra decoder history)
+            context_vector, _, decoder_context, coverage, _, _ = hybrid_attention(
+                [initial_state], intra_decoder_history(1, batch_size, decoder_hidden_size), 0, eti_logsumexp, coverage)
             # in decode mode, this is what updates the coverage vector
 
         for i, inp in enumerate(decoder_inputs):
@@ -137,24 +152,17 @@ def intra_attention_decoder(decoder_inputs, initial_state, encoder_states,
             if input_size.value is None:
                 raise ValueError(
                     "Could not infer input size from input: %s" % inp.name)
-            print("inp shape:{}".format(inp.get_shape().as_list()))
             if i==0:
-                print("initial_state[1].shape {}".format(initial_state[1].get_shape()))
-                intra_context_vector = tf.zeros(shape=[batch_size, initial_state[1].get_shape().as_list()[1]])
-                print("inp.shape {}, context_vector.shape {}, intra_context_vector.shape {}".format(inp.get_shape().as_list(), context_vector.get_shape().as_list(), intra_context_vector.get_shape()))
+                intra_context_vector = tf.zeros(shape=[batch_size, decoder_hidden_size])
                 x = linear([inp] + [context_vector] + [intra_context_vector], input_size, True)
             else:
                 x = linear([inp] + [context_vector] + [decoder_context], input_size, True)
-            print("x shape:{}".format(x.get_shape().as_list()))
 
             # Run the decoder RNN cell. cell_output = decoder state
             cell_output, state = cell(x, state)
 
             # Keep the decoder states
             decoder_states.append(state)
-            _, decoder_states_list = map(list, zip(*decoder_states))
-            decoder_states_stack = tf.stack(decoder_states_list)
-            # print(decoder_states_stack.get_shape()) #(T,batch_size, decoder_hidden_size)
 
             # Run the attention mechanism.
             if i == 0 and initial_state_attention:  # always true in decode mode
@@ -162,32 +170,32 @@ def intra_attention_decoder(decoder_inputs, initial_state, encoder_states,
                         variable_scope.get_variable_scope(), reuse=True):
                     # you need this because you've already run the initial attention(...) call
 
-                    context_vector, attn_dist, decoder_context, _ = hybrid_attention(decoder_states, coverage)
-                    old_context_vector, old_attn_dist = attention(encoder_states, state, enc_padding_mask)
+                    context_vector, attn_dist, decoder_context, _, eti_logsumexp, decoder_history = hybrid_attention(
+                        decoder_states, decoder_history, i, eti_logsumexp, coverage)
                     # don't allow coverage to update
             else:
-                context_vector, attn_dist, decoder_context, coverage = hybrid_attention(decoder_states, coverage)
-                old_context_vector, old_attn_dist = attention(encoder_states, state, enc_padding_mask)
+                context_vector, attn_dist, decoder_context, coverage, eti_logsumexp, decoder_history = hybrid_attention(
+                    decoder_states, decoder_history, i, eti_logsumexp, coverage)
+            if input_attention == 0:
+                old_context_vector, _ = attention(encoder_states, state, enc_padding_mask)
+                old_contexts.append(old_context_vector)
 
             attn_dists.append(attn_dist)
             temporal_attention_scores.append(attn_dist)
             input_contexts.append(context_vector)
             decoder_contexts.append(decoder_context)
 
-            old_dists.append(old_attn_dist)
-            old_contexts.append(old_context_vector)
-
-            # Calculate p_gen
+            # Keep the inputs of p_gen, which is calculated for all steps at once after the loop
             if pointer_gen:
-                with tf.variable_scope('calculate_pgen'):
-                    p_gen = linear(
-                        [context_vector, state.c, state.h, x], 1, True)  # a scalar
-                    p_gen = tf.sigmoid(p_gen)
-                    p_gens.append(p_gen)
+                p_gen_inputs.append(tf.concat([context_vector, state.c, state.h, x], axis=1))
 
             # Append hidden states
             outputs.append(cell_output)
 
+        # Calculate p_gen for all steps with a single matmul, rather than one small one per step
+        if pointer_gen:
+            p_gens = tf.split(calculate_p_gens(tf.concat(p_gen_inputs, axis=0)), len(decoder_inputs), axis=0)
+
         # If using coverage, reshape it
         if coverage is not None:
             coverage = array_ops.reshape(coverage, [batch_size, -1])
@@ -195,7 +203,7 @@ def intra_attention_decoder(decoder_inputs, initial_state, encoder_states,
         # Common part of return
         decoder_rets = {"outputs": outputs, "state": state,
                         "attn_dists": attn_dists, "p_gens": p_gens,
-                        "coverage": coverage}
+                        "coverage": coverage, "eti_logsumexp": eti_logsumexp}
         # Extra returns for Socher model
         decoder_rets["temporal_attention_scores"] = temporal_attention_scores
         decoder_rets["input_contexts"] = input_contexts if input_attention==1 else old_contexts
@@ -215,7 +223,6 @@ def attention(encoder_states, decoder_state, enc_padding_mask):
           attn_dist: attention distribution
           coverage: new coverage vector. shape (batch_size, attn_len, 1, 1)
         """
-        print("attention.encoder_states.get_shape() {}".format(encoder_states.get_shape().as_list()))
         batch_size = encoder_states.get_shape()[
             0].value  # if this line fails, it's because the batch size isn't defined
         attn_size = encoder_states.get_shape()[
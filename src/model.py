@@ -24,7 +24,9 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.tensorboard.plugins import projector
 
-from attention_decoder import attention_decoder
+import util
+from attention_common import initial_eti_logsumexp, intra_temporal_encoder_features
+from attention_decoder import attention_decoder, dynamic_attention_decoder, encoder_attention_features
 from intra_attention_decoder import intra_attention_decoder
 from token_generation_and_pointer import tokenization
 
@@ -37,6 +39,19 @@ class SummarizationModel(object):
     def __init__(self, hps, vocab):
         self._hps = hps
         self._vocab = vocab
+        # The dynamic decoder is for train and eval mode; decode mode runs one decoder step at a time anyway
+        self._dynamic_decoder = hps.dynamic_decoder and hps.mode != 'decode'
+        # Sampled softmax is for training only; eval and decode use the exact softmax
+        self._sampled_softmax = hps.num_sampled_softmax > 0 and hps.mode == 'train'
+        # Whether the decoder uses intra temporal attention, whose history is carried from step to step like coverage
+        self._temporal_attention = hps.attention_model == 1 or hps.use_intra_decoder_attention in [2, 3]
+        # Gradient checkpointing of the decoder is for training only; see _add_checkpointed_decoder
+        self._checkpoint_dec_steps = hps.checkpoint_dec_steps if hps.mode == 'train' else 0
+        # Profiles the training steps or decoder steps (see util.StepProfiler)
+        self._profiler = None
+        if hps.mode in ['train', 'decode']:
+            self._profiler = util.StepProfiler(os.path.join(FLAGS.log_root, 'profile'), FLAGS.profile_steps,
+                                               FLAGS.profile_signal_steps)
 
     def _add_placeholders(self):
         """Add placeholders to the graph. These are entry points for any input data."""
@@ -56,17 +71,33 @@ class SummarizationModel(object):
                 tf.int32, [], name='max_art_oovs')
 
         # decoder part
+        # with the dynamic decoder, the decoder sequences are only padded to the longest one in the batch
+        max_dec_steps = None if self._dynamic_decoder else hps.max_dec_steps
         self._dec_batch = tf.placeholder(
-            tf.int32, [hps.batch_size, hps.max_dec_steps], name='dec_batch')
+            tf.int32, [hps.batch_size, max_dec_steps], name='dec_batch')
         self._target_batch = tf.placeholder(
-            tf.int32, [hps.batch_size, hps.max_dec_steps], name='target_batch')
-        self._dec_padding_mask = tf.placeholder(tf.float32, [hps.batch_size, hps.max_dec_steps],
+            tf.int32, [hps.batch_size, max_dec_steps], name='target_batch')
+        self._dec_padding_mask = tf.placeholder(tf.float32, [hps.batch_size, max_dec_steps],
                                                 name='dec_padding_mask')
 
-        if hps.mode == "decode" and hps.coverage:
+        if hps.mode == "decode" and hps.coverage and not hps.stateful_decode:
             self.prev_coverage = tf.placeholder(
                 tf.float32, [hps.batch_size, None], name='prev_coverage')
 
+        if hps.mode == "decode" and self._temporal_attention and not hps.stateful_decode:
+            self.prev_eti_logsumexp = tf.placeholder(
+                tf.float32, [hps.batch_size, None], name='prev_eti_logsumexp')
+
+        if hps.mode == "decode" and hps.decode_shortlist_size > 0:
+            # the extended vocabulary ids the decoder can output, see Batch.init_shortlist
+            self._shortlist_ids = tf.placeholder(tf.int32, [None], name='shortlist_ids')
+            if FLAGS.pointer_gen:
+                self._enc_shortlist_pos = tf.placeholder(tf.int32, [hps.batch_size, None], name='enc_shortlist_pos')
+
+        if hps.mode == "decode" and hps.stateful_decode:
+            # for each row of the decoder batch, the row of the previous step whose decoder state, coverage and attention history it continues
+            self._parents = tf.placeholder(tf.int32, [hps.batch_size], name='parents')
+
     def _make_feed_dict(self, batch, just_enc=False):
         """Make a feed dictionary mapping parts of the batch to the appropriate placeholders.
 
@@ -81,6 +112,10 @@ class SummarizationModel(object):
         if FLAGS.pointer_gen:
             feed_dict[self._enc_batch_extend_vocab] = batch.enc_batch_extend_vocab
             feed_dict[self._max_art_oovs] = batch.max_art_oovs
+        if self._hps.mode == "decode" and self._hps.decode_shortlist_size > 0:
+            feed_dict[self._shortlist_ids] = batch.shortlist_ids
+            if FLAGS.pointer_gen:
+                feed_dict[self._enc_shortlist_pos] = batch.enc_shortlist_pos
         if not just_enc:
             feed_dict[self._dec_batch] = batch.dec_batch
             feed_dict[self._target_batch] = batch.target_batch
@@ -101,6 +136,8 @@ class SummarizationModel(object):
             Each are LSTMStateTuples of shape ([batch_size,hidden_dim],[batch_size,hidden_dim])
         """
         with tf.variable_scope('encoder'):
+            if self._hps.lstm_cell == 'block':
+                return self._add_fused_encoder(encoder_inputs, seq_len)
             cell_fw = tf.contrib.rnn.LSTMCell(self._hps.hidden_dim, initializer=self.rand_unif_init,
                                               state_is_tuple=True)
             cell_bw = tf.contrib.rnn.LSTMCell(self._hps.hidden_dim, initializer=self.rand_unif_init,
@@ -113,6 +150,32 @@ class SummarizationModel(object):
             encoder_outputs = tf.concat(axis=2, values=encoder_outputs)
         return encoder_outputs, fw_st, bw_st
 
+    def _add_fused_encoder(self, encoder_inputs, seq_len):
+        """The lstm_cell='block' version of _add_encoder, with each direction run by a single fused LSTMBlockFusedCell op instead of a while loop of LSTMCell ops.
+
+        The variables are created under the same names as bidirectional_dynamic_rnn's (bidirectional_rnn/fw/lstm_cell/kernel etc.), and LSTMBlockFusedCell uses the same weight layout and gate order as LSTMCell, so checkpoints can be restored with either cell. Must be called inside the 'encoder' variable scope.
+
+        Args and returns are as for _add_encoder.
+        """
+        hidden_dim = self._hps.hidden_dim
+        inputs = tf.transpose(encoder_inputs, [1, 0, 2])  # the fused cell is time-major
+        with tf.variable_scope('bidirectional_rnn', initializer=self.rand_unif_init):
+            with tf.variable_scope('fw'):
+                cell_fw = tf.contrib.rnn.LSTMBlockFusedCell(hidden_dim)
+                fw_outputs, fw_st = cell_fw(inputs, dtype=tf.float32, sequence_length=seq_len, scope='lstm_cell')
+            with tf.variable_scope('bw'):
+                # Run the backwards direction on the reversed sequences, like bidirectional_dynamic_rnn
+                cell_bw = tf.contrib.rnn.LSTMBlockFusedCell(hidden_dim)
+                inputs_reversed = tf.reverse_sequence(inputs, seq_len, seq_axis=0, batch_axis=1)
+                bw_outputs, bw_st = cell_bw(inputs_reversed, dtype=tf.float32, sequence_length=seq_len,
+                                            scope='lstm_cell')
+                bw_outputs = tf.reverse_sequence(bw_outputs, seq_len, seq_axis=0, batch_axis=1)
+
+        # concatenate the forwards and backwards states, and go back to batch-major
+        # (the fused cell already zeroes the outputs past each sequence length, as dynamic_rnn does)
+        encoder_outputs = tf.transpose(tf.concat(axis=2, values=[fw_outputs, bw_outputs]), [1, 0, 2])
+        return encoder_outputs, fw_st, bw_st
+
     def _reduce_states(self, fw_st, bw_st):
         """Add to the graph a linear layer to reduce the encoder's final FW and BW state into a single initial state for the decoder. This is needed because the encoder is bidirectional but the decoder is not.
 
@@ -167,11 +230,95 @@ class SummarizationModel(object):
 
         return reduced_context
 
-    def _add_decoder(self, inputs):
+    def _add_decode_cache(self, batch_tensors):
+        """For stateful decoding. Keep the encoder outputs, decoder state and coverage in local variables between session runs, so that they are not fed back and forth on every decoder step.
+
+        Adds self._cache_encoder_op, which stores the encoder side of the batch and its initial decoder state in the cache, and self._update_cache_op, which stores the new decoder state, coverage and intra temporal attention history after a decoder step (see _add_seq2seq). On each step the previous ones are gathered from the cache by self._parents, so the reordering of the beam happens in the graph.
+
+        Args:
+          batch_tensors: dict mapping names to the tensors that the decoder reads from the encoder side of the batch (e.g. the encoder states and padding mask).
+
+        Returns:
+          cached_tensors: dict with the same keys as batch_tensors, giving the cached tensors for the decoder to read instead.
+          dec_in_state: The decoder state to start the step from, a LSTMStateTuple.
+          prev_coverage: The coverage vector to start the step from, or None if not using coverage.
+          prev_eti_logsumexp: The intra temporal attention history to start the step from, or None if not using intra temporal attention.
+        """
+        hps = self._hps
+        updates = []
+
+        def cache(name, value):
+            # The attention length changes from batch to batch, so the cached shapes are not fixed. The initial value is
+            # empty rather than zeros_like(value), which would need the batch fed to the local variables initializer;
+            # _cache_encoder_op assigns every cache variable before the first decoder step.
+            var = tf.Variable(tf.zeros([0] * value.get_shape().ndims, value.dtype), name=name, trainable=False,
+                              validate_shape=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            updates.append(tf.assign(var, value, validate_shape=False))
+            cached = tf.identity(var)
+            cached.set_shape(value.get_shape())
+            return var, cached
+
+        with tf.variable_scope('decode_cache'):
+            cached_tensors = {name: cache(name, value)[1] for name, value in batch_tensors.items()}
+
+            c_var, c = cache('dec_state_c', self._dec_in_state.c)
+            h_var, h = cache('dec_state_h', self._dec_in_state.h)
+            self._cached_dec_state = tf.contrib.rnn.LSTMStateTuple(c_var, h_var)
+            dec_in_state = tf.contrib.rnn.LSTMStateTuple(tf.gather(c, self._parents), tf.gather(h, self._parents))
+
+            prev_coverage = None
+            self._cached_coverage = None
+            if hps.coverage:
+                # coverage starts at zero
+                self._cached_coverage, coverage = cache('coverage', tf.zeros_like(self._enc_padding_mask))
+                prev_coverage = tf.gather(coverage, self._parents)
+
+            prev_eti_logsumexp = None
+            self._cached_eti_logsumexp = None
+            if self._temporal_attention:
+                # no attention scores yet
+                self._cached_eti_logsumexp, eti_logsumexp = cache('eti_logsumexp',
+                                                                  initial_eti_logsumexp(self._enc_padding_mask))
+                prev_eti_logsumexp = tf.gather(eti_logsumexp, self._parents)
+
+            self._cache_encoder_op = tf.group(*updates)
+
+        return cached_tensors, dec_in_state, prev_coverage, prev_eti_logsumexp
+
+    def _add_encoder_attention_features(self, enc_states):
+        """For decoding. Add the encoder side of the attention mechanism, which only depends on the encoder states, so that it is computed once per batch by run_encoder instead of on every decoder step.
+
+        The variables are created in the same scopes as the decoder would create them, so checkpoints are unchanged. Must be called in the seq2seq variable scope.
+
+        Args:
+          enc_states: The encoder states. A tensor of shape [batch_size, <=max_enc_steps, 2*hidden_dim].
+
+        Returns:
+          enc_features: dict mapping the names of the decoder arguments (encoder_features, temporal_encoder_features) that the attention mechanism in use takes to their tensors.
+        """
+        hps = self._hps
+        enc_features = {}
+        encoder_states = tf.expand_dims(enc_states, axis=2)  # shape (batch_size, attn_len, 1, attn_size), as in the decoders
+        with tf.variable_scope('decoder'), tf.variable_scope('attention_decoder'):
+            if hps.attention_model != 1 and hps.use_intra_decoder_attention in [0, 1]:  # the pointer-generator attention
+                enc_features['encoder_features'] = encoder_attention_features(encoder_states)
+            if self._temporal_attention:
+                enc_features['temporal_encoder_features'] = intra_temporal_encoder_features(encoder_states,
+                                                                                           hps.hidden_dim)
+        return enc_features
+
+    def _add_decoder(self, inputs, enc_states, enc_padding_mask, dec_in_state, prev_coverage, enc_features=None,
+                     prev_eti_logsumexp=None):
         """Add attention decoder to the graph. In train or eval mode, you call this once to get output on ALL steps. In decode (beam search) mode, you call this once for EACH decoder step.
 
         Args:
-          inputs: inputs to the decoder (word embeddings). A list of tensors shape (batch_size, emb_dim)
+          inputs: inputs to the decoder (word embeddings). A list of tensors shape (batch_size, emb_dim), or with the dynamic decoder a tensor shape (batch_size, dec_len, emb_dim)
+          enc_states: The encoder states. A tensor of shape [batch_size, <=max_enc_steps, 2*hidden_dim].
+          enc_padding_mask: A tensor of shape [batch_size, <=max_enc_steps].
+          dec_in_state: The initial decoder state, a LSTMStateTuple.
+          prev_coverage: In decode mode with coverage, the previous step's coverage vector; otherwise None.
+          enc_features: In decode mode, the precomputed encoder side of the attention (see _add_encoder_attention_features); otherwise None.
+          prev_eti_logsumexp: In decode mode with intra temporal attention, the previous steps' attention history; otherwise None.
 
         Returns:
           outputs: List of tensors; the outputs of the decoder
@@ -179,13 +326,20 @@ class SummarizationModel(object):
           attn_dists: A list of tensors; the attention distributions
           p_gens: A list of scalar tensors; the generation probabilities
           coverage: A tensor, the current coverage vector
+          eti_logsumexp: A tensor, the current intra temporal attention history
         """
         hps = self._hps
-        cell = tf.contrib.rnn.LSTMCell(
-            hps.hidden_dim, state_is_tuple=True, initializer=self.rand_unif_init)
+        if hps.lstm_cell == 'block':
+            # Same variables as LSTMCell, computed by a single fused op per step
+            cell = _InitializerScopedCell(tf.contrib.rnn.LSTMBlockCell(hps.hidden_dim), self.rand_unif_init)
+        else:
+            cell = tf.contrib.rnn.LSTMCell(
+                hps.hidden_dim, state_is_tuple=True, initializer=self.rand_unif_init)
 
-        # In decode mode, we run attention_decoder one step at a time and so need to pass in the previous step's coverage vector each time
-        prev_coverage = self.prev_coverage if hps.mode == "decode" and hps.coverage else None
+        if self._dynamic_decoder:
+            return dynamic_attention_decoder(inputs, dec_in_state, enc_states, enc_padding_mask, cell,
+                                             pointer_gen=hps.pointer_gen, use_coverage=hps.coverage,
+                                             use_intra_decoder_attention=hps.use_intra_decoder_attention)
 
         # {0-Pointer-Attention, 1-Intra-Temporal-Attention, 2-.., 3-..}
         if hps.attention_model == 1:
@@ -193,21 +347,24 @@ class SummarizationModel(object):
         else:
             actual_attention_decoder = attention_decoder
 
-        rets = actual_attention_decoder(inputs, self._dec_in_state, self._enc_states, self._enc_padding_mask, cell,
+        rets = actual_attention_decoder(inputs, dec_in_state, enc_states, enc_padding_mask, cell,
                                         initial_state_attention=(
                                             hps.mode == "decode"),
                                         pointer_gen=hps.pointer_gen, use_coverage=hps.coverage,
                                         prev_coverage=prev_coverage, input_attention=hps.input_attention, \
-                                        use_intra_decoder_attention=hps.use_intra_decoder_attention)
+                                        use_intra_decoder_attention=hps.use_intra_decoder_attention,
+                                        prev_eti_logsumexp=prev_eti_logsumexp, **(enc_features or {}))
 
         return rets
 
-    def _calc_final_dist(self, vocab_dists, attn_dists):
+    def _calc_final_dist(self, vocab_dists, attn_dists, enc_batch_extend_vocab, max_art_oovs):
         """Calculate the final distribution, for the pointer-generator model
 
         Args:
-          vocab_dists: The vocabulary distributions. List length max_dec_steps of (batch_size, vsize) arrays. The words are in the order they appear in the vocabulary file.
+          vocab_dists: The vocabulary distributions. List length max_dec_steps of (batch_size, vsize) arrays. The words are in the order they appear in the vocabulary file (or in the decode shortlist).
           attn_dists: The attention distributions. List length max_dec_steps of (batch_size, attn_len) arrays
+          enc_batch_extend_vocab: The encoder input ids in the extended vocabulary (or their positions in the decode shortlist). Shape (batch_size, attn_len)
+          max_art_oovs: Scalar tensor; the maximum number of in-article OOVs over the batch
 
         Returns:
           final_dists: The final distributions. List length max_dec_steps of (batch_size, extended_vsize) arrays.
@@ -221,8 +378,8 @@ class SummarizationModel(object):
 
             # Concatenate some zeros to each vocabulary dist, to hold the probabilities for in-article OOV words
             # the maximum (over the batch) size of the extended vocabulary
-            extended_vsize = self._vocab.size() + self._max_art_oovs
-            extra_zeros = tf.zeros((self._hps.batch_size, self._max_art_oovs))
+            extended_vsize = tf.shape(vocab_dists[0])[1] + max_art_oovs
+            extra_zeros = tf.zeros((self._hps.batch_size, max_art_oovs))
             vocab_dists_extended = [tf.concat(axis=1, values=[dist, extra_zeros]) for dist in
                                     vocab_dists]  # list length max_dec_steps of shape (batch_size, extended_vsize)
 
@@ -233,13 +390,13 @@ class SummarizationModel(object):
             # shape (batch_size)
             batch_nums = tf.range(0, limit=self._hps.batch_size)
             batch_nums = tf.expand_dims(batch_nums, 1)  # shape (batch_size, 1)
-            attn_len = tf.shape(self._enc_batch_extend_vocab)[
+            attn_len = tf.shape(enc_batch_extend_vocab)[
                 1]  # number of states we attend over
             # shape (batch_size, attn_len)
             batch_nums = tf.tile(batch_nums, [1, attn_len])
             # shape (batch_size, enc_t, 2)
             indices = tf.stack(
-                (batch_nums, self._enc_batch_extend_vocab), axis=2)
+                (batch_nums, enc_batch_extend_vocab), axis=2)
             shape = [self._hps.batch_size, extended_vsize]
             attn_dists_projected = [tf.scatter_nd(indices, copy_dist, shape) for copy_dist in
                                     attn_dists]  # list length max_dec_steps (batch_size, extended_vsize)
@@ -287,8 +444,12 @@ class SummarizationModel(object):
                     self._add_emb_vis(embedding)  # add to tensorboard
                 emb_enc_inputs = tf.nn.embedding_lookup(embedding,
                                                         self._enc_batch)  # tensor with shape (batch_size, max_enc_steps, emb_size)
-                emb_dec_inputs = [tf.nn.embedding_lookup(embedding, x) for x in tf.unstack(self._dec_batch,
-                                                                                           axis=1)]  # list length max_dec_steps containing shape (batch_size, emb_size)
+                if self._dynamic_decoder:
+                    emb_dec_inputs = tf.nn.embedding_lookup(embedding,
+                                                            self._dec_batch)  # tensor with shape (batch_size, dec_len, emb_size)
+                else:
+                    emb_dec_inputs = [tf.nn.embedding_lookup(embedding, x) for x in tf.unstack(self._dec_batch,
+                                                                                               axis=1)]  # list length max_dec_steps containing shape (batch_size, emb_size)
 
             # Add the encoder.
             enc_outputs, fw_st, bw_st = self._add_encoder(
@@ -298,11 +459,50 @@ class SummarizationModel(object):
             # Our encoder is bidirectional and our decoder is unidirectional so we need to reduce the final encoder hidden state to the right size to be the initial decoder hidden state
             self._dec_in_state = self._reduce_states(fw_st, bw_st)
 
+            # In decode mode, the encoder side of the attention is computed once per batch, along with the encoder states
+            enc_features = self._add_encoder_attention_features(self._enc_states) if hps.mode == "decode" else {}
+            self._enc_outputs = dict(enc_states=self._enc_states, **enc_features)
+
+            # The decoder reads the encoder side of the batch from the feed, or in stateful decode mode from the decode cache
+            batch_tensors = {'enc_states': self._enc_states, 'enc_padding_mask': self._enc_padding_mask}
+            batch_tensors.update(enc_features)
+            if FLAGS.pointer_gen:
+                batch_tensors['max_art_oovs'] = self._max_art_oovs
+                # the positions in the final distribution that the attention over each encoder input goes to
+                batch_tensors['copy_ids'] = self._enc_batch_extend_vocab
+            if hps.mode == "decode" and hps.decode_shortlist_size > 0:
+                batch_tensors['shortlist_ids'] = self._shortlist_ids
+                if FLAGS.pointer_gen:
+                    batch_tensors['copy_ids'] = self._enc_shortlist_pos
+
+            if self._checkpoint_dec_steps:
+                # Add the decoder and the loss in segments, to be recomputed for backprop
+                self._add_checkpointed_decoder(emb_dec_inputs, vsize)
+                return
+
+            dec_in_state = self._dec_in_state
+            # In decode mode, we run attention_decoder one step at a time and so need to pass in the previous step's coverage vector each time
+            prev_coverage = self.prev_coverage if hps.mode == "decode" and hps.coverage and not hps.stateful_decode else None
+            # Likewise the intra temporal attention history
+            prev_eti_logsumexp = self.prev_eti_logsumexp if hps.mode == "decode" and self._temporal_attention and not hps.stateful_decode else None
+            if hps.mode == "decode" and hps.stateful_decode:
+                batch_tensors, dec_in_state, prev_coverage, prev_eti_logsumexp = self._add_decode_cache(batch_tensors)
+
+            # With a decode shortlist, the output projection is only computed for the in-vocabulary ids of the shortlist
+            vocab_ids = None
+            if 'shortlist_ids' in batch_tensors:
+                vocab_ids = batch_tensors['shortlist_ids']
+                if FLAGS.pointer_gen:  # the shortlist ends with the article OOVs
+                    vocab_ids = vocab_ids[:tf.size(vocab_ids) - batch_tensors['max_art_oovs']]
+
             # Add the decoder.
             with tf.variable_scope('decoder'):
-                decoder_rets = self._add_decoder(emb_dec_inputs)
+                decoder_rets = self._add_decoder(emb_dec_inputs, batch_tensors['enc_states'],
+                                                 batch_tensors['enc_padding_mask'], dec_in_state, prev_coverage,
+                                                 {name: batch_tensors[name] for name in enc_features}, prev_eti_logsumexp)
                 decoder_outputs, self._dec_out_state, self.attn_dists, self.p_gens, self.coverage = decoder_rets[
                     "outputs"], decoder_rets["state"], decoder_rets["attn_dists"], decoder_rets["p_gens"], decoder_rets["coverage"]
+                self.eti_logsumexp = decoder_rets["eti_logsumexp"]
 
             # for Paulus, Xiong and Socher model
             # {0-Pointer-Attention, 1-Intra-Temporal-Attention, 2-.., 3-..}
@@ -311,41 +511,61 @@ class SummarizationModel(object):
                 input_contexts = decoder_rets["input_contexts"]
                 decoder_contexts = decoder_rets["decoder_contexts"]
                 params = {"temporal_attention_scores": temporal_attention_scores, "decoder_outputs": decoder_outputs,
-                          "input_contexts": input_contexts, "decoder_contexts": decoder_contexts, "vocab_size": vsize}
+                          "input_contexts": input_contexts, "decoder_contexts": decoder_contexts, "vocab_size": vsize,
+                          "vocab_ids": vocab_ids}
 
                 self.caculate_baseline_dist = self._calc_baseline_dists_paulus
             else:
                 params = {"decoder_outputs": decoder_outputs,
-                          "hps": hps, "vsize": vsize}
+                          "hps": hps, "vsize": vsize, "vocab_ids": vocab_ids}
                 self.caculate_baseline_dist = self._calc_baseline_dist
 
             # Add the output projection to obtain the vocabulary distribution
-            vocab_dists, vocab_scores = self.caculate_baseline_dist(params)
+            # (with sampled softmax, the vocabulary distribution is never computed in full, only the probabilities of the target words)
+            stack = (lambda t: t) if self._dynamic_decoder else (lambda t: tf.stack(t, axis=1))
+            if self._sampled_softmax:
+                vocab_dists, vocab_scores = None, None
+                # Work on all steps at once. vocab_probs has shape (batch_size, dec_len)
+                vocab_probs = self._calc_sampled_vocab_probs(stack(decoder_outputs), self._target_batch)
+            else:
+                vocab_dists, vocab_scores = self.caculate_baseline_dist(params)
 
             # For pointer-generator model, calc final distribution from copy distribution and vocabulary distribution
-            if FLAGS.pointer_gen:
+            # (only needed to decode; the loss is computed from the gold token probabilities without building it)
+            if FLAGS.pointer_gen and hps.mode == "decode":
                 final_dists = self._calc_final_dist(
-                    vocab_dists, self.attn_dists)
+                    vocab_dists, self.attn_dists, batch_tensors['copy_ids'], batch_tensors['max_art_oovs'])
             else:  # final distribution is just vocabulary distribution
                 final_dists = vocab_dists
 
             if hps.mode in ['train', 'eval']:
                 # Calculate the loss
                 with tf.variable_scope('loss'):
-                    if FLAGS.pointer_gen:
+                    if self._sampled_softmax:
+                        if FLAGS.pointer_gen:
+                            gold_probs = _gold_probs(vocab_probs, stack(self.attn_dists), stack(self.p_gens),
+                                                     self._target_batch, batch_tensors['copy_ids'], vsize)
+                        else:
+                            gold_probs = vocab_probs
+                        self._loss = _mask_and_avg_stacked(-tf.log(gold_probs), self._dec_padding_mask)
+
+                    elif FLAGS.pointer_gen and self._dynamic_decoder:
+                        # The probabilities of the gold target words on all steps at once. shape (batch_size, dec_len)
+                        gold_probs = _gold_probs(_target_probs(vocab_dists, self._target_batch), self.attn_dists,
+                                                 self.p_gens, self._target_batch, batch_tensors['copy_ids'], vsize)
+                        self._loss = _mask_and_avg_stacked(-tf.log(gold_probs), self._dec_padding_mask)
+
+                    elif FLAGS.pointer_gen:
                         # Calculate the loss per step
-                        # This is fiddly; we use tf.gather_nd to pick out the probabilities of the gold target words
                         # will be list length max_dec_steps containing shape (batch_size)
                         loss_per_step = []
-                        # shape (batch_size)
-                        batch_nums = tf.range(0, limit=hps.batch_size)
-                        for dec_step, dist in enumerate(final_dists):
+                        for dec_step, (vocab_dist, attn_dist, p_gen) in enumerate(
+                                zip(vocab_dists, self.attn_dists, self.p_gens)):
                             targets = self._target_batch[:,
                                                          dec_step]  # The indices of the target words. shape (batch_size)
-                            # shape (batch_size, 2)
-                            indices = tf.stack((batch_nums, targets), axis=1)
-                            gold_probs = tf.gather_nd(dist,
-                                                      indices)  # shape (batch_size). prob of correct words on this step
+                            gold_probs = _gold_probs(_target_probs(vocab_dist, targets), attn_dist, p_gen, targets,
+                                                     batch_tensors['copy_ids'],
+                                                     vsize)  # shape (batch_size). prob of correct words on this step
                             losses = -tf.log(gold_probs)
                             loss_per_step.append(losses)
 
@@ -354,7 +574,9 @@ class SummarizationModel(object):
                             loss_per_step, self._dec_padding_mask)
 
                     else:  # baseline model
-                        self._loss = tf.contrib.seq2seq.sequence_loss(tf.stack(vocab_scores, axis=1),
+                        if not self._dynamic_decoder:
+                            vocab_scores = tf.stack(vocab_scores, axis=1)
+                        self._loss = tf.contrib.seq2seq.sequence_loss(vocab_scores,
                                                                       self._target_batch,
                                                                       self._dec_padding_mask)  # this applies softmax internally
 
@@ -363,8 +585,12 @@ class SummarizationModel(object):
                     # Calculate coverage loss from the attention distributions
                     if hps.coverage:
                         with tf.variable_scope('coverage_loss'):
-                            self._coverage_loss = _coverage_loss(
-                                self.attn_dists, self._dec_padding_mask)
+                            if self._dynamic_decoder:
+                                self._coverage_loss = _coverage_loss_stacked(
+                                    self.attn_dists, self._dec_padding_mask)
+                            else:
+                                self._coverage_loss = _coverage_loss(
+                                    self.attn_dists, self._dec_padding_mask)
                             tf.summary.scalar(
                                 'coverage_loss', self._coverage_loss)
                         self._total_loss = self._loss + hps.cov_loss_wt * self._coverage_loss
@@ -376,8 +602,22 @@ class SummarizationModel(object):
                 final_dists) == 1  # final_dists is a singleton list containing shape (batch_size, extended_vsize)
             final_dists = final_dists[0]
             topk_probs, self._topk_ids = tf.nn.top_k(final_dists,
-                                                     hps.batch_size * 2)  # take the k largest probs. note batch_size=beam_size in decode mode
+                                                     hps.batch_size * 2)  # take the k largest probs. note batch_size=beam_size in beam search decode mode
             self._topk_log_probs = tf.log(topk_probs)
+            if 'shortlist_ids' in batch_tensors:
+                # the top k are positions in the shortlist; map them back to extended vocabulary ids
+                self._topk_ids = tf.gather(batch_tensors['shortlist_ids'], self._topk_ids)
+
+            if hps.stateful_decode:
+                # Store the new decoder state, coverage and attention history in the decode cache, once the step has been computed from the old ones
+                with tf.control_dependencies([self._topk_ids, self._topk_log_probs]):
+                    updates = [tf.assign(self._cached_dec_state.c, self._dec_out_state.c, validate_shape=False),
+                               tf.assign(self._cached_dec_state.h, self._dec_out_state.h, validate_shape=False)]
+                    if hps.coverage:
+                        updates.append(tf.assign(self._cached_coverage, self.coverage, validate_shape=False))
+                    if self._temporal_attention:
+                        updates.append(tf.assign(self._cached_eti_logsumexp, self.eti_logsumexp, validate_shape=False))
+                    self._update_cache_op = tf.group(*updates)
 
     def _calc_baseline_dists_paulus(self, calc_params):
         temporal_attention_scores = calc_params['temporal_attention_scores']
@@ -385,26 +625,23 @@ class SummarizationModel(object):
         input_contexts = calc_params['input_contexts']
         decoder_contexts = calc_params['decoder_contexts']
         vocab_size = calc_params['vocab_size']
+        vocab_ids = calc_params['vocab_ids']
 
-        vocab_dists = []
-        vocab_scores = []
-
+        # Stack all decoder steps along the batch axis, so that each layer is a single large matmul rather than one per step
+        dec_steps = len(decoder_outputs)
         with tf.variable_scope('output_projection_paulus'):
-            for i, output in enumerate(decoder_outputs):
-                if i > 0:
-                    tf.get_variable_scope().reuse_variables()
+            # reduce the dimention for input_contexts
+            input_context = self._reduce_context(tf.concat(input_contexts, axis=0))
 
-                # reduce the dimention for input_contexts
-                input_context = self._reduce_context(input_contexts[i])
+            vocab_dist, vocab_score = tokenization(
+                tf.concat(temporal_attention_scores, axis=0), tf.concat(decoder_outputs, axis=0),
+                input_context, tf.concat(decoder_contexts, axis=0),
+                self._hps.max_enc_steps, vocab_size, vocab_ids=vocab_ids
+            )
 
-                vocab_dist, vocab_score = tokenization(
-                    temporal_attention_scores[i], decoder_outputs[i],
-                    input_context, decoder_contexts[i],
-                    self._hps.max_enc_steps, vocab_size
-                )
-
-                vocab_dists.append(vocab_dist)
-                vocab_scores.append(vocab_score)
+        # Back to one entry per decoder step
+        vocab_dists = tf.split(vocab_dist, dec_steps, axis=0)
+        vocab_scores = tf.split(vocab_score, dec_steps, axis=0)
 
         return vocab_dists, vocab_scores
 
@@ -414,59 +651,323 @@ class SummarizationModel(object):
         :param decoder_outputs:
         :param hps:
         :param vsize:
+        :param vocab_ids: None, or the vocabulary ids of the decode shortlist to compute the distribution over
         :return:
         '''
         decoder_outputs = calc_params["decoder_outputs"]
         hps = calc_params["hps"]
         vsize = calc_params["vsize"]
+        vocab_ids = calc_params["vocab_ids"]
         with tf.variable_scope('output_projection'):
             w = tf.get_variable(
                 'w', [hps.hidden_dim, vsize], dtype=tf.float32, initializer=self.trunc_norm_init)
             v = tf.get_variable(
                 'v', [vsize], dtype=tf.float32, initializer=self.trunc_norm_init)
-            vocab_scores = []  # vocab_scores is the vocabulary distribution before applying softmax. Each entry on the list corresponds to one decoder step
-            for i, output in enumerate(decoder_outputs):
-                if i > 0:
-                    tf.get_variable_scope().reuse_variables()
-                # apply the linear layer
-                vocab_scores.append(tf.nn.xw_plus_b(output, w, v))
-
-            vocab_dists = [tf.nn.softmax(s) for s in
-                           vocab_scores]  # The vocabulary distributions. List length max_dec_steps of (batch_size, vsize) arrays. The words are in the order they appear in the vocabulary file.
+            if vocab_ids is not None:  # only project onto the shortlist
+                w = tf.gather(w, vocab_ids, axis=1)
+                v = tf.gather(v, vocab_ids)
+            if self._dynamic_decoder:
+                # decoder_outputs has shape (batch_size, dec_len, hidden_dim); project all steps with a single matmul
+                vocab_scores = tf.reshape(tf.nn.xw_plus_b(tf.reshape(decoder_outputs, [-1, hps.hidden_dim]), w, v),
+                                          [hps.batch_size, -1, vsize])
+                return tf.nn.softmax(vocab_scores), vocab_scores
+            # Likewise stack the steps along the batch axis, and apply the linear layer and softmax to all of them at once
+            vocab_scores = tf.nn.xw_plus_b(tf.concat(decoder_outputs, axis=0), w, v)
+            vocab_dists = tf.nn.softmax(vocab_scores)
+
+        # vocab_scores is the vocabulary distribution before applying softmax. Each entry on the list corresponds to one decoder step
+        vocab_scores = tf.split(vocab_scores, len(decoder_outputs), axis=0)
+        vocab_dists = tf.split(vocab_dists, len(decoder_outputs),
+                               axis=0)  # The vocabulary distributions. List length max_dec_steps of (batch_size, vsize) arrays. The words are in the order they appear in the vocabulary file.
 
         return vocab_dists, vocab_scores
 
+    def _calc_sampled_vocab_probs(self, decoder_outputs, targets):
+        """For training with sampled softmax. Estimate the probability of each target word under the vocabulary distribution, without computing the full output projection and softmax.
+
+        The softmax is taken over the target word and hps.num_sampled_softmax words sampled from a log-uniform (Zipfian) distribution, which suits the frequency-sorted vocabulary, with the logits corrected by the log of the expected sample counts, as in tf.nn.sampled_softmax_loss. The sample is shared by the whole batch.
+
+        Args:
+          decoder_outputs: The decoder outputs. Shape (batch_size, dec_len, hidden_dim).
+          targets: The target word ids in the extended vocabulary. Shape (batch_size, dec_len). The estimate for in-article OOVs is meaningless, and masked out by _gold_probs.
+
+        Returns:
+          vocab_probs: Shape (batch_size, dec_len).
+        """
+        hps = self._hps
+        vsize = self._vocab.size()
+        with tf.variable_scope('output_projection'):
+            w = tf.get_variable(
+                'w', [hps.hidden_dim, vsize], dtype=tf.float32, initializer=self.trunc_norm_init)
+            v = tf.get_variable(
+                'v', [vsize], dtype=tf.float32, initializer=self.trunc_norm_init)
+
+        with tf.variable_scope('sampled_softmax'):
+            outputs = tf.reshape(decoder_outputs, [-1, hps.hidden_dim])
+            labels = tf.reshape(tf.where(tf.less(targets, vsize), targets, tf.zeros_like(targets)), [-1])
+            sampled, true_expected_count, sampled_expected_count = tf.nn.log_uniform_candidate_sampler(
+                true_classes=tf.expand_dims(tf.cast(labels, tf.int64), 1), num_true=1,
+                num_sampled=hps.num_sampled_softmax, unique=True, range_max=vsize)
+            sampled = tf.cast(sampled, tf.int32)
+
+            true_logits = tf.reduce_sum(outputs * tf.transpose(tf.gather(w, labels, axis=1)), 1) + tf.gather(v, labels)
+            true_logits -= tf.log(tf.squeeze(true_expected_count, 1))
+            sampled_logits = tf.nn.xw_plus_b(outputs, tf.gather(w, sampled, axis=1), tf.gather(v, sampled))
+            sampled_logits -= tf.log(sampled_expected_count)
+            # A sampled word that is the target itself must not compete with it
+            accidental_hits = tf.equal(tf.expand_dims(labels, 1), tf.expand_dims(sampled, 0))
+            sampled_logits -= 1e9 * tf.cast(accidental_hits, tf.float32)
+
+            logits = tf.concat([tf.expand_dims(true_logits, 1), sampled_logits], 1)
+            vocab_probs = tf.exp(true_logits - tf.reduce_logsumexp(logits, 1))
+            return tf.reshape(vocab_probs, tf.shape(targets))
+
+    def _add_checkpointed_decoder(self, emb_dec_inputs, vsize):
+        """For training with gradient checkpointing. Add the decoder and the loss in segments of hps.checkpoint_dec_steps decoder steps.
+
+        Only the tensors the segments start from (the decoder state, and the intra temporal attention history and coverage if used) are kept for backprop: _checkpointed_gradients builds the segments again for the backward pass. The encoder side of the attention is computed once, and read by all segments.
+
+        Sets self._loss, self._coverage_loss and self._total_loss as _add_seq2seq does, and self._dec_segments and self._dec_shared for _checkpointed_gradients.
+
+        Args:
+          emb_dec_inputs: The decoder inputs (word embeddings). A list length max_dec_steps of tensors shape (batch_size, emb_dim).
+          vsize: The vocabulary size.
+        """
+        hps = self._hps
+        self._dec_shared = dict(enc_states=self._enc_states,
+                                **self._add_encoder_attention_features(self._enc_states))
+
+        boundary = {'c': self._dec_in_state.c, 'h': self._dec_in_state.h}
+        if self._temporal_attention:
+            boundary['eti_logsumexp'] = initial_eti_logsumexp(self._enc_padding_mask)
+        if hps.coverage:
+            boundary['coverage'] = tf.zeros_like(self._enc_padding_mask)  # Initial coverage is zero.
+
+        self._dec_segments = []
+        losses, coverage_losses = [], []
+        for start in range(0, hps.max_dec_steps, self._checkpoint_dec_steps):
+            steps = range(start, min(start + self._checkpoint_dec_steps, hps.max_dec_steps))
+            inputs = emb_dec_inputs[steps[0]:steps[-1] + 1]
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True if start > 0 else None):
+                loss, coverage_loss, new_boundary = self._add_decoder_segment(steps, boundary, inputs,
+                                                                              self._dec_shared, vsize)
+            self._dec_segments.append({'steps': steps, 'boundary': boundary, 'inputs': inputs})
+            losses.append(loss)
+            coverage_losses.append(coverage_loss)
+            boundary = new_boundary
+
+        with tf.variable_scope('loss'):
+            self._loss = tf.add_n(losses)
+            tf.summary.scalar('loss', self._loss)
+            if hps.coverage:
+                with tf.variable_scope('coverage_loss'):
+                    self._coverage_loss = tf.add_n(coverage_losses)
+                    tf.summary.scalar('coverage_loss', self._coverage_loss)
+                self._total_loss = self._loss + hps.cov_loss_wt * self._coverage_loss
+                tf.summary.scalar('total_loss', self._total_loss)
+
+    def _add_decoder_segment(self, steps, boundary, inputs, shared, vsize):
+        """Add the decoder and the loss for one segment of decoder steps (see _add_checkpointed_decoder).
+
+        Args:
+          steps: range of the decoder steps of the segment.
+          boundary: dict of the tensors the segment starts from: the decoder state 'c' and 'h', and if used the intra temporal attention history 'eti_logsumexp' and the 'coverage' of the previous steps.
+          inputs: The decoder inputs of the segment. A list of tensors shape (batch_size, emb_dim).
+          shared: dict of the encoder side tensors the decoder reads: 'enc_states', and the encoder features of the attention (see _add_encoder_attention_features).
+          vsize: The vocabulary size.
+
+        Returns:
+          loss: The segment's share of the loss. The loss is the sum of the shares of the segments.
+          coverage_loss: The segment's share of the coverage loss, or None if not using coverage.
+          new_boundary: dict of the same tensors as boundary after the segment, for the next segment to start from.
+        """
+        hps = self._hps
+        dec_in_state = tf.contrib.rnn.LSTMStateTuple(boundary['c'], boundary['h'])
+        enc_features = {name: t for name, t in shared.items() if name != 'enc_states'}
+        with tf.variable_scope('decoder'):
+            decoder_rets = self._add_decoder(inputs, shared['enc_states'], self._enc_padding_mask, dec_in_state, None,
+                                             enc_features, boundary.get('eti_logsumexp'))
+        new_boundary = {'c': decoder_rets['state'].c, 'h': decoder_rets['state'].h}
+        if 'eti_logsumexp' in boundary:
+            new_boundary['eti_logsumexp'] = decoder_rets['eti_logsumexp']
+        attn_dists = tf.stack(decoder_rets['attn_dists'], axis=1)  # shape (batch_size, len(steps), attn_length)
+
+        targets = self._target_batch[:, steps[0]:steps[-1] + 1]
+        padding_mask = self._dec_padding_mask[:, steps[0]:steps[-1] + 1]
+        dec_lens = tf.reduce_sum(self._dec_padding_mask, axis=1)  # the lengths of the whole target sequences
+
+        # The loss of each step of the segment. shape (batch_size, len(steps))
+        if self._sampled_softmax:
+            gold_probs = self._calc_sampled_vocab_probs(tf.stack(decoder_rets['outputs'], axis=1), targets)
+        else:
+            vocab_dists, vocab_scores = self._calc_baseline_dist(
+                {"decoder_outputs": decoder_rets['outputs'], "hps": hps, "vsize": vsize, "vocab_ids": None})
+        if FLAGS.pointer_gen:
+            if not self._sampled_softmax:
+                gold_probs = _target_probs(tf.stack(vocab_dists, axis=1), targets)
+            gold_probs = _gold_probs(gold_probs, attn_dists, tf.stack(decoder_rets['p_gens'], axis=1), targets,
+                                     self._enc_batch_extend_vocab, vsize)
+        if FLAGS.pointer_gen or self._sampled_softmax:
+            # As _mask_and_avg_stacked, normalized by the lengths of the whole sequences
+            loss = tf.reduce_mean(tf.reduce_sum(-tf.log(gold_probs) * padding_mask, axis=1) / dec_lens)
+        else:
+            # As tf.contrib.seq2seq.sequence_loss, normalized by the number of target words in the whole batch
+            losses = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=targets,
+                                                                    logits=tf.stack(vocab_scores, axis=1))
+            loss = tf.reduce_sum(losses * padding_mask) / tf.reduce_sum(self._dec_padding_mask)
+
+        coverage_loss = None
+        if hps.coverage:
+            # As _coverage_loss_stacked, carrying on from the coverage of the previous segments
+            coverage = tf.expand_dims(boundary['coverage'], 1) + tf.cumsum(attn_dists, axis=1, exclusive=True)
+            covlosses = tf.reduce_sum(tf.minimum(attn_dists, coverage), [2])
+            coverage_loss = tf.reduce_mean(tf.reduce_sum(covlosses * padding_mask, axis=1) / dec_lens)
+            new_boundary['coverage'] = boundary['coverage'] + tf.reduce_sum(attn_dists, axis=1)
+
+        return loss, coverage_loss, new_boundary
+
+    def _checkpointed_gradients(self, tvars):
+        """For training with gradient checkpointing. Backprop the loss through the segments added by _add_checkpointed_decoder, recomputing the activations of each.
+
+        The segments are built again from the tensors they started from in the forward pass, last segment first. Each one is only computed once the gradients of the next one are (by a control dependency), so the activations of one segment at a time are alive. The gradients of the encoder side tensors and decoder inputs read by the segments are then backpropagated through the encoder and the embedding in one go.
+
+        Args:
+          tvars: The variables to take the gradients of.
+
+        Returns:
+          gradients: The gradients of the loss (with coverage, the total loss) with respect to tvars, as a list like tf.gradients returns.
+        """
+        hps = self._hps
+        aggregation_method = tf.AggregationMethod.EXPERIMENTAL_TREE
+        shared_names = sorted(self._dec_shared)
+        shared_grads = {name: None for name in shared_names}
+        input_grads = []
+        var_grads = [None for _ in tvars]  # running sums over the segments, so that each segment's gradients can be freed once added
+        boundary_grads = {}  # the gradients of the tensors the segment after the current one starts from
+
+        with tf.variable_scope('seq2seq', reuse=True):
+            shared = {name: tf.stop_gradient(t) for name, t in self._dec_shared.items()}
+            for segment in reversed(self._dec_segments):
+                # New tensors with the values of the forward pass, so that the forward pass is not backpropagated through
+                boundary = {name: tf.stop_gradient(t) for name, t in segment['boundary'].items()}
+                inputs = [tf.stop_gradient(inp) for inp in segment['inputs']]
+                with tf.control_dependencies(list(boundary_grads.values())):
+                    loss, coverage_loss, new_boundary = self._add_decoder_segment(segment['steps'], boundary, inputs,
+                                                                                  shared, vsize=self._vocab.size())
+                ys = [loss + hps.cov_loss_wt * coverage_loss if hps.coverage else loss]
+                grad_ys = [None]
+                for name, grad in boundary_grads.items():
+                    ys.append(new_boundary[name])
+                    grad_ys.append(grad)
+
+                boundary_names = sorted(boundary)
+                xs = [boundary[name] for name in boundary_names] + [shared[name] for name in shared_names] + inputs
+                grads = tf.gradients(ys, xs + tvars, grad_ys=grad_ys, aggregation_method=aggregation_method)
+                grads, var_grads_segment = grads[:len(xs)], grads[len(xs):]
+
+                boundary_grads = {name: grad for name, grad in zip(boundary_names, grads) if grad is not None}
+                for name, grad in zip(shared_names, grads[len(boundary_names):]):
+                    shared_grads[name] = _sum_gradients([shared_grads[name], grad])
+                input_grads = grads[len(boundary_names) + len(shared_names):] + input_grads
+                var_grads = [_sum_gradients([acc, grad]) for acc, grad in zip(var_grads, var_grads_segment)]
+
+        # Backprop into the encoder and the embedding, from the decoder's initial state, encoder side tensors and inputs
+        ys = [self._dec_segments[0]['boundary'][name] for name in boundary_grads]
+        grad_ys = list(boundary_grads.values())
+        for name in shared_names:
+            grad = shared_grads[name]
+            if grad is not None:
+                ys.append(self._dec_shared[name])
+                grad_ys.append(grad)
+        for segment in self._dec_segments:
+            ys += segment['inputs']
+        grad_ys += input_grads
+        ys, grad_ys = zip(*[(y, grad) for y, grad in zip(ys, grad_ys) if grad is not None])
+        grads = tf.gradients(list(ys), tvars, grad_ys=list(grad_ys), aggregation_method=aggregation_method)
+
+        return [_sum_gradients([acc, grad]) for acc, grad in zip(var_grads, grads)]
+
     def _add_train_op(self):
         """Sets self._train_op, the op to run for training."""
         # Take gradients of the trainable variables w.r.t. the loss function to minimize
         loss_to_minimize = self._total_loss if self._hps.coverage else self._loss
         tvars = tf.trainable_variables()
-        gradients = tf.gradients(
-            loss_to_minimize, tvars, aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE)
+        if self._checkpoint_dec_steps:
+            gradients = self._checkpointed_gradients(tvars)
+        else:
+            gradients = tf.gradients(
+                loss_to_minimize, tvars, aggregation_method=tf.AggregationMethod.EXPERIMENTAL_TREE)
+
+        # The gradient of the embedding matrix (and with sampled softmax, of the output projection bias) is sparse: an IndexedSlices with a row per word in the batch.
+        # Sum the rows of repeated words, so that the global norm is that of the actual gradient. clip_by_global_norm scales the IndexedSlices rows without densifying them
+        gradients = [_sum_duplicate_rows(g) if isinstance(g, tf.IndexedSlices) else g for g in gradients]
+
+        if self._hps.grad_accum_steps > 1:
+            # Clip and apply the mean gradient over the micro-batches instead
+            gradients = self._add_grad_accumulation(gradients, tvars)
 
         # Clip the gradients
-        with tf.device("/gpu:0"):
-            grads, global_norm = tf.clip_by_global_norm(
-                gradients, self._hps.max_grad_norm)
+        grads, global_norm = tf.clip_by_global_norm(
+            gradients, self._hps.max_grad_norm)
 
         # Add a summary
         tf.summary.scalar('global_norm', global_norm)
 
-        # Apply adagrad optimizer
-        #optimizer = tf.train.AdagradOptimizer(
-        #    self._hps.lr, initial_accumulator_value=self._hps.adagrad_init_acc)
-        optimizer = tf.train.AdamOptimizer(self._hps.lr)
-        with tf.device("/gpu:0"):
-            self._train_op = optimizer.apply_gradients(zip(grads, tvars), global_step=self.global_step,
-                                                       name='train_step')
+        # Apply the optimizer. Adam decays the moments of every embedding row on every step; LazyAdam and Adagrad only update the rows in the batch
+        if self._hps.optimizer == 'adagrad':
+            optimizer = tf.train.AdagradOptimizer(
+                self._hps.lr, initial_accumulator_value=self._hps.adagrad_init_acc)
+        elif self._hps.optimizer == 'lazy_adam':
+            # named like AdamOptimizer, so that checkpoints can switch between adam and lazy_adam
+            optimizer = tf.contrib.opt.LazyAdamOptimizer(self._hps.lr, name='Adam')
+        else:
+            optimizer = tf.train.AdamOptimizer(self._hps.lr)
+        self._train_op = optimizer.apply_gradients(zip(grads, tvars), global_step=self.global_step,
+                                                   name='train_step')
+        if self._hps.grad_accum_steps > 1:
+            # Start accumulating the next update from zero
+            with tf.control_dependencies([self._train_op]):
+                self._train_op = tf.group(*[tf.assign(buf, tf.zeros_like(buf)) for buf in self._accum_buffers])
+
+    def _add_grad_accumulation(self, gradients, tvars):
+        """For training with gradient accumulation. Add buffers that sum the gradients over hps.grad_accum_steps micro-batches, for a single update.
+
+        The buffers are local variables, so they are not saved in checkpoints. Sets self._accum_op, which adds the gradients of the batch to the buffers, and self._accum_buffers.
+
+        Args:
+          gradients: The gradients of the batch, a list like tf.gradients returns.
+          tvars: The variables of the gradients.
+
+        Returns:
+          The mean gradients over the micro-batches, read from the buffers once the gradients of the batch are added (so the last micro-batch of an update is added and applied in the same session run).
+        """
+        buffers, accum_ops = [], []
+        with tf.name_scope('grad_accum'):
+            for grad, var in zip(gradients, tvars):
+                if grad is None:
+                    buffers.append(None)
+                    continue
+                # on the device of the gradient, so that in distributed training each worker has its own buffers rather than sharing them on the parameter server
+                with tf.device(grad.device):
+                    buf = tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                      collections=[tf.GraphKeys.LOCAL_VARIABLES], name=var.op.name)
+                buffers.append(buf)
+                if isinstance(grad, tf.IndexedSlices):  # only add the rows of the words in the batch
+                    accum_ops.append(tf.scatter_add(buf, grad.indices, grad.values))
+                else:
+                    accum_ops.append(tf.assign_add(buf, grad))
+            self._accum_op = tf.group(*accum_ops)
+            self._accum_buffers = [buf for buf in buffers if buf is not None]
+
+            with tf.control_dependencies([self._accum_op]):
+                return [None if buf is None else buf.read_value() / self._hps.grad_accum_steps for buf in buffers]
 
     def build_graph(self):
         """Add the placeholders, model, global step, train_op and summaries to the graph"""
         tf.logging.info('Building graph...')
         t0 = time.time()
         self._add_placeholders()
-        with tf.device("/gpu:0"):
-            self._add_seq2seq()
+        self._add_seq2seq()
         self.global_step = tf.Variable(0, name='global_step', trainable=False)
         if self._hps.mode == 'train':
             self._add_train_op()
@@ -474,18 +975,38 @@ class SummarizationModel(object):
         t1 = time.time()
         tf.logging.info('Time to build graph: %i seconds', t1 - t0)
 
-    def run_train_step(self, sess, batch):
-        """Runs one training iteration. Returns a dictionary containing train op, summaries, loss, global_step and (optionally) coverage loss."""
+    def run_train_step(self, sess, batch, with_summaries=True):
+        """Runs one training iteration. Returns a dictionary containing train op, summaries (if with_summaries), loss, global_step and (optionally) coverage loss.
+
+        With gradient accumulation, this is the last micro-batch of an update: its gradients are added to the accumulated ones, which are then applied."""
         feed_dict = self._make_feed_dict(batch)
         to_return = {
             'train_op': self._train_op,
-            'summaries': self._summaries,
             'loss': self._loss,
             'global_step': self.global_step,
         }
+        if with_summaries:
+            to_return['summaries'] = self._summaries
         if self._hps.coverage:
             to_return['coverage_loss'] = self._coverage_loss
-        return sess.run(to_return, feed_dict)
+        return self._run(sess, to_return, feed_dict)
+
+    def _run(self, sess, fetches, feed_dict):
+        """Runs sess.run(fetches, feed_dict), profiling the run if asked to (see util.StepProfiler)."""
+        if self._profiler is None:
+            return sess.run(fetches, feed_dict)
+        return self._profiler.run(sess, fetches, feed_dict)
+
+    def run_accum_step(self, sess, batch):
+        """With gradient accumulation, runs one training iteration that only adds the gradients of the batch to the accumulated ones (see _add_grad_accumulation). Returns a dictionary containing loss and (optionally) coverage loss."""
+        feed_dict = self._make_feed_dict(batch)
+        to_return = {
+            'accum_op': self._accum_op,
+            'loss': self._loss,
+        }
+        if self._hps.coverage:
+            to_return['coverage_loss'] = self._coverage_loss
+        return self._run(sess, to_return, feed_dict)
 
     def run_eval_step(self, sess, batch):
         """Runs one evaluation iteration. Returns a dictionary containing summaries, loss, global_step and (optionally) coverage loss."""
@@ -499,108 +1020,157 @@ class SummarizationModel(object):
             to_return['coverage_loss'] = self._coverage_loss
         return sess.run(to_return, feed_dict)
 
-    def run_encoder(self, sess, batch):
+    def run_encoder(self, sess, batch, keep_batch=False):
         """For beam search decoding. Run the encoder on the batch and return the encoder states and decoder initial state.
 
+        Besides the encoder states, this fetches the encoder side of the attention, which decode_onestep feeds back instead of recomputing it. In stateful decode mode, all of these are stored in the decode cache along with the initial decoder state instead, and are not fetched.
+
         Args:
           sess: Tensorflow session.
           batch: Batch object that is the same example repeated across the batch (for beam search)
+          keep_batch: If True, the batch holds different examples (for greedy and sampling decoding), so return the decoder initial state of every example.
 
         Returns:
-          enc_states: The encoder states. A tensor of shape [batch_size, <=max_enc_steps, 2*hidden_dim].
-          dec_in_state: A LSTMStateTuple of shape ([1,hidden_dim],[1,hidden_dim])
+          enc_states: dict holding the encoder states (shape [batch_size, <=max_enc_steps, 2*hidden_dim]) and the encoder attention features, to pass to decode_onestep. None in stateful decode mode.
+          dec_in_state: A LSTMStateTuple of shape ([hidden_dim],[hidden_dim]), or ([batch_size,hidden_dim],[batch_size,hidden_dim]) if keep_batch
         """
         feed_dict = self._make_feed_dict(
             batch, just_enc=True)  # feed the batch into the placeholders
-        (enc_states, dec_in_state, global_step) = sess.run([self._enc_states, self._dec_in_state, self.global_step],
-                                                           feed_dict)  # run the encoder
+        if self._hps.stateful_decode:
+            (_, dec_in_state, global_step) = sess.run([self._cache_encoder_op, self._dec_in_state, self.global_step],
+                                                      feed_dict)  # run the encoder and fill the decode cache
+            enc_states = None
+        else:
+            (enc_states, dec_in_state, global_step) = sess.run([self._enc_outputs, self._dec_in_state, self.global_step],
+                                                               feed_dict)  # run the encoder
 
         # dec_in_state is LSTMStateTuple shape ([batch_size,hidden_dim],[batch_size,hidden_dim])
+        if keep_batch:
+            return enc_states, dec_in_state
         # Given that the batch is a single example repeated, dec_in_state is identical across the batch so we just take the top row.
         dec_in_state = tf.contrib.rnn.LSTMStateTuple(
             dec_in_state.c[0], dec_in_state.h[0])
         return enc_states, dec_in_state
 
-    def decode_onestep(self, sess, batch, latest_tokens, enc_states, dec_init_states, prev_coverage):
+    def decode_onestep(self, sess, batch, latest_tokens, enc_states, dec_init_states, prev_coverage, parents=None,
+                       prev_eti_logsumexp=None):
         """For beam search decoding. Run the decoder for one step.
 
         Args:
           sess: Tensorflow session.
           batch: Batch object containing single example repeated across the batch
           latest_tokens: Tokens to be fed as input into the decoder for this timestep
-          enc_states: The encoder states.
+          enc_states: The encoder states and encoder attention features returned by run_encoder.
           dec_init_states: List of beam_size LSTMStateTuples; the decoder states from the previous timestep
           prev_coverage: List of np arrays. The coverage vectors from the previous timestep. List of None if not using coverage.
+          parents: List of beam_size ints. For each hypothesis, the row of the previous step's decoder batch it continues. Only used in stateful decode mode, where it replaces enc_states, dec_init_states, prev_coverage and prev_eti_logsumexp, which are kept in the decode cache instead.
+          prev_eti_logsumexp: List of np arrays. The intra temporal attention history from the previous timestep. Only used with intra temporal attention.
 
         Returns:
           ids: top 2k ids. shape [beam_size, 2*beam_size]
           probs: top 2k log probabilities. shape [beam_size, 2*beam_size]
           new_states: new states of the decoder. a list length beam_size containing
-            LSTMStateTuples each of shape ([hidden_dim,],[hidden_dim,])
-          attn_dists: List length beam_size containing lists length attn_length.
-          p_gens: Generation probabilities for this step. A list length beam_size. List of None if in baseline mode.
-          new_coverage: Coverage vectors for this step. A list of arrays. List of None if coverage is not turned on.
+            LSTMStateTuples each of shape ([hidden_dim,],[hidden_dim,]). List of None in stateful decode mode.
+          attn_dists: Numpy array shape [beam_size, attn_length]. None unless FLAGS.record_traces.
+          p_gens: Generation probabilities for this step. Numpy array shape [beam_size, 1]. None unless FLAGS.record_traces and in pointer-generator mode.
+          new_coverage: Coverage vectors for this step. A list of arrays. List of None if coverage is not turned on or in stateful decode mode.
+          new_eti_logsumexp: Intra temporal attention history including this step. A list of arrays. List of None if intra temporal attention is not used or in stateful decode mode.
         """
 
         beam_size = len(dec_init_states)
-
-        # Turn dec_init_states (a list of LSTMStateTuples) into a single LSTMStateTuple for the batch
-        cells = [np.expand_dims(state.c, axis=0) for state in dec_init_states]
-        hiddens = [np.expand_dims(state.h, axis=0)
-                   for state in dec_init_states]
-        new_c = np.concatenate(cells, axis=0)  # shape [batch_size,hidden_dim]
-        # shape [batch_size,hidden_dim]
-        new_h = np.concatenate(hiddens, axis=0)
-        new_dec_in_state = tf.contrib.rnn.LSTMStateTuple(new_c, new_h)
-
-        feed = {
-            self._enc_states: enc_states,
-            self._enc_padding_mask: batch.enc_padding_mask,
-            self._dec_in_state: new_dec_in_state,
-            self._dec_batch: np.transpose(np.array([latest_tokens])),
-        }
+        stateful = self._hps.stateful_decode
+
+        if stateful:
+            # Everything but the latest tokens and the beam backpointers is already in the graph
+            feed = {
+                self._dec_batch: np.transpose(np.array([latest_tokens])),
+                self._parents: parents,
+            }
+        else:
+            # Turn dec_init_states (a list of LSTMStateTuples) into a single LSTMStateTuple for the batch
+            cells = [np.expand_dims(state.c, axis=0) for state in dec_init_states]
+            hiddens = [np.expand_dims(state.h, axis=0)
+                       for state in dec_init_states]
+            new_c = np.concatenate(cells, axis=0)  # shape [batch_size,hidden_dim]
+            # shape [batch_size,hidden_dim]
+            new_h = np.concatenate(hiddens, axis=0)
+            new_dec_in_state = tf.contrib.rnn.LSTMStateTuple(new_c, new_h)
+
+            feed = {
+                self._enc_padding_mask: batch.enc_padding_mask,
+                self._dec_in_state: new_dec_in_state,
+                self._dec_batch: np.transpose(np.array([latest_tokens])),
+            }
+            for name, value in enc_states.items():
+                feed[self._enc_outputs[name]] = value
 
         to_return = {
             "ids": self._topk_ids,
             "probs": self._topk_log_probs,
-            "states": self._dec_out_state,
-            "attn_dists": self.attn_dists
         }
+        if stateful:
+            to_return['update_cache'] = self._update_cache_op
+        else:
+            to_return['states'] = self._dec_out_state
+
+        # The attention distributions and p_gens are only needed for the attention visualizer
+        if FLAGS.record_traces:
+            to_return['attn_dists'] = self.attn_dists
 
         if FLAGS.pointer_gen:
-            feed[self._enc_batch_extend_vocab] = batch.enc_batch_extend_vocab
-            feed[self._max_art_oovs] = batch.max_art_oovs
-            to_return['p_gens'] = self.p_gens
+            if not stateful:
+                feed[self._enc_batch_extend_vocab] = batch.enc_batch_extend_vocab
+                feed[self._max_art_oovs] = batch.max_art_oovs
+            if FLAGS.record_traces:
+                to_return['p_gens'] = self.p_gens
+
+        if self._hps.decode_shortlist_size > 0 and not stateful:
+            feed[self._shortlist_ids] = batch.shortlist_ids
+            if FLAGS.pointer_gen:
+                feed[self._enc_shortlist_pos] = batch.enc_shortlist_pos
 
-        if self._hps.coverage:
+        if self._hps.coverage and not stateful:
             feed[self.prev_coverage] = np.stack(prev_coverage, axis=0)
             to_return['coverage'] = self.coverage
 
-        results = sess.run(to_return, feed_dict=feed)  # run the decoder step
+        if self._temporal_attention and not stateful:
+            feed[self.prev_eti_logsumexp] = np.stack(prev_eti_logsumexp, axis=0)
+            to_return['eti_logsumexp'] = self.eti_logsumexp
+
+        results = self._run(sess, to_return, feed)  # run the decoder step
 
         # Convert results['states'] (a single LSTMStateTuple) into a list of LSTMStateTuple -- one for each hypothesis
-        new_states = [tf.contrib.rnn.LSTMStateTuple(results['states'].c[i, :], results['states'].h[i, :]) for i in
-                      range(beam_size)]
+        if stateful:
+            new_states = [None for _ in range(beam_size)]
+        else:
+            new_states = [tf.contrib.rnn.LSTMStateTuple(results['states'].c[i, :], results['states'].h[i, :]) for i in
+                          range(beam_size)]
 
-        # Convert singleton list containing a tensor to a list of k arrays
-        assert len(results['attn_dists']) == 1
-        attn_dists = results['attn_dists'][0].tolist()
+        attn_dists = None
+        p_gens = None
+        if FLAGS.record_traces:
+            # Take the tensor out of the singleton list
+            assert len(results['attn_dists']) == 1
+            attn_dists = results['attn_dists'][0]
 
-        if FLAGS.pointer_gen:
-            # Convert singleton list containing a tensor to a list of k arrays
-            assert len(results['p_gens']) == 1
-            p_gens = results['p_gens'][0].tolist()
-        else:
-            p_gens = [None for _ in range(beam_size)]
+            if FLAGS.pointer_gen:
+                assert len(results['p_gens']) == 1
+                p_gens = results['p_gens'][0]
 
         # Convert the coverage tensor to a list length k containing the coverage vector for each hypothesis
-        if FLAGS.coverage:
+        if FLAGS.coverage and not stateful:
             new_coverage = results['coverage'].tolist()
             assert len(new_coverage) == beam_size
         else:
             new_coverage = [None for _ in range(beam_size)]
 
-        return results['ids'], results['probs'], new_states, attn_dists, p_gens, new_coverage
+        # Likewise for the intra temporal attention history
+        if self._temporal_attention and not stateful:
+            new_eti_logsumexp = list(results['eti_logsumexp'])
+        else:
+            new_eti_logsumexp = [None for _ in range(beam_size)]
+
+        return results['ids'], results['probs'], new_states, attn_dists, p_gens, new_coverage, new_eti_logsumexp
 
 
 def _mask_and_avg(values, padding_mask):
@@ -614,12 +1184,42 @@ def _mask_and_avg(values, padding_mask):
       a scalar
     """
 
-    dec_lens = tf.reduce_sum(padding_mask, axis=1)  # shape batch_size. float32
-    values_per_step = [v * padding_mask[:, dec_step]
-                       for dec_step, v in enumerate(values)]
-    # shape (batch_size); normalized value for each batch member
-    values_per_ex = sum(values_per_step) / dec_lens
-    return tf.reduce_mean(values_per_ex)  # overall average
+    # Mask all steps with a single op rather than one per step
+    return _mask_and_avg_stacked(tf.stack(values, axis=1), padding_mask)
+
+
+def _sum_duplicate_rows(grad):
+    """Sums the values of the repeated indices of a sparse gradient.
+
+    Args:
+      grad: An IndexedSlices, e.g. the gradient of an embedding lookup, with one row per looked up id.
+
+    Returns:
+      An IndexedSlices with one row per distinct id.
+    """
+    unique_indices, new_positions = tf.unique(grad.indices)
+    summed_values = tf.unsorted_segment_sum(grad.values, new_positions, tf.shape(unique_indices)[0])
+    return tf.IndexedSlices(summed_values, unique_indices, grad.dense_shape)
+
+
+def _sum_gradients(grads):
+    """Sums the gradients of a tensor from several parts of the graph, like tf.gradients does.
+
+    Args:
+      grads: A list of gradients (Tensors, IndexedSlices, or None where the part of the graph does not depend on the tensor).
+
+    Returns:
+      The sum of the gradients: an IndexedSlices if they all are, a Tensor otherwise, or None if there are none.
+    """
+    grads = [g for g in grads if g is not None]
+    if not grads:
+        return None
+    if len(grads) == 1:
+        return grads[0]
+    if all(isinstance(g, tf.IndexedSlices) for g in grads):
+        return tf.IndexedSlices(tf.concat([g.values for g in grads], 0), tf.concat([g.indices for g in grads], 0),
+                                grads[0].dense_shape)
+    return tf.add_n([tf.convert_to_tensor(g) for g in grads])
 
 
 def _coverage_loss(attn_dists, padding_mask):
@@ -632,14 +1232,104 @@ def _coverage_loss(attn_dists, padding_mask):
     Returns:
       coverage_loss: scalar
     """
-    coverage = tf.zeros_like(
-        attn_dists[0])  # shape (batch_size, attn_length). Initial coverage is zero.
-    # Coverage loss per decoder timestep. Will be list length max_dec_steps containing shape (batch_size).
-    covlosses = []
-    for a in attn_dists:
-        # calculate the coverage loss for this step
-        covloss = tf.reduce_sum(tf.minimum(a, coverage), [1])
-        covlosses.append(covloss)
-        coverage += a  # update the coverage vector
-    coverage_loss = _mask_and_avg(covlosses, padding_mask)
-    return coverage_loss
+    return _coverage_loss_stacked(tf.stack(attn_dists, axis=1), padding_mask)
+
+
+class _InitializerScopedCell(tf.contrib.rnn.RNNCell):
+    """Wraps a RNN cell that doesn't take an initializer (like LSTMBlockCell), so that its variables are created with the given initializer, like LSTMCell's."""
+
+    def __init__(self, cell, initializer):
+        super(_InitializerScopedCell, self).__init__()
+        self._cell = cell
+        self._initializer = initializer
+
+    @property
+    def state_size(self):
+        return self._cell.state_size
+
+    @property
+    def output_size(self):
+        return self._cell.output_size
+
+    def __call__(self, inputs, state, scope=None):
+        with tf.variable_scope(tf.get_variable_scope(), initializer=self._initializer):
+            return self._cell(inputs, state, scope=scope)
+
+
+def _target_probs(vocab_dists, targets):
+    """Picks out the probabilities of the target words from the vocabulary distributions.
+
+    Args:
+      vocab_dists: The vocabulary distributions. Shape (batch_size, vsize) for one decoder step, or (batch_size, dec_len, vsize) for all of them.
+      targets: The target word ids in the extended vocabulary. Shape (batch_size), or (batch_size, dec_len). The probability returned for in-article OOVs is meaningless.
+
+    Returns:
+      vocab_probs: Same shape as targets.
+    """
+    vsize = tf.shape(vocab_dists)[-1]
+    ids = tf.where(tf.less(targets, vsize), targets, tf.zeros_like(targets))
+    flat_ids = tf.range(tf.size(targets)) * vsize + tf.reshape(ids, [-1])
+    return tf.reshape(tf.gather(tf.reshape(vocab_dists, [-1]), flat_ids), tf.shape(targets))
+
+
+def _gold_probs(vocab_probs, attn_dists, p_gens, targets, enc_batch_extend_vocab, vsize):
+    """Calculates the probabilities of the target words under the pointer-generator final distribution, without building the final distribution.
+
+    The final distribution (see SummarizationModel._calc_final_dist) gives the target word w the probability p_gen * P_vocab(w) + (1 - p_gen) * (sum of the attention on the encoder positions holding w). This computes that sum directly, so no (batch_size, extended_vsize) tensor is built per decoder step.
+
+    Args:
+      vocab_probs: The probabilities of the target words under the vocabulary distribution (see _target_probs). Shape (batch_size) for one decoder step, or (batch_size, dec_len) for all of them.
+      attn_dists: The attention distributions. Shape (batch_size, attn_len), or (batch_size, dec_len, attn_len).
+      p_gens: The generation probabilities. Shape (batch_size, 1), or (batch_size, dec_len, 1).
+      targets: The target word ids in the extended vocabulary. Shape (batch_size), or (batch_size, dec_len).
+      enc_batch_extend_vocab: The encoder input ids in the extended vocabulary. Shape (batch_size, attn_len).
+      vsize: The vocabulary size; target ids from vsize up are in-article OOVs.
+
+    Returns:
+      gold_probs: Same shape as targets.
+    """
+    p_gens = tf.squeeze(p_gens, -1)
+
+    # In-article OOVs have zero probability in the vocabulary distribution
+    vocab_probs *= tf.cast(tf.less(targets, vsize), tf.float32)
+
+    # Attention on the encoder positions that hold the target word
+    if attn_dists.get_shape().ndims == 3:
+        enc_batch_extend_vocab = tf.expand_dims(enc_batch_extend_vocab, 1)  # shape (batch_size, 1, attn_len)
+    is_target = tf.cast(tf.equal(enc_batch_extend_vocab, tf.expand_dims(targets, -1)), tf.float32)
+    copy_probs = tf.reduce_sum(attn_dists * is_target, -1)
+
+    return p_gens * vocab_probs + (1 - p_gens) * copy_probs
+
+
+def _mask_and_avg_stacked(values, padding_mask):
+    """Like _mask_and_avg, for values stacked over the decoder steps.
+
+    Args:
+      values: tensor shape (batch_size, dec_len).
+      padding_mask: tensor shape (batch_size, dec_len) containing 1s and 0s.
+
+    Returns:
+      a scalar
+    """
+    dec_lens = tf.reduce_sum(padding_mask, axis=1)  # shape batch_size. float32
+    # shape (batch_size); normalized value for each batch member
+    values_per_ex = tf.reduce_sum(values * padding_mask, axis=1) / dec_lens
+    return tf.reduce_mean(values_per_ex)  # overall average
+
+
+def _coverage_loss_stacked(attn_dists, padding_mask):
+    """Like _coverage_loss, for attention distributions stacked over the decoder steps.
+
+    Args:
+      attn_dists: The attention distributions. Shape (batch_size, dec_len, attn_length).
+      padding_mask: shape (batch_size, dec_len).
+
+    Returns:
+      coverage_loss: scalar
+    """
+    # The coverage vector of each step is the sum of the attention distributions of the previous steps (zero on the first).
+    # shape (batch_size, dec_len, attn_length)
+    coverage = tf.cumsum(attn_dists, axis=1, exclusive=True)
+    covlosses = tf.reduce_sum(tf.minimum(attn_dists, coverage), [2])  # coverage loss per step. shape (batch_size, dec_len)
+    return _mask_and_avg_stacked(covlosses, padding_mask)
@@ -17,6 +17,7 @@
 """This is the top-level file to train, evaluate or test your summarization model"""
 
 import os
+import subprocess
 import sys
 import time
 from collections import namedtuple
@@ -42,6 +43,8 @@ tf.app.flags.DEFINE_string('vocab_path', '', 'Path expression to text vocabulary
 tf.app.flags.DEFINE_string('mode', 'train', 'must be one of train/eval/decode')
 tf.app.flags.DEFINE_boolean('single_pass', False,
                             'For decode mode only. If True, run eval on the full dataset using a fixed checkpoint, i.e. take the current checkpoint, and use it to produce one summary for each example in the dataset, write the summaries to file and then get ROUGE scores for the whole dataset. If False (default), run concurrent decoding, i.e. repeatedly load latest checkpoint, use it to produce summaries for randomly-chosen examples and log the results to screen, indefinitely.')
+tf.app.flags.DEFINE_integer('eval_num_batches', 0,
+                            'For eval mode only. If positive, read this many batches from the start of the dataset once and keep them in memory, score them all on each new checkpoint, and save the best model by their exact mean loss. If 0 (default), score one random batch each time the latest checkpoint is loaded, and save the best model by a running average loss.')
 
 # Where to save output
 tf.app.flags.DEFINE_string('log_root', '', 'Root directory for all logging.')
@@ -64,6 +67,10 @@ tf.app.flags.DEFINE_float('adagrad_init_acc', 0.1, 'initial accumulator value fo
 tf.app.flags.DEFINE_float('rand_unif_init_mag', 0.02, 'magnitude for lstm cells random uniform inititalization')
 tf.app.flags.DEFINE_float('trunc_norm_init_std', 1e-4, 'std of trunc norm init, used for initializing everything else')
 tf.app.flags.DEFINE_float('max_grad_norm', 2.0, 'for gradient clipping')
+tf.app.flags.DEFINE_integer('grad_accum_steps', 1,
+                            'Number of batches to accumulate the gradients over, before clipping and applying them as one update. The effective batch size is batch_size*grad_accum_steps; global_step counts the updates. The accumulated gradients are dense, so this cannot be combined with optimizer=lazy_adam.')
+tf.app.flags.DEFINE_string('optimizer', 'adam',
+                           'adam, lazy_adam or adagrad. lazy_adam and adagrad only update the embedding rows of the words in the batch, rather than the whole matrix. adam and lazy_adam checkpoints are interchangeable. lazy_adam needs grad_accum_steps=1')
 
 # Pointer-generator or baseline model
 tf.app.flags.DEFINE_boolean('pointer_gen', True, 'If True, use pointer-generator model. If False, use baseline model.')
@@ -89,9 +96,68 @@ tf.app.flags.DEFINE_boolean('convert_to_coverage_model', False,
 tf.app.flags.DEFINE_boolean('restore_best_model', False,
                             'Restore the best model in the eval/ dir and save it in the train/ dir, ready to be used for further training. Useful for early stopping, or if your training checkpoint has become corrupted with e.g. NaN values.')
 
+# Graph construction
+tf.app.flags.DEFINE_string('lstm_cell', 'lstm',
+                           'Must be one of lstm/block. lstm uses LSTMCell in the encoder and decoder. block uses the fused LSTMBlockFusedCell for the encoder and LSTMBlockCell for the decoder, which run far fewer ops on CPU. Both use the same variables, so a checkpoint trained with one can be restored with the other.')
+tf.app.flags.DEFINE_boolean('dynamic_decoder', False,
+                            'For train and eval mode. If True, run the decoder in a tf.while_loop for as many steps as the longest target sequence in each batch, instead of unrolling max_dec_steps decoder steps in the graph. Same variables and values, a much smaller graph, and less work on batches of short summaries. Only supported with attention_model=0.')
+
+tf.app.flags.DEFINE_integer('num_sampled_softmax', 0,
+                            'For train mode only. If positive, train with a sampled softmax over this many words drawn from a log-uniform distribution instead of the full softmax over the vocabulary; eval and decode always use the full softmax. 0 means off. Only supported with attention_model=0.')
+tf.app.flags.DEFINE_integer('checkpoint_dec_steps', 0,
+                            'For train mode only. If positive, only keep the decoder state every this many decoder steps for backprop, and recompute the activations in between during the backward pass, one segment at a time. Trades about one more forward pass of the decoder for the memory of all but one segment. 0 means off. Only supported with the unrolled decoder, attention_model=0 and use_intra_decoder_attention=0 or 3.')
+
+# Decoding
+tf.app.flags.DEFINE_string('decode_strategy', 'beam',
+                           'For decode mode only. Must be one of beam/greedy/sample. beam decodes one example at a time with beam search of width beam_size. greedy and sample decode batch_size different examples at once with a single hypothesis each, taking the most likely token (greedy) or sampling among the sample_top_k most likely tokens (sample) on every step.')
+tf.app.flags.DEFINE_integer('sample_top_k', 10,
+                            'For decode_strategy=sample only. Sample among this many most likely tokens. Must be at most 2*batch_size, the number of candidates the decode graph returns.')
+tf.app.flags.DEFINE_float('sample_temperature', 1.0,
+                          'For decode_strategy=sample only. Temperature applied to the log probabilities before sampling; below 1 is closer to greedy, above 1 is more random.')
+tf.app.flags.DEFINE_boolean('stateful_decode', False,
+                            'For decode mode only. If True, keep the encoder states, decoder state and coverage in the graph between decoder steps, and only feed the latest tokens and the beam backpointers on each step, instead of copying them in and out of the session on every step.')
+tf.app.flags.DEFINE_integer('decode_shortlist_size', 0,
+                            'For decode mode only. If positive, compute the output projection and softmax only over a per-batch shortlist of the vocabulary: the special tokens, this many most frequent words, and the words of the articles in the batch. 0 means use the whole vocabulary. Must be at least 2*batch_size.')
+tf.app.flags.DEFINE_boolean('record_traces', False,
+                            'For decode mode only. If True, record the attention distributions and generation probabilities of the beam search and write them to attn_vis_data.json for the attention visualizer (concurrent decoding only). Off by default because keeping these histories is most of the memory and copying time of beam search.')
+tf.app.flags.DEFINE_boolean('beam_early_stop', True,
+                            'For decode mode only. If True, stop beam search as soon as the best finished hypothesis has a higher average log probability than any live hypothesis could still reach. This never changes the decoded output, it only skips steps that cannot matter.')
+
+tf.app.flags.DEFINE_integer('summary_every_n_steps', 1,
+                            'For train mode only. Fetch and write the summaries (including the throughput over the steps since the last ones) every this many training steps.')
+tf.app.flags.DEFINE_boolean('async_checkpoint', False,
+                            'For train mode only. If True, only copy the variables to host memory every 60 secs between training steps, and write the checkpoint in a background thread, instead of stalling training while the Supervisor writes it.')
+tf.app.flags.DEFINE_integer('max_train_steps', 0,
+                            'For train mode only. If positive, save a checkpoint and stop once global_step reaches this many steps. If 0 (default), train until interrupted.')
+tf.app.flags.DEFINE_string('length_curriculum', '',
+                           'For train mode only. If ENC:DEC,ENC:DEC,..., e.g. 100:25,200:50, train on articles and abstracts truncated to these max_enc_steps:max_dec_steps limits first, one stage after the other, then to the full max_enc_steps and max_dec_steps. Early steps are much cheaper. The decoder only gets cheaper with dynamic_decoder; the unrolled decoder always runs max_dec_steps steps. Needs curriculum_stage_steps and/or curriculum_patience.')
+tf.app.flags.DEFINE_integer('curriculum_stage_steps', 0,
+                            'For the length_curriculum. If positive, move to the next stage every this many global steps.')
+tf.app.flags.DEFINE_integer('curriculum_patience', 0,
+                            'For the length_curriculum. If positive, move to the next stage once the running average training loss has not improved for this many steps. Not supported in distributed training.')
+tf.app.flags.DEFINE_integer('intra_op_threads', 0,
+                            'Number of threads each op (e.g. a matmul) may use. 0 (default) lets tensorflow use one per core. Set it when several processes share the machine, e.g. to the number of cores each one is pinned to.')
+tf.app.flags.DEFINE_integer('inter_op_threads', 0,
+                            'Number of ops that may run at the same time. 0 (default) lets tensorflow use one per core.')
+
+# Distributed training. Between-graph data parallelism: each worker process trains on its own shard of the data files, with the variables on parameter servers
+tf.app.flags.DEFINE_integer('num_workers', 1,
+                            'For train mode only. If greater than 1 (and worker_hosts is not set), run this many local worker processes and a local parameter server, on the ports from dist_port on.')
+tf.app.flags.DEFINE_integer('dist_port', 2222, 'First port of the local processes started by num_workers.')
+tf.app.flags.DEFINE_string('ps_hosts', '', 'Comma-separated list of host:port of the parameter servers, for distributed training.')
+tf.app.flags.DEFINE_string('worker_hosts', '', 'Comma-separated list of host:port of the workers, for distributed training. The first worker is the chief, which saves checkpoints and summaries.')
+tf.app.flags.DEFINE_string('job_name', '', 'For distributed training, whether this process is a ps or a worker.')
+tf.app.flags.DEFINE_integer('task_index', 0, 'For distributed training, the index of this process among the ps_hosts or worker_hosts.')
+
 # Debugging. See https://www.tensorflow.org/programmers_guide/debugger
 tf.app.flags.DEFINE_boolean('debug', False, "Run in tensorflow's debug mode (watches for NaN/inf values)")
 
+# Profiling
+tf.app.flags.DEFINE_string('profile_steps', '',
+                           'For train and decode mode. If N-M, capture a full trace of the Nth to Mth training steps (or decoder steps), counting from 0 in this process, and write a Chrome trace and the time per op type of each to log_root/profile.')
+tf.app.flags.DEFINE_integer('profile_signal_steps', 10,
+                            'For train and decode mode. On a SIGUSR1 signal (kill -USR1 <pid>), profile this many of the next steps, as with profile_steps.')
+
 
 def calc_running_avg_loss(loss, running_avg_loss, summary_writer, step, decay=0.99):
     """Calculate the running average loss via exponential decay.
@@ -169,12 +235,53 @@ def convert_to_coverage_model():
     exit()
 
 
+def get_cluster():
+    """Returns the tf.train.ClusterSpec for distributed training, or None if training in a single process (or not training)"""
+    if FLAGS.mode != 'train' or not FLAGS.worker_hosts:
+        return None
+    return tf.train.ClusterSpec({'ps': FLAGS.ps_hosts.split(','), 'worker': FLAGS.worker_hosts.split(',')})
+
+
+def launch_local_cluster():
+    """Runs distributed training on this machine, with FLAGS.num_workers worker processes and one parameter server, each running this script with the same flags. Returns once the workers have stopped."""
+    ps_hosts = 'localhost:%i' % FLAGS.dist_port
+    worker_hosts = ','.join('localhost:%i' % (FLAGS.dist_port + 1 + i) for i in range(FLAGS.num_workers))
+    cmd = [sys.executable] + sys.argv + ['--ps_hosts=%s' % ps_hosts, '--worker_hosts=%s' % worker_hosts]
+    tf.logging.info("Starting a parameter server at %s and %i workers at %s", ps_hosts, FLAGS.num_workers, worker_hosts)
+    ps = subprocess.Popen(cmd + ['--job_name=ps', '--task_index=0'])
+    workers = [subprocess.Popen(cmd + ['--job_name=worker', '--task_index=%i' % i]) for i in range(FLAGS.num_workers)]
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:  # the workers get the interrupt too, and stop their supervisors
+        tf.logging.info("Caught keyboard interrupt. Waiting for the workers to stop...")
+        for worker in workers:
+            worker.wait()
+    finally:
+        for process in workers + [ps]:
+            if process.poll() is None:
+                process.terminate()
+
+
 def setup_training(model, batcher):
     """Does setup before starting training (run_training)"""
     train_dir = os.path.join(FLAGS.log_root, "train")
-    if not os.path.exists(train_dir): os.makedirs(train_dir)
+    os.makedirs(train_dir, exist_ok=True)  # the workers of distributed training may race to create it
 
-    model.build_graph()  # build the graph
+    cluster = get_cluster()
+    if cluster is None:
+        server, is_chief, config = None, True, util.get_config()
+        model.build_graph()  # build the graph
+    else:
+        # Each worker only talks to the parameter servers, not to the other workers
+        config = util.get_config()
+        config.device_filters.extend(['/job:ps', '/job:worker/task:%i' % FLAGS.task_index])
+        server = tf.train.Server(cluster, job_name='worker', task_index=FLAGS.task_index, config=config)
+        is_chief = FLAGS.task_index == 0
+        # build the graph, with the variables on the parameter servers and the computation on this worker
+        with tf.device(tf.train.replica_device_setter(worker_device='/job:worker/task:%i' % FLAGS.task_index,
+                                                      cluster=cluster)):
+            model.build_graph()
     if FLAGS.convert_to_coverage_model:
         assert FLAGS.coverage, "To convert your non-coverage model to a coverage model, run with convert_to_coverage_model=True and coverage=True"
         convert_to_coverage_model()
@@ -183,61 +290,108 @@ def setup_training(model, batcher):
     saver = tf.train.Saver(max_to_keep=3)  # keep 3 checkpoints at a time
 
     sv = tf.train.Supervisor(logdir=train_dir,
-                             is_chief=True,
+                             is_chief=is_chief,
                              saver=saver,
                              summary_op=None,
                              save_summaries_secs=60,  # save summaries for tensorboard every 60 secs
-                             save_model_secs=60,  # checkpoint every 60 secs
+                             save_model_secs=0 if FLAGS.async_checkpoint else 60,  # checkpoint every 60 secs
                              global_step=model.global_step)
     summary_writer = sv.summary_writer
     tf.logging.info("Preparing or waiting for session...")
-    sess_context_manager = sv.prepare_or_wait_for_session(config=util.get_config())
+    sess_context_manager = sv.prepare_or_wait_for_session(master=server.target if server else '', config=config)
     tf.logging.info("Created session.")
+    checkpointer = None
+    if FLAGS.async_checkpoint and is_chief:  # checkpoint every 60 secs, in the background
+        checkpointer = util.AsyncCheckpointSaver(tf.global_variables(), os.path.join(train_dir, 'model.ckpt'), 60)
+    curriculum = None
+    if FLAGS.length_curriculum:
+        curriculum = util.LengthCurriculum(FLAGS.length_curriculum, FLAGS.max_enc_steps, FLAGS.max_dec_steps,
+                                           FLAGS.curriculum_stage_steps, FLAGS.curriculum_patience,
+                                           os.path.join(train_dir, 'curriculum_stage'))
     try:
         run_training(model, batcher, sess_context_manager, sv,
-                     summary_writer)  # this is an infinite loop until interrupted
+                     summary_writer, checkpointer, curriculum)  # this is an infinite loop until interrupted, or until max_train_steps
     except KeyboardInterrupt:
         tf.logging.info("Caught keyboard interrupt on worker. Stopping supervisor...")
-        sv.stop()
+        if checkpointer is not None:  # don't leave a half-written checkpoint
+            checkpointer.wait()
+    sv.stop()
 
 
-def run_training(model, batcher, sess_context_manager, sv, summary_writer):
-    """Repeatedly runs training iterations, logging loss to screen and writing summaries"""
+def run_training(model, batcher, sess_context_manager, sv, summary_writer, checkpointer=None, curriculum=None):
+    """Repeatedly runs training iterations, logging loss to screen and writing summaries (and with an AsyncCheckpointSaver checkpointer, saving checkpoints, and with a LengthCurriculum, setting the length limits of the batcher)"""
     tf.logging.info("starting run_training")
     with sess_context_manager as sess:
         if FLAGS.debug:  # start the tensorflow debugger
             sess = tf_debug.LocalCLIDebugWrapperSession(sess)
             sess.add_tensor_filter("has_inf_or_nan", tf_debug.has_inf_or_nan)
+        # Only the chief writes summaries in distributed training, and the meter is only emptied when its summary is written
+        throughput = util.ThroughputMeter() if summary_writer is not None else None
+        steps = 0  # training steps run by this process
+        summaries_written = 0
+        if curriculum is not None:  # start from the stage of the restored global step
+            batcher.set_length_limits(*curriculum.update(sess.run(model.global_step)))
         while True:  # repeats until interrupted
-            batch = batcher.next_batch()
-
             tf.logging.info('running training step...')
-            t0 = time.time()
-            results = model.run_train_step(sess, batch)
-            t1 = time.time()
-            tf.logging.info('seconds for training step: %.3f', t1 - t0)
-
-            loss = results['loss']
+            write_summaries = summary_writer is not None and steps % FLAGS.summary_every_n_steps == 0
+            # With gradient accumulation, the gradients of the first grad_accum_steps-1 batches are only accumulated, and applied with the last one's
+            batches, step_results = [], []
+            wait_secs, run_secs = 0.0, 0.0
+            for i in range(FLAGS.grad_accum_steps):
+                t0 = time.time()
+                batch = batcher.next_batch()
+                t1 = time.time()
+                if i < FLAGS.grad_accum_steps - 1:
+                    step_results.append(model.run_accum_step(sess, batch))
+                else:
+                    step_results.append(model.run_train_step(sess, batch, with_summaries=write_summaries))
+                t2 = time.time()
+                batches.append(batch)
+                wait_secs += t1 - t0
+                run_secs += t2 - t1
+            results = step_results[-1]
+            steps += 1
+            if throughput is not None:
+                throughput.add_step(batches, wait_secs, run_secs)
+            tf.logging.info('seconds for training step: %.3f (%.3f waiting for batches)', wait_secs + run_secs, wait_secs)
+
+            loss = np.mean([r['loss'] for r in step_results])
             tf.logging.info('loss: %f', loss)  # print the loss to screen
 
             if not np.isfinite(loss):
                 raise Exception("Loss is not finite. Stopping.")
 
             if FLAGS.coverage:
-                coverage_loss = results['coverage_loss']
+                coverage_loss = np.mean([r['coverage_loss'] for r in step_results])
                 tf.logging.info("coverage_loss: %f", coverage_loss)  # print the coverage loss to screen
 
-            # get the summaries and iteration number so we can write summaries to tensorboard
-            summaries = results['summaries']  # we will write these summaries to tensorboard using summary_writer
+            # get the iteration number so we can write summaries to tensorboard
             train_step = results['global_step']  # we need this to update our running average loss
 
-            summary_writer.add_summary(summaries, train_step)  # write the summaries
-            if train_step % 100 == 0:  # flush the summary writer every so often
-                summary_writer.flush()
-
-            #if train_step >= 10000:
-            #    tf.logging.info('===Finishing this run.====')
-            #    break
+            if write_summaries:  # only the chief writes summaries in distributed training
+                summary_writer.add_summary(results['summaries'], train_step)  # write the summaries
+                # and the throughput since the last time
+                summary_writer.add_summary(throughput.summary(), train_step)
+                if curriculum is not None:
+                    summary_writer.add_summary(curriculum.summary(), train_step)
+                summaries_written += 1
+                if summaries_written % max(1, 100 // FLAGS.summary_every_n_steps) == 0:  # flush the summary writer about every 100 steps
+                    summary_writer.flush()
+
+            if curriculum is not None:
+                batcher.set_length_limits(*curriculum.update(train_step, loss))
+
+            if 0 < FLAGS.max_train_steps <= train_step:
+                tf.logging.info('Reached max_train_steps=%i. Saving the final checkpoint and stopping.', FLAGS.max_train_steps)
+                if checkpointer is not None:
+                    checkpointer.save(sess, model.global_step)
+                    checkpointer.wait()
+                elif sv.is_chief:
+                    sv.saver.save(sess, sv.save_path, global_step=model.global_step)
+                break
+
+            if checkpointer is not None:
+                checkpointer.maybe_save(sess, model.global_step)
 
 def run_eval(model, batcher, vocab):
     """Repeatedly runs eval iterations, logging to screen and writing summaries. Saves the model with the best loss seen so far."""
@@ -287,6 +441,79 @@ def run_eval(model, batcher, vocab):
         if train_step % 100 == 0:
             summary_writer.flush()
 
+def run_eval_fixed_batches(model, batcher):
+    """Scores a fixed set of FLAGS.eval_num_batches batches on every new checkpoint, logging to screen and writing summaries. Saves the model with the best mean loss seen so far."""
+    model.build_graph()  # build the graph
+    saver = tf.train.Saver(max_to_keep=3)  # we will keep 3 best checkpoints at a time
+    sess = tf.Session(config=util.get_config())
+    train_dir = os.path.join(FLAGS.log_root, "train")
+    eval_dir = os.path.join(FLAGS.log_root, "eval")  # make a subdir of the root dir for eval data
+    bestmodel_save_path = os.path.join(eval_dir, 'bestmodel')  # this is where checkpoints of best models are saved
+    summary_writer = tf.summary.FileWriter(eval_dir)
+    best_loss = None  # will hold the best loss achieved so far
+
+    # Read the batches once. The batcher is in single_pass mode, so they are the first ones of the dataset, in order.
+    # A short last batch is left out, as its padding would count in the loss
+    batches = []
+    while len(batches) < FLAGS.eval_num_batches:
+        batch = batcher.next_batch()
+        if batch is None or batch.num_examples < FLAGS.batch_size:
+            break
+        batches.append(batch)
+    if not batches:
+        raise ValueError("The dataset %s has no full batch of batch_size=%i examples to score with eval_num_batches=%i" % (
+            FLAGS.data_path, FLAGS.batch_size, FLAGS.eval_num_batches))
+    tf.logging.info('Scoring %i batches of %i examples on each checkpoint', len(batches), FLAGS.batch_size)
+
+    last_ckpt = None
+    while True:
+        ckpt_state = tf.train.get_checkpoint_state(train_dir)
+        if ckpt_state is None or ckpt_state.model_checkpoint_path == last_ckpt:
+            time.sleep(10)  # wait for a new checkpoint
+            continue
+        last_ckpt = util.load_ckpt(saver, sess)  # load the new checkpoint
+
+        t0 = time.time()
+        results = [model.run_eval_step(sess, batch) for batch in batches]
+        t1 = time.time()
+        tf.logging.info('seconds for %i batches: %.2f', len(batches), t1 - t0)
+
+        # All batches have batch_size examples, so the mean of their losses is the mean over the examples
+        train_step = results[0]['global_step']
+        loss = np.mean([r['loss'] for r in results])
+        summary = tf.Summary()
+        summary.value.add(tag='fixed_eval/loss', simple_value=loss)
+        tf.logging.info('loss: %f', loss)
+        if FLAGS.coverage:
+            coverage_loss = np.mean([r['coverage_loss'] for r in results])
+            summary.value.add(tag='fixed_eval/coverage_loss', simple_value=coverage_loss)
+            tf.logging.info("coverage_loss: %f", coverage_loss)
+        summary_writer.add_summary(summary, train_step)
+        summary_writer.flush()
+
+        # If the loss is the best so far, save this checkpoint (early stopping).
+        # These checkpoints will appear as bestmodel-<iteration_number> in the eval dir
+        if best_loss is None or loss < best_loss:
+            tf.logging.info('Found new best model with %.3f loss. Saving to %s', loss, bestmodel_save_path)
+            saver.save(sess, bestmodel_save_path, global_step=train_step, latest_filename='checkpoint_best')
+            best_loss = loss
+
+
+def make_hps():
+    """Returns a namedtuple hps, containing the values of the hyperparameters that the model needs"""
+    hparam_list = ['mode', 'lr', 'adagrad_init_acc', 'rand_unif_init_mag', 'trunc_norm_init_std', 'max_grad_norm',
+                   'hidden_dim', 'emb_dim', 'batch_size', 'max_dec_steps', 'max_enc_steps', 'coverage', 'cov_loss_wt',
+                   'pointer_gen', 'attention_model', 'input_attention', 'use_intra_decoder_attention',
+                   'decode_strategy', 'stateful_decode', 'decode_shortlist_size', 'dynamic_decoder',
+                   'num_sampled_softmax', 'lstm_cell', 'optimizer', 'checkpoint_dec_steps',
+                   'grad_accum_steps']
+    hps_dict = {}
+    for key, val in FLAGS.__flags.items():  # for each flag
+        if key in hparam_list:  # if it's in the list
+            hps_dict[key] = val  # add it to the dict
+    return namedtuple("HParams", hps_dict.keys())(**hps_dict)
+
+
 def main(unused_argv):
     if len(unused_argv) != 1:  # prints a message if you've entered flags incorrectly
         raise Exception("Problem with flags: %s" % unused_argv)
@@ -302,30 +529,82 @@ def main(unused_argv):
         else:
             raise Exception("Logdir %s doesn't exist. Run in train mode to create it." % (FLAGS.log_root))
 
+    if FLAGS.mode == 'train' and FLAGS.num_workers > 1 and not FLAGS.worker_hosts:
+        launch_local_cluster()
+        return
+
+    cluster = get_cluster()
+    if cluster is not None and FLAGS.job_name not in ['ps', 'worker']:
+        raise ValueError("With worker_hosts, the 'job_name' flag must be one of ps/worker")
+    if cluster is not None and FLAGS.job_name == 'ps':
+        server = tf.train.Server(cluster, job_name='ps', task_index=FLAGS.task_index, config=util.get_config())
+        server.join()  # serve the variables until killed
+        return
+
     vocab = Vocab(FLAGS.vocab_path, FLAGS.vocab_size)  # create a vocabulary
 
-    # If in decode mode, set batch_size = beam_size
-    # Reason: in decode mode, we decode one example at a time.
+    if FLAGS.decode_strategy not in ['beam', 'greedy', 'sample']:
+        raise ValueError("The 'decode_strategy' flag must be one of beam/greedy/sample")
+
+    # If in beam search decode mode, set batch_size = beam_size
+    # Reason: in beam search decode mode, we decode one example at a time.
     # On each step, we have beam_size-many hypotheses in the beam, so we need to make a batch of these hypotheses.
-    if FLAGS.mode == 'decode':
+    # Greedy and sampling decoding keep batch_size, and decode that many examples at a time.
+    if FLAGS.mode == 'decode' and FLAGS.decode_strategy == 'beam':
         FLAGS.batch_size = FLAGS.beam_size
 
+    if FLAGS.mode == 'decode' and FLAGS.decode_strategy == 'sample' and not 0 < FLAGS.sample_top_k <= 2 * FLAGS.batch_size:
+        raise ValueError("The 'sample_top_k' flag must be between 1 and 2*batch_size=%i" % (2 * FLAGS.batch_size))
+
+    if FLAGS.summary_every_n_steps < 1:
+        raise ValueError("The 'summary_every_n_steps' flag must be at least 1")
+
+    if FLAGS.grad_accum_steps < 1:
+        raise ValueError("The 'grad_accum_steps' flag must be at least 1")
+    if FLAGS.grad_accum_steps > 1 and FLAGS.optimizer == 'lazy_adam':
+        raise ValueError("optimizer=lazy_adam can't be used with grad_accum_steps > 1: the accumulated embedding gradient is dense, so every row would be updated on every step")
+    if FLAGS.max_train_steps < 0 or FLAGS.intra_op_threads < 0 or FLAGS.inter_op_threads < 0:
+        raise ValueError("The 'max_train_steps', 'intra_op_threads' and 'inter_op_threads' flags must not be negative")
+
+    if FLAGS.length_curriculum and FLAGS.curriculum_stage_steps <= 0 and FLAGS.curriculum_patience <= 0:
+        raise ValueError("The length_curriculum flag needs a positive curriculum_stage_steps and/or curriculum_patience")
+    if FLAGS.length_curriculum and FLAGS.curriculum_patience > 0 and (FLAGS.worker_hosts or FLAGS.num_workers > 1):
+        raise ValueError("The curriculum_patience flag is not supported in distributed training, where each worker only sees its own loss. Use curriculum_stage_steps, which all workers follow by the shared global step")
+
+    if FLAGS.optimizer not in ['adam', 'lazy_adam', 'adagrad']:
+        raise ValueError("The 'optimizer' flag must be one of adam/lazy_adam/adagrad")
+
+    if FLAGS.lstm_cell not in ['lstm', 'block']:
+        raise ValueError("The 'lstm_cell' flag must be one of lstm/block")
+
+    if FLAGS.dynamic_decoder and FLAGS.attention_model != 0:
+        raise ValueError("The dynamic_decoder flag is only supported with attention_model=0")
+
+    if FLAGS.num_sampled_softmax > 0 and FLAGS.attention_model != 0:
+        raise ValueError("The num_sampled_softmax flag is only supported with attention_model=0")
+
+    if FLAGS.checkpoint_dec_steps > 0 and (FLAGS.dynamic_decoder or FLAGS.attention_model != 0 or
+                                           FLAGS.use_intra_decoder_attention not in [0, 3]):
+        raise ValueError("The checkpoint_dec_steps flag is only supported with the unrolled decoder, attention_model=0 and use_intra_decoder_attention=0 or 3")
+
+    if FLAGS.mode == 'decode' and 0 < FLAGS.decode_shortlist_size < 2 * FLAGS.batch_size:
+        raise ValueError("The 'decode_shortlist_size' flag must be 0 or at least 2*batch_size=%i, so that the decoder can return its top k" % (2 * FLAGS.batch_size))
+
     # If single_pass=True, check we're in decode mode
     if FLAGS.single_pass and FLAGS.mode != 'decode':
         raise Exception("The single_pass flag should only be True in decode mode")
 
-    # Make a namedtuple hps, containing the values of the hyperparameters that the model needs
-    hparam_list = ['mode', 'lr', 'adagrad_init_acc', 'rand_unif_init_mag', 'trunc_norm_init_std', 'max_grad_norm',
-                   'hidden_dim', 'emb_dim', 'batch_size', 'max_dec_steps', 'max_enc_steps', 'coverage', 'cov_loss_wt',
-                   'pointer_gen', 'attention_model', 'input_attention', 'use_intra_decoder_attention']
-    hps_dict = {}
-    for key, val in FLAGS.__flags.items():  # for each flag
-        if key in hparam_list:  # if it's in the list
-            hps_dict[key] = val  # add it to the dict
-    hps = namedtuple("HParams", hps_dict.keys())(**hps_dict)
+    hps = make_hps()
 
     # Create a batcher object that will create minibatches of data
-    batcher = Batcher(FLAGS.data_path, vocab, hps, single_pass=FLAGS.single_pass)
+    # (in distributed training, each worker reads its own shard of the data files)
+    if cluster is not None:
+        batcher = Batcher(FLAGS.data_path, vocab, hps, single_pass=FLAGS.single_pass, shard_index=FLAGS.task_index,
+                          num_shards=cluster.num_tasks('worker'))
+    else:
+        # (reading the fixed eval batches, the batcher goes through the dataset once, in order)
+        batcher = Batcher(FLAGS.data_path, vocab, hps,
+                          single_pass=FLAGS.single_pass or (hps.mode == 'eval' and FLAGS.eval_num_batches > 0))
 
     tf.set_random_seed(111)  # a seed value for randomness
 
@@ -335,7 +614,10 @@ def main(unused_argv):
         setup_training(model, batcher)
     elif hps.mode == 'eval':
         model = SummarizationModel(hps, vocab)
-        run_eval(model, batcher, vocab)
+        if FLAGS.eval_num_batches > 0:
+            run_eval_fixed_batches(model, batcher)
+        else:
+            run_eval(model, batcher, vocab)
     elif hps.mode == 'decode':
         decode_model_hps = hps  # This will be the hyperparameters for the decoder model
         decode_model_hps = hps._replace(
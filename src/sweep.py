@@ -0,0 +1,219 @@
+"""
+Runs a grid of run_summarization.py experiments as concurrent processes, and collects their loss and ROUGE scores into one table.
+
+Each experiment does what one iteration of the run_*.sh scripts does: it trains for max_train_steps steps, then decodes decode_data_path in single_pass mode and scores the summaries with ROUGE. The cores of the machine are split between num_parallel experiments at a time; each one is pinned to its own cores, and its tensorflow thread pools are sized to match, so that the experiments don't slow each other down. Run like this:
+  python sweep.py --grid="attention_model=0,1 pointer_gen=False,True hidden_dim=200" --num_parallel=4 --max_train_steps=10000 --data_path=../data/finished_files/chunked/train_*.bin --decode_data_path=../data/finished_files/chunked/val_000.bin --vocab_path=../data/finished_files/vocab --log_root=log --lr=0.0001
+Flags that sweep.py doesn't know (like --lr above) are passed on to every train and decode run. Each experiment logs to log_root/<exp_prefix>_<grid values>/sweep_{train,decode}.log, and the table is written to log_root/<exp_prefix>_results.tsv.
+"""
+
+import argparse
+import glob
+import itertools
+import os
+import queue as Queue
+import re
+import subprocess
+import sys
+import threading
+import time
+
+RUN_SUMMARIZATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_summarization.py')
+
+ROUGE_KEYS = ['rouge_1_f_score', 'rouge_2_f_score', 'rouge_l_f_score']
+
+
+def parse_grid(grid):
+    """Parse a grid like "attention_model=0,1 pointer_gen=False,True" into a list of (flag, values) pairs, in the given order."""
+    pairs = []
+    for item in grid.split():
+        flag, sep, values = item.partition('=')
+        if not sep or not flag or not values:
+            raise ValueError("Grid items must look like flag=value1,value2,... but got %r" % item)
+        pairs.append((flag.lstrip('-'), values.split(',')))
+    return pairs
+
+
+def make_experiments(grid_pairs, exp_prefix):
+    """Returns one (exp_name, [(flag, value)]) per point of the grid."""
+    flags = [flag for flag, _ in grid_pairs]
+    experiments = []
+    for values in itertools.product(*[values for _, values in grid_pairs]):
+        settings = list(zip(flags, values))
+        exp_name = '_'.join([exp_prefix] + ['%s%s' % (flag, value) for flag, value in settings])
+        experiments.append((exp_name, settings))
+    return experiments
+
+
+def partition_cores(num_parallel, cores_per_job):
+    """Split the cores this process may run on into num_parallel disjoint lists of cores_per_job cores (or as many as fit, if cores_per_job is 0)."""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    if not cores_per_job:
+        cores_per_job = max(1, len(cores) // num_parallel)
+    if cores_per_job * num_parallel > len(cores):
+        raise ValueError("Can't give %i parallel experiments %i cores each: only %i cores are available" % (
+            num_parallel, cores_per_job, len(cores)))
+    return [cores[i * cores_per_job:(i + 1) * cores_per_job] for i in range(num_parallel)]
+
+
+def run_command(cmd, log_path, cores):
+    """Run cmd pinned to cores, with its tensorflow and OpenMP thread pools limited to len(cores) threads, and its output appended to log_path. Returns the exit code."""
+    env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)))
+    cmd = cmd + ['--intra_op_threads=%i' % len(cores), '--inter_op_threads=%i' % len(cores)]
+    with open(log_path, 'a') as log:
+        log.write('Running: %s\n' % ' '.join(cmd))
+        log.flush()
+        process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        # Not in a preexec_fn, which can deadlock with several threads starting processes. Popen returns once the command is
+        # exec'd, before python has started any threads (which inherit the affinity) or tensorflow has sized its thread pools.
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(process.pid, cores)
+        return process.wait()
+
+
+def run_experiment(args, extra_flags, exp_name, settings, cores, stopping):
+    """Train one experiment, then decode with it (unless the stopping Event was set meanwhile). Returns its row of the results table."""
+    exp_dir = os.path.join(args.log_root, exp_name)
+    if not os.path.exists(exp_dir):
+        os.makedirs(exp_dir)
+    flags = ['--%s=%s' % (flag, value) for flag, value in settings] + extra_flags + [
+        '--vocab_path=%s' % args.vocab_path, '--log_root=%s' % args.log_root, '--exp_name=%s' % exp_name]
+    row = dict(settings, exp_name=exp_name)
+
+    print('Training %s on cores %s' % (exp_name, ','.join(str(c) for c in cores)))
+    t0 = time.time()
+    train_log = os.path.join(exp_dir, 'sweep_train.log')
+    cmd = [sys.executable, RUN_SUMMARIZATION, '--mode=train', '--data_path=%s' % args.data_path,
+           '--max_train_steps=%i' % args.max_train_steps] + flags
+    code = run_command(cmd, train_log, cores)
+    row['train_secs'] = '%.0f' % (time.time() - t0)
+    row['train_loss'] = final_train_loss(train_log)
+    if code != 0:
+        row['status'] = 'train failed, see %s' % train_log
+        return row
+    if stopping.is_set():
+        row['status'] = 'interrupted'
+        return row
+
+    if args.decode_data_path:
+        print('Decoding with %s' % exp_name)
+        decode_log = os.path.join(exp_dir, 'sweep_decode.log')
+        cmd = [sys.executable, RUN_SUMMARIZATION, '--mode=decode', '--single_pass=1',
+               '--data_path=%s' % args.decode_data_path] + flags
+        if run_command(cmd, decode_log, cores) != 0:
+            row['status'] = 'decode failed, see %s' % decode_log
+            return row
+        row.update(latest_rouge(exp_dir))
+    row['status'] = 'ok'
+    return row
+
+
+def final_train_loss(train_log, last_n=100):
+    """Returns the mean of the last last_n training losses logged to train_log, formatted for the table, or '' if there are none."""
+    losses = []
+    with open(train_log) as f:
+        for line in f:
+            match = re.search(r'tensorflow:loss: (\S+)', line)
+            if match:
+                losses.append(float(match.group(1)))
+    if not losses:
+        return ''
+    losses = losses[-last_n:]
+    return '%.4f' % (sum(losses) / len(losses))
+
+
+def latest_rouge(exp_dir):
+    """Returns the ROUGE F-scores written by the most recent single_pass decode of the experiment (see decode.rouge_log)."""
+    results_files = glob.glob(os.path.join(exp_dir, 'decode_*', 'ROUGE_results.txt'))
+    if not results_files:
+        return {}
+    scores = {}
+    with open(max(results_files, key=os.path.getmtime)) as f:
+        for line in f:
+            key, sep, rest = line.partition(': ')
+            if sep and key in ROUGE_KEYS:
+                scores[key] = rest.split()[0]
+    return scores
+
+
+def write_table(rows, columns, path):
+    """Print the results as an aligned table, and write them as tab-separated values to path."""
+    table = [columns] + [[str(row.get(c, '')) for c in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    print('')
+    for line in table:
+        print('  '.join(value.ljust(width) for value, width in zip(line, widths)))
+    with open(path, 'w') as f:
+        for line in table:
+            f.write('\t'.join(line) + '\n')
+    print('\nWrote the results to %s' % path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a grid of run_summarization.py experiments in parallel, and tabulate their loss and ROUGE scores. Unknown flags are passed on to run_summarization.py.')
+    parser.add_argument('--grid', required=True,
+                        help='Space-separated flag=value1,value2,... items, e.g. "attention_model=0,1 pointer_gen=False,True use_intra_decoder_attention=0,3 batch_size=16 hidden_dim=200". One experiment is run per combination.')
+    parser.add_argument('--data_path', required=True, help='Training data, as for run_summarization.py.')
+    parser.add_argument('--decode_data_path', default='',
+                        help='Data to decode in single_pass mode and score with ROUGE after training, e.g. a val_*.bin chunk. If empty, only train.')
+    parser.add_argument('--vocab_path', required=True, help='As for run_summarization.py.')
+    parser.add_argument('--log_root', required=True, help='As for run_summarization.py.')
+    parser.add_argument('--exp_prefix', default='sweep',
+                        help='Each experiment is named exp_prefix followed by its grid values.')
+    parser.add_argument('--max_train_steps', type=int, required=True,
+                        help='Train each experiment up to this global step before decoding.')
+    parser.add_argument('--num_parallel', type=int, default=1, help='How many experiments to run at a time.')
+    parser.add_argument('--cores_per_job', type=int, default=0,
+                        help='Cores to pin each experiment to. 0 (default) splits the available cores evenly between num_parallel experiments.')
+    args, extra_flags = parser.parse_known_args()
+    if args.num_parallel < 1 or args.max_train_steps < 1 or args.cores_per_job < 0:
+        raise ValueError("num_parallel and max_train_steps must be at least 1, and cores_per_job must not be negative")
+
+    grid_pairs = parse_grid(args.grid)
+    experiments = make_experiments(grid_pairs, args.exp_prefix)
+    core_sets = partition_cores(min(args.num_parallel, len(experiments)), args.cores_per_job)
+    print('Running %i experiments, %i at a time, with %i cores each' % (
+        len(experiments), len(core_sets), len(core_sets[0])))
+
+    # One thread per core set takes the next experiment off the queue and waits for its processes
+    todo = Queue.Queue()
+    for experiment in experiments:
+        todo.put(experiment)
+    rows = {}
+    stopping = threading.Event()
+
+    def work(cores):
+        while not stopping.is_set():
+            try:
+                exp_name, settings = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                rows[exp_name] = run_experiment(args, extra_flags, exp_name, settings, cores, stopping)
+            except Exception as e:  # keep running the other experiments
+                rows[exp_name] = dict(settings, exp_name=exp_name, status='error: %s' % e)
+            print('Finished %s: %s' % (exp_name, rows[exp_name]['status']))
+
+    threads = [threading.Thread(target=work, args=(cores,)) for cores in core_sets]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:  # the running experiments get the interrupt too, and save their checkpoints
+        print('Caught keyboard interrupt. Waiting for the running experiments to stop...')
+        stopping.set()
+        for thread in threads:
+            thread.join()
+
+    columns = ['exp_name'] + [flag for flag, _ in grid_pairs] + ['train_loss'] + ROUGE_KEYS + ['train_secs', 'status']
+    write_table([rows[exp_name] for exp_name, _ in experiments if exp_name in rows], columns,
+                os.path.join(args.log_root, '%s_results.tsv' % args.exp_prefix))
+
+
+if __name__ == '__main__':
+    main()
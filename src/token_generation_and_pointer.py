@@ -12,7 +12,7 @@ import argparse
 
 def tokenization(encoder_attn_score, decoder_state, encoder_context,
                  decoder_context, attn_score_size, vocab_size,
-                 use_pointer=False):
+                 use_pointer=False, vocab_ids=None):
     '''
     Token generation and pointer (2.3, p.3). u_t = 1 if we
     want to pay attention to or copy the inputs and u_t = 0 if we do not. The
@@ -33,6 +33,9 @@ def tokenization(encoder_attn_score, decoder_state, encoder_context,
         vocab_size: scalar vocabulary size,
             size = [vocab_size]
         use_pointer: boolean, True = pointer mechanism, False = no pointer
+        vocab_ids: None, or 1-D int tensor of vocabulary ids (a decode-time
+            shortlist); if given, scores and distribution are only computed
+            over these ids, in this order
 
     Returns:
         final_dists: tensor of word probability distn for each timestep y_t,
@@ -109,6 +112,11 @@ def tokenization(encoder_attn_score, decoder_state, encoder_context,
         # Reuse variables across timesteps
         tf.get_variable_scope().reuse_variables()
 
+        # Only project onto the shortlist
+        if vocab_ids is not None:
+            W_out = tf.gather(W_out, vocab_ids, axis=1)
+            b_out = tf.gather(b_out, vocab_ids)
+
         # Equation 9
         vocab_scores = tf.nn.xw_plus_b(attentions, W_out, b_out)
         final_dists = tf.nn.softmax(vocab_scores)
@@ -16,17 +16,26 @@
 
 """This file contains some utility functions"""
 
+import glob
 import os
+import signal
 import time
+from collections import defaultdict, deque
+from threading import Event, Thread
 
+import numpy as np
+import queue as Queue
 import tensorflow as tf
+from tensorflow.python.client import timeline
 
 FLAGS = tf.app.flags.FLAGS
 
 
 def get_config():
     """Returns config for tf.session"""
-    config = tf.ConfigProto(allow_soft_placement=True)
+    config = tf.ConfigProto(allow_soft_placement=True,
+                            intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                            inter_op_parallelism_threads=FLAGS.inter_op_threads)
     config.gpu_options.allow_growth = True
     return config
 
@@ -44,3 +53,282 @@ def load_ckpt(saver, sess, ckpt_dir="train"):
         except:
             tf.logging.info("Failed to load checkpoint from %s. Sleeping for %i secs...", ckpt_dir, 10)
             time.sleep(10)
+
+
+class ThroughputMeter(object):
+    """Collects the training throughput over the steps between two summaries, and the percentiles of the step times over a window of the last steps."""
+
+    def __init__(self, window_steps=100):
+        """
+        Args:
+          window_steps: Number of most recent step times to take the percentiles over, whatever the summaries in between.
+        """
+        self._recent_step_secs = deque(maxlen=window_steps)
+        self._reset()
+
+    def _reset(self):
+        self._secs = 0.0
+        self._wait_secs = 0.0
+        self._examples = 0
+        self._enc_tokens, self._enc_padded_tokens = 0, 0
+        self._dec_tokens, self._dec_padded_tokens = 0, 0
+
+    def add_step(self, batches, wait_secs, run_secs):
+        """Add a training step.
+
+        Args:
+          batches: The batches of the step (more than one with gradient accumulation).
+          wait_secs: Seconds spent waiting for the batches.
+          run_secs: Seconds spent running the model on them.
+        """
+        self._recent_step_secs.append(wait_secs + run_secs)
+        self._secs += wait_secs + run_secs
+        self._wait_secs += wait_secs
+        for batch in batches:
+            self._examples += batch.num_examples
+            self._enc_tokens += np.sum(batch.enc_lens)
+            self._enc_padded_tokens += batch.enc_batch.size
+            self._dec_tokens += np.sum(batch.dec_padding_mask)
+            self._dec_padded_tokens += batch.dec_padding_mask.size
+
+    def summary(self):
+        """Returns a tf.Summary of the throughput over the steps added since the last call, and (once there are enough) of the step time percentiles over the window."""
+        secs = self._secs
+        values = {
+            'examples_per_sec': self._examples / secs,
+            'enc_tokens_per_sec': self._enc_tokens / secs,
+            'dec_tokens_per_sec': self._dec_tokens / secs,
+            'enc_padding_ratio': 1 - self._enc_tokens / self._enc_padded_tokens,
+            'dec_padding_ratio': 1 - self._dec_tokens / self._dec_padded_tokens,
+            'batch_wait_fraction': self._wait_secs / secs,
+        }
+        if len(self._recent_step_secs) >= 10:  # percentiles of fewer steps would mean little
+            for p in [50, 90, 99]:
+                values['step_secs_p%i' % p] = np.percentile(self._recent_step_secs, p)
+        summary = tf.Summary()
+        for name, value in sorted(values.items()):
+            summary.value.add(tag='throughput/' + name, simple_value=float(value))
+        self._reset()
+        return summary
+
+
+class LengthCurriculum(object):
+    """Chooses the truncation limits of the training batches: a few stages of short articles and abstracts, then the full max_enc_steps and max_dec_steps.
+
+    Training moves to the next stage every stage_steps global steps, and/or once the running average loss has not improved for patience steps. Stages reached by a loss plateau are saved to state_path, so that a restarted training job resumes from them."""
+
+    def __init__(self, stages, max_enc_steps, max_dec_steps, stage_steps=0, patience=0, state_path=None, decay=0.99):
+        """
+        Args:
+          stages: 'ENC:DEC,ENC:DEC,...', the max_enc_steps:max_dec_steps limits of the stages before the full ones.
+          max_enc_steps, max_dec_steps: The full limits, of the last stage.
+          stage_steps: If positive, move to the next stage every this many global steps.
+          patience: If positive, move to the next stage once the running average loss hasn't improved for this many steps.
+          state_path: None, or the file to save the stage reached by a loss plateau to.
+          decay: The decay of the running average loss.
+        """
+        self._limits = []
+        for stage in stages.split(','):
+            try:
+                enc_steps, dec_steps = [int(n) for n in stage.split(':')]
+            except ValueError:
+                raise ValueError("The stages of the length curriculum must be of the form ENC:DEC,ENC:DEC,..., not '%s'" % stages)
+            if not 0 < enc_steps <= max_enc_steps or not 0 < dec_steps <= max_dec_steps:
+                raise ValueError("The limits of each stage of the length curriculum must be between 1 and max_enc_steps:max_dec_steps=%i:%i, not %s" % (
+                    max_enc_steps, max_dec_steps, stage))
+            self._limits.append((enc_steps, dec_steps))
+        self._limits.append((max_enc_steps, max_dec_steps))
+        self._stage_steps = stage_steps
+        self._patience = patience
+        self._state_path = state_path
+        self._decay = decay
+        self._plateau_stage = 0  # the last stage reached by a loss plateau
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path) as f:
+                self._plateau_stage = int(f.read())
+        self._stage = None
+        self._reset_loss()
+
+    def _reset_loss(self):
+        self._running_avg_loss = None
+        self._best_loss, self._best_step = None, None
+
+    def update(self, global_step, loss=None):
+        """Move to the next stage if it's time to.
+
+        Args:
+          global_step: The global step reached.
+          loss: None, or the loss of the last training step.
+
+        Returns:
+          (max_enc_steps, max_dec_steps) of the current stage.
+        """
+        stage = self._plateau_stage
+        if self._stage_steps:
+            stage = max(stage, global_step // self._stage_steps)
+        if loss is not None and self._patience and stage == self._stage and stage < len(self._limits) - 1:
+            self._running_avg_loss = loss if self._running_avg_loss is None else \
+                self._running_avg_loss * self._decay + (1 - self._decay) * loss
+            if self._best_loss is None or self._running_avg_loss < self._best_loss:
+                self._best_loss, self._best_step = self._running_avg_loss, global_step
+            elif global_step - self._best_step >= self._patience:
+                tf.logging.info('The running average loss has not improved on %f for %i steps', self._best_loss,
+                                global_step - self._best_step)
+                stage += 1
+        stage = min(stage, len(self._limits) - 1)
+
+        if stage != self._stage:
+            tf.logging.info('Length curriculum stage %i of %i at step %i: max_enc_steps=%i, max_dec_steps=%i', stage + 1,
+                            len(self._limits), global_step, self._limits[stage][0], self._limits[stage][1])
+            if self._stage is not None and stage > self._plateau_stage and self._patience:
+                self._plateau_stage = stage
+                if self._state_path is not None:
+                    with open(self._state_path, 'w') as f:
+                        f.write('%i\n' % stage)
+            self._stage = stage
+            self._reset_loss()  # the loss isn't comparable across stages
+        return self._limits[stage]
+
+    def summary(self):
+        """Returns a tf.Summary of the current limits."""
+        summary = tf.Summary()
+        for name, value in zip(['max_enc_steps', 'max_dec_steps'], self._limits[self._stage]):
+            summary.value.add(tag='curriculum/' + name, simple_value=value)
+        return summary
+
+
+class AsyncCheckpointSaver(object):
+    """Saves checkpoints of the training variables in a background thread, so that training only stalls while their values are copied to host memory.
+
+    The checkpoints are the files and `checkpoint` index file that tf.train.Saver writes, so load_ckpt and the Supervisor restore them as usual. They are written by a copy of the variables in a separate graph and session, from the snapshot of their values."""
+
+    def __init__(self, var_list, save_path, save_secs, max_to_keep=3):
+        """
+        Args:
+          var_list: The variables to save.
+          save_path: The prefix of the checkpoint files, e.g. train_dir/model.ckpt; the global step is appended.
+          save_secs: Take a snapshot at most once every save_secs seconds.
+          max_to_keep: Number of checkpoints to keep, as in tf.train.Saver.
+        """
+        self._var_list = var_list
+        self._save_path = save_path
+        self._save_secs = save_secs
+        self._last_snapshot_time = time.time()
+
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._placeholders = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in var_list]
+            # initialized with the values of each snapshot
+            host_vars = [tf.Variable(p, trainable=False, collections=[]) for p in self._placeholders]
+            self._init_ops = [v.initializer for v in host_vars]
+            self._saver = tf.train.Saver({v.op.name: hv for v, hv in zip(var_list, host_vars)}, max_to_keep=max_to_keep)
+        self._sess = tf.Session(graph=self._graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+        self._snapshots = Queue.Queue(1)
+        self._idle = Event()  # set while no snapshot is being written
+        self._idle.set()
+        self._writer_thread = Thread(target=self._write_snapshots)
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    def maybe_save(self, sess, global_step):
+        """Between training steps. If save_secs have passed since the last snapshot and it has been written, take a snapshot of the variables to be written in the background."""
+        if time.time() - self._last_snapshot_time < self._save_secs or not self._idle.is_set():
+            return
+        self.save(sess, global_step)
+
+    def save(self, sess, global_step):
+        """Take a snapshot of the variables (waiting for the previous one to be written), to be written in the background."""
+        self._idle.wait()
+        self._idle.clear()
+        self._last_snapshot_time = time.time()
+        values, step = sess.run([self._var_list, global_step])
+        self._snapshots.put((values, step))
+
+    def wait(self):
+        """Wait for the last snapshot to be written."""
+        self._idle.wait()
+
+    def _write_snapshots(self):
+        """Writes the snapshots to disk, one after the other. Runs in the background thread."""
+        while True:
+            values, step = self._snapshots.get()
+            try:
+                t0 = time.time()
+                self._sess.run(self._init_ops, feed_dict=dict(zip(self._placeholders, values)))
+                path = self._saver.save(self._sess, self._save_path, global_step=step, write_meta_graph=False)
+                # Make sure the checkpoint is on disk, in case the machine goes down before the OS writes it
+                for fname in glob.glob(path + '.*') + [os.path.join(os.path.dirname(path), 'checkpoint')]:
+                    with open(fname, 'rb') as f:
+                        os.fsync(f.fileno())
+                tf.logging.info('Saved checkpoint %s in the background in %.3f seconds', path, time.time() - t0)
+            except Exception as e:  # keep training; the next snapshot may succeed
+                tf.logging.error('Failed to save checkpoint of step %i: %s', step, e)
+            finally:
+                self._idle.set()
+
+
+class StepProfiler(object):
+    """Captures full traces of a range of session runs (e.g. training or decoder steps). For each one, writes a Chrome trace (to open in chrome://tracing) and a table of the time spent per op type to profile_dir.
+
+    The range is given up front, and/or a SIGUSR1 signal starts the profiling of the next signal_steps runs."""
+
+    def __init__(self, profile_dir, steps='', signal_steps=10):
+        """
+        Args:
+          profile_dir: The directory to write the profiles to.
+          steps: '' or 'N-M', the range of runs to profile, counting from 0.
+          signal_steps: Number of runs to profile after a SIGUSR1 signal.
+        """
+        self._profile_dir = profile_dir
+        self._signal_steps = signal_steps
+        self._step = 0  # index of the next run
+        self._first, self._last = 0, -1  # the range of runs to profile, empty by default
+        if steps:
+            try:
+                self._first, self._last = [int(n) for n in steps.split('-')]
+            except ValueError:
+                raise ValueError("The range of steps to profile must be of the form N-M, not '%s'" % steps)
+        signal.signal(signal.SIGUSR1, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+        """Profile the next signal_steps runs"""
+        tf.logging.info('Profiling the next %i steps to %s', self._signal_steps, self._profile_dir)
+        self._first, self._last = self._step, self._step + self._signal_steps - 1
+
+    def run(self, sess, fetches, feed_dict):
+        """Runs sess.run(fetches, feed_dict), with a full trace if the run is in the range to profile"""
+        step = self._step
+        self._step += 1
+        if not self._first <= step <= self._last:
+            return sess.run(fetches, feed_dict)
+
+        run_metadata = tf.RunMetadata()
+        results = sess.run(fetches, feed_dict, options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                           run_metadata=run_metadata)
+        self._write_profile(step, run_metadata.step_stats)
+        return results
+
+    def _write_profile(self, step, step_stats):
+        """Writes the Chrome trace and op type table of a run"""
+        if not os.path.exists(self._profile_dir): os.makedirs(self._profile_dir)
+        fname = os.path.join(self._profile_dir, 'step_%i' % step)
+        with open(fname + '_timeline.json', 'w') as f:
+            f.write(timeline.Timeline(step_stats).generate_chrome_trace_format())
+
+        # Total the time of the ops by type. The timeline labels are of the form "name = Type(inputs)"
+        op_micros, op_counts = defaultdict(int), defaultdict(int)
+        for dev_stats in step_stats.dev_stats:
+            for node_stats in dev_stats.node_stats:
+                if ' = ' not in node_stats.timeline_label:
+                    continue
+                op_type = node_stats.timeline_label.split(' = ')[1].split('(')[0]
+                op_micros[op_type] += node_stats.all_end_rel_micros
+                op_counts[op_type] += 1
+        total_micros = max(sum(op_micros.values()), 1)
+        with open(fname + '_op_types.txt', 'w') as f:
+            f.write('op_type\tcount\ttotal_ms\tpercent\n')
+            for op_type in sorted(op_micros, key=op_micros.get, reverse=True):
+                f.write('%s\t%i\t%.3f\t%.1f\n' % (op_type, op_counts[op_type], op_micros[op_type] / 1000.0,
+                                                    100.0 * op_micros[op_type] / total_micros))
+        tf.logging.info('Wrote profile of step %i to %s_*', step, fname)